@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import tempfile
+
+import nibabel
+import numpy
+
+import cest
+
+class Processing:
+    """ Processing tasks on synthetic Z-spectra, with a Lorentzian direct
+        saturation shifted by a random B0 inhomogeneity.
+    """
+    
+    params = [[(32, 32, 8), (64, 64, 16), (128, 128, 32)]]
+    param_names = ["shape"]
+    timeout = 600
+    
+    def setup(self, shape):
+        self.directory = tempfile.mkdtemp()
+        self.path = lambda x: os.path.join(self.directory, x)
+        
+        rng = numpy.random.default_rng(0)
+        ppm = numpy.linspace(-5, 5, 41)
+        shift = rng.uniform(-0.3, 0.3, shape)
+        data = 1-0.9/(1+((ppm-shift[..., None])/0.5)**2)
+        data += rng.normal(0, 0.01, data.shape)
+        
+        nibabel.save(
+            nibabel.Nifti1Image(data.astype(numpy.float32), numpy.eye(4)),
+            self.path("spectrum.nii"))
+        nibabel.save(
+            nibabel.Nifti1Image(shift.astype(numpy.float32), numpy.eye(4)),
+            self.path("B0.nii"))
+        with open(self.path("spectrum.json"), "w") as fd:
+            json.dump(
+                {"SaturationPulse": [{"FrequencyOffset": x} for x in ppm]}, fd)
+        
+        self.ppms = numpy.linspace(-5, 5, 201)
+    
+    def teardown(self, shape):
+        shutil.rmtree(self.directory)
+    
+    def time_wassr(self, shape):
+        cest.wassr(
+            self.path("spectrum.nii"), self.path("spectrum.json"),
+            self.path("wassr.nii"))
+    
+    def peakmem_wassr(self, shape):
+        cest.wassr(
+            self.path("spectrum.nii"), self.path("spectrum.json"),
+            self.path("wassr.nii"))
+    
+    def time_shift_spectrum(self, shape):
+        cest.shift_spectrum(
+            self.path("spectrum.nii"), self.path("spectrum.json"),
+            self.path("B0.nii"), self.path("shifted.nii"))
+    
+    def peakmem_shift_spectrum(self, shape):
+        cest.shift_spectrum(
+            self.path("spectrum.nii"), self.path("spectrum.json"),
+            self.path("B0.nii"), self.path("shifted.nii"))
+    
+    def time_refine(self, shape):
+        cest.refine(
+            self.path("spectrum.nii"), self.path("spectrum.json"), self.ppms,
+            self.path("refined.nii"))
+    
+    def peakmem_refine(self, shape):
+        cest.refine(
+            self.path("spectrum.nii"), self.path("spectrum.json"), self.ppms,
+            self.path("refined.nii"))
+    
+    def time_mtr(self, shape):
+        cest.mtr(
+            self.path("spectrum.nii"), numpy.linspace(-5, 5, 41),
+            self.path("mtr.nii"))
+    
+    def peakmem_mtr(self, shape):
+        cest.mtr(
+            self.path("spectrum.nii"), numpy.linspace(-5, 5, 41),
+            self.path("mtr.nii"))
@@ -0,0 +1,145 @@
+import numpy
+
+import cest
+
+# Water and amide at 3 T, as in the documentation
+species_a = cest.Species(1.3, 50e-3, 0, 1)
+species_b = cest.Species(1, 10e-3, 3.5, 0.01)
+species_c = cest.Species(1, 10e-3, -3, 0.02)
+Cb, Cc = 40., 100.
+w0 = 3*2.675e8 # rad/s
+w1 = 2*numpy.pi*100 # rad/s
+M0_2 = [0, 0, species_a.M0, 0, 0, species_b.M0]
+M0_3 = [*M0_2, 0, 0, species_c.M0]
+
+class TwoPools:
+    params = [[11, 101, 1001]]
+    param_names = ["offsets"]
+    
+    def setup(self, offsets):
+        self.offsets = numpy.linspace(-5, 5, offsets)
+    
+    def time_single(self, offsets):
+        cest.bm(species_a, species_b, Cb, w0, 3.5, w1, 2., M0_2)
+    
+    def time_batch(self, offsets):
+        cest.bm_batch(species_a, species_b, Cb, w0, self.offsets, w1, 2., M0_2)
+    
+    def peakmem_batch(self, offsets):
+        cest.bm_batch(species_a, species_b, Cb, w0, self.offsets, w1, 2., M0_2)
+    
+    def time_sweep(self, offsets):
+        cest.bm_sweep(
+            [species_a], [species_b], [20., 40., 80.], w0, self.offsets,
+            [w1/2, w1, 2*w1], numpy.linspace(0.5, 5, 10),
+            solver=cest.Solver.eigendecomposition)
+    
+    def time_steady_state(self, offsets):
+        cest.bm_steady_state(species_a, species_b, Cb, w0, 3.5, w1)
+    
+    def time_pulsed_steady_state(self, offsets):
+        cest.bm_pulsed_steady_state(
+            species_a, species_b, Cb, w0, 3.5, w1, 50e-3, 10e-3)
+
+class ThreePools:
+    params = [[11, 101, 1001]]
+    param_names = ["offsets"]
+    
+    def setup(self, offsets):
+        self.offsets = numpy.linspace(-5, 5, offsets)
+    
+    def time_single(self, offsets):
+        cest.bm(species_a, species_b, species_c, Cb, Cc, w0, 3.5, w1, 2., M0_3)
+    
+    def time_batch(self, offsets):
+        cest.bm_batch(
+            species_a, species_b, species_c, Cb, Cc, w0, self.offsets, w1, 2.,
+            M0_3)
+    
+    def peakmem_batch(self, offsets):
+        cest.bm_batch(
+            species_a, species_b, species_c, Cb, Cc, w0, self.offsets, w1, 2.,
+            M0_3)
+    
+    def time_n_batch(self, offsets):
+        exchange_rates = numpy.array([
+            [0, species_b.M0/species_a.M0*Cb, species_c.M0/species_a.M0*Cc],
+            [Cb, 0, 0],
+            [Cc, 0, 0]])
+        cest.bm_n_batch(
+            [species_a, species_b, species_c], exchange_rates, w0,
+            self.offsets, w1, 2., M0_3)
+
+class ShapedPulse:
+    params = [["block", "gaussian", "sinc", "sech"], [1, 10, 50]]
+    param_names = ["shape", "count"]
+    
+    steps = 100
+    step = 1e-3 # s
+    gap_steps = 20
+    
+    def setup(self, shape, count):
+        self.pulse = (
+            getattr(cest.pulses, shape)(self.steps) * w1 * self.steps)
+        self.train = numpy.concatenate(
+            (count-1)*[self.pulse, numpy.zeros(self.gap_steps)]+[self.pulse])
+    
+    # The propagator cache is shared by all simulations, and asv calls the
+    # timed functions several times per repeat: clear it in each call to time
+    # the computation of the propagators, and fill it in setup to time the
+    # cache hits.
+    
+    def time_shaped(self, shape, count):
+        cest.propagator_cache.clear()
+        cest.bm(
+            species_a, species_b, Cb, w0, 3.5, self.train, self.step, M0_2)
+    
+    def time_train(self, shape, count):
+        cest.propagator_cache.clear()
+        cest.bm_train(
+            species_a, species_b, Cb, w0, 3.5, self.pulse, count,
+            self.gap_steps, self.step, M0_2)
+
+class ShapedPulseCached(ShapedPulse):
+    def setup(self, shape, count):
+        ShapedPulse.setup(self, shape, count)
+        cest.propagator_cache.clear()
+        cest.bm(
+            species_a, species_b, Cb, w0, 3.5, self.train, self.step, M0_2)
+    
+    def time_shaped(self, shape, count):
+        cest.bm(
+            species_a, species_b, Cb, w0, 3.5, self.train, self.step, M0_2)
+    
+    def time_train(self, shape, count):
+        cest.bm_train(
+            species_a, species_b, Cb, w0, 3.5, self.pulse, count,
+            self.gap_steps, self.step, M0_2)
+
+class Fit:
+    params = [[2, 3], [10, 100]]
+    param_names = ["pools", "voxels"]
+    timeout = 600
+    
+    def setup(self, pools, voxels):
+        self.species = [species_a, species_b, species_c][:pools]
+        self.exchange_rates = [Cb, Cc][:pools-1]
+        self.offsets = numpy.linspace(-5, 5, 41)
+        
+        rng = numpy.random.default_rng(0)
+        exchange_rates = numpy.zeros((pools, pools))
+        exchange_rates[1:, 0] = self.exchange_rates
+        exchange_rates[0, 1:] = [
+            x.M0/species_a.M0*y
+            for x, y in zip(self.species[1:], self.exchange_rates)]
+        M0 = [x for s in self.species for x in [0, 0, s.M0]]
+        self.Z = numpy.array([
+            cest.bm_n_batch(
+                self.species, exchange_rates, w0, self.offsets-shift, w1, 2.,
+                M0)[:, 2]
+            for shift in rng.uniform(-0.3, 0.3, voxels)])
+    
+    def time_fit(self, pools, voxels):
+        cest.bm_fit(
+            self.species, self.exchange_rates, w0, self.offsets, w1, 2.,
+            self.Z)
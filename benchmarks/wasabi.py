@@ -0,0 +1,86 @@
+import numpy
+
+import cest
+
+def simulate(Delta_w, voxels, B0, B1_nominal, t_p, seed=0):
+    """ Synthetic normalized WASABI spectra, with 1% noise, as in
+        wasabi_sampler.stan.
+    """
+    
+    gamma = 2.6752218708e8 # rad/s/T
+    rng = numpy.random.default_rng(seed)
+    
+    c = rng.uniform(0.8, 1, (voxels, 1))
+    d = rng.uniform(1.5, 2, (voxels, 1))
+    B1 = B1_nominal*rng.uniform(0.7, 1.3, (voxels, 1))
+    delta_w = gamma*B0*1e-6*rng.uniform(-0.3, 0.3, (voxels, 1))
+    
+    w1 = gamma*B1
+    w = Delta_w-delta_w
+    Z = numpy.abs(
+        c - d * w1**2/(w1**2+w**2) * numpy.sin(numpy.sqrt(w1**2+w**2)*t_p/2)**2)
+    return Z + rng.normal(0, 0.01, Z.shape)
+
+class WASABI:
+    params = [[100, 1000, 10000]]
+    param_names = ["voxels"]
+    
+    B0 = 3 # T
+    B1_nominal = 3.7e-6 # T
+    t_p = 5e-3 # s
+    
+    def setup(self, voxels):
+        ppm = 2.6752218708e8*self.B0*1e-6
+        self.Delta_w = ppm*numpy.linspace(-2, 2, 31)
+        self.Z = simulate(
+            self.Delta_w, voxels, self.B0, self.B1_nominal, self.t_p)
+    
+    def time_optimize(self, voxels):
+        cest.wasabi(
+            self.Delta_w, self.Z, self.B0, self.B1_nominal, self.t_p,
+            "optimize")
+    
+    def peakmem_optimize(self, voxels):
+        cest.wasabi(
+            self.Delta_w, self.Z, self.B0, self.B1_nominal, self.t_p,
+            "optimize")
+
+class WASABISampling:
+    # Sampling is much slower than the least-squares fit
+    params = [[10, 100]]
+    param_names = ["voxels"]
+    timeout = 600
+    
+    def setup(self, voxels):
+        try:
+            import slimp
+        except ImportError:
+            raise NotImplementedError("slimp is not available")
+        
+        self.parameters = slimp.action_parameters.Sample(
+            seed=42, num_chains=4, num_samples=500, num_warmup=500)
+        
+        ppm = 2.6752218708e8*WASABI.B0*1e-6
+        self.Delta_w = ppm*numpy.linspace(-2, 2, 31)
+        self.Z = simulate(
+            self.Delta_w, voxels, WASABI.B0, WASABI.B1_nominal, WASABI.t_p)
+    
+    def time_sample(self, voxels):
+        cest.wasabi(
+            self.Delta_w, self.Z, WASABI.B0, WASABI.B1_nominal, WASABI.t_p,
+            self.parameters)
+    
+    def peakmem_sample(self, voxels):
+        cest.wasabi(
+            self.Delta_w, self.Z, WASABI.B0, WASABI.B1_nominal, WASABI.t_p,
+            self.parameters)
+    
+    def time_summaries(self, voxels):
+        cest.wasabi(
+            self.Delta_w, self.Z, WASABI.B0, WASABI.B1_nominal, WASABI.t_p,
+            self.parameters, quantiles=[0.05, 0.5, 0.95])
+    
+    def peakmem_summaries(self, voxels):
+        cest.wasabi(
+            self.Delta_w, self.Z, WASABI.B0, WASABI.B1_nominal, WASABI.t_p,
+            self.parameters, quantiles=[0.05, 0.5, 0.95])
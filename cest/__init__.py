@@ -1,5 +1,8 @@
 from . import pulses
-from ._cest import Species, bm, wasabi
+from ._cest import (
+    Solver, Species, bm, bm_batch, bm_fit, bm_n, bm_n_batch, bm_pulsed,
+    bm_pulsed_steady_state, bm_steady_state, bm_sweep, bm_train,
+    propagator_cache, wasabi)
 
 from .functions import *
 from . import tasks
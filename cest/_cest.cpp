@@ -6,15 +6,25 @@
 #define FORCE_IMPORT_ARRAY
 #include <xtensor-python/pyarray.hpp>
 
+#include "bm_fit.h"
 #include "bm2.h"
 #include "bm3_partial.h"
+#include "bmn.h"
+#include "interpolation.h"
 #include "misc.h"
+#include "propagator_cache.h"
 #include "wasabi.h"
+#include "wasabi_optimize.h"
 
 PYBIND11_MODULE(_cest, m)
 {
     misc(m);
+    propagator_cache(m);
     bm2(m);
     bm3_partial(m);
+    bmn(m);
+    bm_fit(m);
+    interpolation(m);
     wasabi(m);
+    wasabi_optimize(m);
 }
@@ -1,55 +1,51 @@
 #include "bm2.h"
 
+#include <cstddef>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
 #include <Eigen/Core>
 #include <unsupported/Eigen/MatrixFunctions>
 
 #include <pybind11/eigen.h>
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+
+#include <tbb/blocked_range.h>
+#include <tbb/parallel_for.h>
 
 #include "misc.h"
+#include "propagator.h"
+#include "propagator_cache.h"
 
-Eigen::Matrix7d bm(
+namespace
+{
+
+/// @brief Cached propagator of a single step of a shaped pulse
+Eigen::Matrix7d cached_propagator(
     Species const & species_a, Species const & species_b, double Cb,
-    double w0, double delta_w_rf, double w1, double duration)
+    double w0, double delta_w_rf, double w1, double step, Solver solver)
 {
-    auto const M0a = species_a.M0;
-    auto const R1a = 1/species_a.T1;
-    auto const R2a = 1/species_a.T2;
-    
-    auto const M0b = species_b.M0;
-    auto const R1b = 1/species_b.T1;
-    auto const R2b = 1/species_b.T2;
-    
-    auto const Ca = M0b/M0a * Cb;
-    
-    auto const k1a = R1a+Ca;
-    auto const k2a = R2a+Ca;
-    
-    auto const k1b = R1b+Cb;
-    auto const k2b = R2b+Cb;
-    
-    auto const wa = w0*(1 + species_a.delta_w*1e-6);
-    auto const wb = w0*(1 + species_b.delta_w*1e-6);
-    
-    auto const w = w0*(1 + delta_w_rf*1e-6);
-    
-    Eigen::Matrix7d dM;
-    dM << 
-    //   Mxa      Mya   Mza   Mxa      Myb   Mzb            M0
-        -k2a, -(wa-w),    0,   Cb,       0,    0,            0,
-        wa-w,    -k2a,  -w1,    0,      Cb,    0,            0,
-           0,      w1, -k1a,    0,       0,   Cb,      M0a*R1a,
-          Ca,       0,    0, -k2b, -(wb-w),    0,            0,
-           0,      Ca,    0, wb-w,    -k2b,  -w1,            0,
-           0,       0,   Ca,    0,      w1, -k1b,      M0b*R1b,
-           0,       0,    0,    0,       0,    0,            0;
-    return (dM*duration).exp();
+    auto & cache = PropagatorCache::instance();
+    auto const w1_q = cache.quantize(w1);
+    return cache.get(
+        PropagatorCache::key(
+            {species_a, species_b},
+            {Cb, w0, delta_w_rf, w1_q, step, double(solver)}),
+        [&]() -> Eigen::MatrixXd {
+            return bm(
+                species_a, species_b, Cb, w0, delta_w_rf, w1_q, step, solver);
+        });
 }
 
-Eigen::Vector6d bm(
+}
+
+void bm_system(
     Species const & species_a, Species const & species_b, double Cb,
-    double w0, double delta_w_rf, double w1, double duration,
-    Eigen::Vector6d const & M)
+    double w0, double delta_w_rf, double w1,
+    Eigen::Matrix6d & A, Eigen::Vector6d & b)
 {
     auto const M0a = species_a.M0;
     auto const R1a = 1/species_a.T1;
@@ -72,7 +68,6 @@ Eigen::Vector6d bm(
     
     auto const w = w0*(1 + delta_w_rf*1e-6);
     
-    Eigen::Matrix6d A;
     A << 
     //   Mxa      Mya   Mza   Mxa      Myb   Mzb
         -k2a, -(wa-w),    0,   Cb,       0,    0,
@@ -82,23 +77,45 @@ Eigen::Vector6d bm(
            0,      Ca,    0, wb-w,    -k2b,  -w1,
            0,       0,   Ca,    0,      w1, -k1b;
     
-    Eigen::Vector6d const b{0, 0, M0a*R1a, 0, 0, M0b*R1b};
+    b << 0, 0, M0a*R1a, 0, 0, M0b*R1b;
+}
+
+Eigen::Matrix7d bm(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1, double duration, Solver solver)
+{
+    Eigen::Matrix6d A;
+    Eigen::Vector6d b;
+    bm_system(species_a, species_b, Cb, w0, delta_w_rf, w1, A, b);
     
-    Eigen::Vector6d const AinvB = A.partialPivLu().solve(b);
+    return propagator(A, b, duration, solver);
+}
+
+Eigen::Vector6d bm(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1, double duration,
+    Eigen::Vector6d const & M, Solver solver)
+{
+    Eigen::Matrix6d A;
+    Eigen::Vector6d b;
+    bm_system(species_a, species_b, Cb, w0, delta_w_rf, w1, A, b);
     
-    return (A*duration).exp() * (M+AinvB) - AinvB;
+    return evolve(A, b, M, duration, solver);
 }
 
 Eigen::Vector7d
 bm(
     Species const & species_a, Species const & species_b, double Cb,
-    double w0, double delta_w_rf, Eigen::VectorXd const & w1,
-    double step, Eigen::Vector7d const & M0)
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> w1,
+    double step, Eigen::Vector7d const & M0, Solver solver)
 {
+    // Shaped pulses often repeat the same w1 values: re-use the propagators
     Eigen::Vector7d M = M0;
     for(auto && w1_: w1)
     {
-        M = bm(species_a, species_b, Cb, w0, delta_w_rf, w1_, step) * M;
+        M = cached_propagator(
+                species_a, species_b, Cb, w0, delta_w_rf, w1_, step, solver)
+            * M;
     }
     return M;
 }
@@ -106,15 +123,189 @@ bm(
 Eigen::Vector6d
 bm(
     Species const & species_a, Species const & species_b, double Cb,
-    double w0, double delta_w_rf, Eigen::VectorXd const & w1,
-    double step, Eigen::Vector6d const & M0)
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> w1,
+    double step, Eigen::Vector6d const & M0, Solver solver)
 {
-    Eigen::Vector6d M = M0;
-    for(auto && w1_: w1)
+    // Use projective coordinates to benefit from the cached propagators
+    Eigen::Vector7d M;
+    M << M0, 1;
+    M = bm(species_a, species_b, Cb, w0, delta_w_rf, w1, step, M, solver);
+    return M.head<6>();
+}
+
+void bm(
+    Species const & species_a, Species const & species_b, double Cb, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration, Eigen::Vector6d const & M,
+    Eigen::Ref<Eigen::MatrixX6d> result, Solver solver)
+{
+    auto const size = batch_size({delta_w_rf.size(), w1.size(), duration.size()});
+    if(result.rows() != size)
     {
-        M = bm(species_a, species_b, Cb, w0, delta_w_rf, w1_, step, M);
+        throw std::invalid_argument(
+            "Result must have "+std::to_string(size)+" rows");
     }
-    return M;
+    
+    Eigen::Matrix6d A;
+    Eigen::Vector6d b;
+    EigenPropagator<6> eigen_propagator;
+    for(Eigen::Index i=0; i!=size; ++i)
+    {
+        // Only assemble (and decompose) the system when it changes, i.e. not
+        // when only the duration changes.
+        auto const delta_w_rf_ = batch_item(delta_w_rf, i);
+        auto const w1_ = batch_item(w1, i);
+        if(
+            i == 0 || delta_w_rf_ != batch_item(delta_w_rf, i-1)
+            || w1_ != batch_item(w1, i-1))
+        {
+            bm_system(species_a, species_b, Cb, w0, delta_w_rf_, w1_, A, b);
+            if(solver == Solver::Eigendecomposition)
+            {
+                eigen_propagator = EigenPropagator<6>(A, b);
+            }
+        }
+        
+        auto const duration_ = batch_item(duration, i);
+        result.row(i) = 
+            eigen_propagator.valid()
+            ? eigen_propagator.evolve(M, duration_)
+            : evolve(A, b, M, duration_, Solver::Pade);
+    }
+}
+
+void bm_sweep(
+    std::vector<Species> const & species_a,
+    std::vector<Species> const & species_b,
+    Eigen::Ref<Eigen::VectorXd const> Cb, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration,
+    Eigen::Ref<Eigen::MatrixX6d> result, Solver solver)
+{
+    // Shape of the Cartesian product, the last dimension varies fastest. The
+    // durations are handled separately, so that each system is only assembled
+    // (and decomposed) once.
+    std::vector<Eigen::Index> const shape{
+        Eigen::Index(species_a.size()), Eigen::Index(species_b.size()),
+        Cb.size(), w1.size(), delta_w_rf.size()};
+    Eigen::Index systems = 1;
+    for(auto && item: shape)
+    {
+        systems *= item;
+    }
+    if(result.rows() != systems * duration.size())
+    {
+        throw std::invalid_argument(
+            "Result must have "+std::to_string(systems * duration.size())
+            +" rows");
+    }
+    
+    tbb::parallel_for(
+        tbb::blocked_range<Eigen::Index>(0, systems),
+        [&](tbb::blocked_range<Eigen::Index> const & range) {
+            std::vector<Eigen::Index> index(shape.size());
+            Eigen::Matrix6d A;
+            Eigen::Vector6d b;
+            for(auto system=range.begin(); system!=range.end(); ++system)
+            {
+                auto remainder = system;
+                for(std::size_t d=shape.size(); d!=0; --d)
+                {
+                    index[d-1] = remainder % shape[d-1];
+                    remainder /= shape[d-1];
+                }
+                
+                auto const & species_a_ = species_a[index[0]];
+                auto const & species_b_ = species_b[index[1]];
+                Eigen::Vector6d const M{
+                    0, 0, species_a_.M0, 0, 0, species_b_.M0};
+                bm_system(
+                    species_a_, species_b_, Cb[index[2]], w0,
+                    delta_w_rf[index[4]], w1[index[3]], A, b);
+                
+                EigenPropagator<6> eigen_propagator;
+                if(solver == Solver::Eigendecomposition)
+                {
+                    eigen_propagator = EigenPropagator<6>(A, b);
+                }
+                
+                // The duration dimension is between the w1 dimension and the
+                // offset dimension
+                auto const outer = system / delta_w_rf.size();
+                auto const offset = system % delta_w_rf.size();
+                for(Eigen::Index d=0; d!=duration.size(); ++d)
+                {
+                    auto const row =
+                        (outer*duration.size() + d)*delta_w_rf.size() + offset;
+                    result.row(row) =
+                        eigen_propagator.valid()
+                        ? eigen_propagator.evolve(M, duration[d])
+                        : evolve(A, b, M, duration[d], Solver::Pade);
+                }
+            }
+        });
+}
+
+Eigen::Vector6d bm_train(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> pulse,
+    std::size_t count, std::size_t gap_steps, double step,
+    Eigen::Vector6d const & M, Solver solver)
+{
+    // Propagator of a single pulse, from the cached propagators of its steps
+    Eigen::Matrix7d pulse_propagator = Eigen::Matrix7d::Identity();
+    for(auto && w1: pulse)
+    {
+        pulse_propagator =
+            cached_propagator(
+                species_a, species_b, Cb, w0, delta_w_rf, w1, step, solver)
+            * pulse_propagator;
+    }
+    
+    // Free precession during the whole gap
+    auto const gap_propagator = bm(
+        species_a, species_b, Cb, w0, delta_w_rf, 0, gap_steps*step, solver);
+    
+    return pulse_train<6>(pulse_propagator, gap_propagator, count, M);
+}
+
+Eigen::Vector6d bm_steady_state(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1)
+{
+    Eigen::Matrix6d A;
+    Eigen::Vector6d b;
+    bm_system(species_a, species_b, Cb, w0, delta_w_rf, w1, A, b);
+    
+    return steady_state(A, b);
+}
+
+Eigen::Vector6d bm_pulsed(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1, double pulse_duration,
+    double gap_duration, std::size_t count, Eigen::Vector6d const & M,
+    Solver solver)
+{
+    return pulse_train<6>(
+        bm(
+            species_a, species_b, Cb, w0, delta_w_rf, w1, pulse_duration,
+            solver),
+        bm(species_a, species_b, Cb, w0, delta_w_rf, 0, gap_duration, solver),
+        count, M);
+}
+
+Eigen::Vector6d bm_pulsed_steady_state(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1, double pulse_duration,
+    double gap_duration, Solver solver)
+{
+    return pulsed_steady_state<6>(
+        bm(
+            species_a, species_b, Cb, w0, delta_w_rf, w1, pulse_duration,
+            solver),
+        bm(species_a, species_b, Cb, w0, delta_w_rf, 0, gap_duration, solver));
 }
 
 void bm2(pybind11::module & m)
@@ -125,38 +316,154 @@ void bm2(pybind11::module & m)
         "bm",
         pybind11::overload_cast<
             Species const &, Species const &,
-            double, double, double, double, double>(&bm),
+            double, double, double, double, double, Solver>(&bm),
         "Two-pools Bloch-McConnell transition matrix between two pools A and B, "
         "using projective coordinates",
         "species_a"_a, "species_b"_a,
-        "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a, "step"_a);
+        "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a, "step"_a,
+        "solver"_a=Solver::Pade);
     
     m.def(
         "bm",
         pybind11::overload_cast<
             Species const &, Species const &,
-            double, double, double, double, double, Eigen::Vector6d const &>(&bm),
+            double, double, double, double, double, Eigen::Vector6d const &,
+            Solver>(&bm),
         "Two-pools Bloch-McConnell simulation",
         "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
-        "step"_a, "M0"_a);
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade);
     
     m.def(
         "bm",
         pybind11::overload_cast<
             Species const &, Species const &,
-            double, double, double, Eigen::VectorXd const &, double,
-            Eigen::Vector7d const &>(&bm),
+            double, double, double, Eigen::Ref<Eigen::VectorXd const>, double,
+            Eigen::Vector7d const &, Solver>(&bm),
         "Two-pools Bloch-McConnel simulation of a shaped pulse",
         "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
-        "step"_a, "M0"_a);
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade);
     
     m.def(
         "bm",
         pybind11::overload_cast<
             Species const &, Species const &,
-            double, double, double, Eigen::VectorXd const &, double,
-            Eigen::Vector6d const &>(&bm),
+            double, double, double, Eigen::Ref<Eigen::VectorXd const>, double,
+            Eigen::Vector6d const &, Solver>(&bm),
         "Two-pools Bloch-McConnel simulation of a shaped pulse",
         "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
-        "step"_a, "M0"_a);
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade);
+    
+    m.def(
+        "bm_batch",
+        [](
+            Species const & species_a, Species const & species_b, double Cb,
+            double w0, ArrayOrScalar const & delta_w_rf,
+            ArrayOrScalar const & w1, ArrayOrScalar const & duration,
+            Eigen::Vector6d const & M0, Solver solver,
+            pybind11::object const & out) {
+            auto const size = batch_size(
+                {delta_w_rf.size(), w1.size(), duration.size()});
+            auto result = output_array<double>(out, {size, 6});
+            Eigen::Map<Eigen::MatrixX6d> result_map(
+                result.mutable_data(), size, 6);
+            bm(
+                species_a, species_b, Cb, w0, as_vector(delta_w_rf),
+                as_vector(w1), as_vector(duration), M0, result_map, solver);
+            return result;
+        },
+        "Two-pools Bloch-McConnell simulation of a batch of block pulses. "
+        "delta_w_rf, w1 and step may be scalars or arrays of the same size, "
+        "the result has one row per item of the batch, and is written to out "
+        "if specified",
+        "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade, "out"_a=pybind11::none());
+    
+    m.def(
+        "bm_sweep",
+        [](
+            std::vector<Species> const & species_a,
+            std::vector<Species> const & species_b, ArrayOrScalar const & Cb,
+            double w0, ArrayOrScalar const & delta_w_rf,
+            ArrayOrScalar const & w1, ArrayOrScalar const & duration,
+            pybind11::object const & out, Solver solver) {
+            auto result = output_array<double>(
+                out, {
+                    pybind11::ssize_t(species_a.size()),
+                    pybind11::ssize_t(species_b.size()),
+                    Cb.size(), w1.size(), duration.size(), delta_w_rf.size(),
+                    6});
+            Eigen::Map<Eigen::MatrixX6d> result_map(
+                result.mutable_data(), result.size()/6, 6);
+            auto const Cb_ = as_vector(Cb), delta_w_rf_ = as_vector(delta_w_rf),
+                w1_ = as_vector(w1), duration_ = as_vector(duration);
+            {
+                pybind11::gil_scoped_release release_gil;
+                bm_sweep(
+                    species_a, species_b, Cb_, w0, delta_w_rf_, w1_,
+                    duration_, result_map, solver);
+            }
+            
+            return result;
+        },
+        "Two-pools Bloch-McConnell simulation over the Cartesian product of "
+        "species_a, species_b, Cb, w1, step and delta_w_rf, starting from the "
+        "equilibrium magnetization. The result has a shape of "
+        "(len(species_a), len(species_b), len(Cb), len(w1), len(step), "
+        "len(delta_w_rf), 6), and is written to out if specified. The "
+        "simulations are run in parallel.",
+        "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
+        "step"_a, "out"_a=pybind11::none(), "solver"_a=Solver::Pade);
+    
+    m.def(
+        "bm_train",
+        pybind11::overload_cast<
+            Species const &, Species const &, double, double, double,
+            Eigen::Ref<Eigen::VectorXd const>, std::size_t, std::size_t,
+            double, Eigen::Vector6d const &, Solver>(&bm_train),
+        "Two-pools Bloch-McConnell simulation of a train of count shaped "
+        "pulses separated by gap_steps steps without saturation, equivalent "
+        "to the simulation of the whole train as a shaped pulse. The "
+        "magnetization is returned at the end of the last pulse. The "
+        "propagator of a single period is raised to the number of pulses by "
+        "repeated squaring.",
+        "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a,
+        "pulse"_a, "count"_a, "gap_steps"_a, "step"_a, "M0"_a,
+        "solver"_a=Solver::Pade);
+    
+    m.def(
+        "bm_steady_state",
+        pybind11::overload_cast<
+            Species const &, Species const &,
+            double, double, double, double>(&bm_steady_state),
+        "Steady state of the two-pools Bloch-McConnell system under continuous "
+        "saturation, i.e. the limit of the magnetization for an infinite "
+        "duration, computed without matrix exponential",
+        "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a);
+    
+    m.def(
+        "bm_pulsed",
+        pybind11::overload_cast<
+            Species const &, Species const &, double, double, double, double,
+            double, double, std::size_t, Eigen::Vector6d const &, Solver>(
+                &bm_pulsed),
+        "Two-pools Bloch-McConnell simulation of a train of count block "
+        "pulses separated by gaps without saturation. The magnetization is "
+        "returned at the end of the last pulse. The propagator of the train "
+        "is computed by repeated squaring of the propagator of a single "
+        "period.",
+        "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
+        "pulse_duration"_a, "gap_duration"_a, "count"_a, "M0"_a,
+        "solver"_a=Solver::Pade);
+    
+    m.def(
+        "bm_pulsed_steady_state",
+        pybind11::overload_cast<
+            Species const &, Species const &, double, double, double, double,
+            double, double, Solver>(&bm_pulsed_steady_state),
+        "Pulsed steady state of the two-pools Bloch-McConnell system, i.e. the "
+        "magnetization at the end of a pulse of an infinite train of block "
+        "pulses separated by gaps without saturation. It is computed as the "
+        "fixed point of the propagator of a single period.",
+        "species_a"_a, "species_b"_a, "Cb"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
+        "pulse_duration"_a, "gap_duration"_a, "solver"_a=Solver::Pade);
 }
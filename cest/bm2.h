@@ -1,12 +1,31 @@
 #ifndef _0b16c428_bf5f_41fe_bd25_64831665ce8a
 #define _0b16c428_bf5f_41fe_bd25_64831665ce8a
 
+#include <cstddef>
+#include <vector>
+
 #include <Eigen/Core>
 
 #include <pybind11/pybind11.h>
 
 #include "misc.h"
 
+/**
+ * @brief Two-pools Bloch-McConnell system, as dM/dt = A M + b
+ * @param species_a
+ * @param species_b
+ * @param Cb Transition rate from B to A (Hz)
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offset of the saturation RF pulse (ppm)
+ * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
+ * @param A System matrix, applied to [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ * @param b Constant term of the system
+ */
+void bm_system(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1,
+    Eigen::Matrix6d & A, Eigen::Vector6d & b);
+
 /**
  * @brief Two-pools Bloch-McConnell transition matrix
  * @param species_a
@@ -16,12 +35,14 @@
  * @param delta_w_rf Frequency offset of the saturation RF pulse (ppm)
  * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
  * @param duration Duration of the simulation in s
+ * @param solver Method used to compute the matrix exponential
  * @return 7x7 matrix in projective coordinates, should be applied to a vector
  * [Mxa, Mya, Mza, Mxb, Myb, Mzb, 1]
  */
 Eigen::Matrix7d bm(
     Species const & species_a, Species const & species_b, double Cb,
-    double w0, double delta_w_rf, double w1, double duration);
+    double w0, double delta_w_rf, double w1, double duration,
+    Solver solver=Solver::Pade);
 
 /**
  * @brief Two-pools Bloch-McConnell simulation
@@ -33,13 +54,14 @@ Eigen::Matrix7d bm(
  * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
  * @param duration Duration of the simulation in s
  * @param M magnetization as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ * @param solver Method used to compute the matrix exponential
  * @return Magnetization after evolution, as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
  * 
  */
 Eigen::Vector6d bm(
     Species const & species_a, Species const & species_b, double Cb,
     double w0, double delta_w_rf, double w1, double duration,
-    Eigen::Vector6d const & M);
+    Eigen::Vector6d const & M, Solver solver=Solver::Pade);
 
 /**
  * @brief Two-pools Bloch-McConnel simulation of a shaped pulse
@@ -51,12 +73,13 @@ Eigen::Vector6d bm(
  * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
  * @param step Interval between to w1 values of the simulation in s
  * @param M0 Initial magnetization as [Mxa, Mya, Mza, Mxb, Myb, Mzb, 1]
+ * @param solver Method used to compute the matrix exponential
  * @return Magnetization after evolution, as [Mxa, Mya, Mza, Mxb, Myb, Mzb, 1]
  */
 Eigen::Vector7d bm(
     Species const & species_a, Species const & species_b, double Cb,
-    double w0, double delta_w_rf, Eigen::VectorXd const & w1,
-    double step, Eigen::Vector7d const & M0);
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> w1,
+    double step, Eigen::Vector7d const & M0, Solver solver=Solver::Pade);
 
 /**
  * @brief Two-pools Bloch-McConnel simulation of a shaped pulse
@@ -68,13 +91,149 @@ Eigen::Vector7d bm(
  * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
  * @param step Interval between to w1 values of the simulation in s
  * @param M0 Initial magnetization as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ * @param solver Method used to compute the matrix exponential
  * @return Magnetization after evolution, as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
  */
 Eigen::Vector6d
 bm(
     Species const & species_a, Species const & species_b, double Cb,
-    double w0, double delta_w_rf, Eigen::VectorXd const & w1,
-    double step, Eigen::Vector6d const & M0);
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> w1,
+    double step, Eigen::Vector6d const & M0, Solver solver=Solver::Pade);
+
+/**
+ * @brief Two-pools Bloch-McConnell simulation of a batch of block pulses
+ * @param species_a
+ * @param species_b
+ * @param Cb Transition rate from B to A (Hz)
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offsets of the saturation RF pulse (ppm)
+ * @param w1 Frequencies of the B1 field of the saturation RF pulse (rad/s)
+ * @param duration Durations of the simulation in s
+ * @param M magnetization as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ * @param result Magnetization after evolution, one row per item of the batch,
+ * as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ * @param solver Method used to compute the matrix exponential: with
+ * Solver::Eigendecomposition, consecutive items which only differ by their
+ * duration share the same decomposition
+ * 
+ * delta_w_rf, w1 and duration must have the same size, or have a size of 1 in
+ * which case their value is used for the whole batch.
+ */
+void bm(
+    Species const & species_a, Species const & species_b, double Cb, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration, Eigen::Vector6d const & M,
+    Eigen::Ref<Eigen::MatrixX6d> result, Solver solver=Solver::Pade);
+
+/**
+ * @brief Two-pools Bloch-McConnell simulation over the Cartesian product of
+ * simulation parameters, starting from the equilibrium magnetization. The
+ * items of the product are simulated in parallel.
+ * @param species_a
+ * @param species_b
+ * @param Cb Transition rates from B to A (Hz)
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offsets of the saturation RF pulse (ppm)
+ * @param w1 Frequencies of the B1 field of the saturation RF pulse (rad/s)
+ * @param duration Durations of the simulation in s
+ * @param result Magnetization after evolution, as [Mxa, Mya, Mza, Mxb, Myb,
+ * Mzb], one row per item of the product: the item order is the row-major
+ * order of (species_a, species_b, Cb, w1, duration, delta_w_rf)
+ * @param solver Method used to compute the matrix exponential: with
+ * Solver::Eigendecomposition, all durations share the same decomposition
+ */
+void bm_sweep(
+    std::vector<Species> const & species_a,
+    std::vector<Species> const & species_b,
+    Eigen::Ref<Eigen::VectorXd const> Cb, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration,
+    Eigen::Ref<Eigen::MatrixX6d> result, Solver solver=Solver::Pade);
+
+/**
+ * @brief Two-pools Bloch-McConnell simulation of a train of shaped pulses,
+ * separated by gaps without saturation. This is equivalent to the simulation
+ * of the whole train as a shaped pulse, but its cost is logarithmic in the
+ * number of pulses.
+ * @param species_a
+ * @param species_b
+ * @param Cb Transition rate from B to A (Hz)
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offset of the saturation RF pulse (ppm)
+ * @param pulse Frequencies of the B1 field of a single pulse (rad/s)
+ * @param count Number of pulses, must be positive
+ * @param gap_steps Number of steps of the gap between two pulses
+ * @param step Interval between to w1 values of the simulation in s
+ * @param M magnetization as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ * @param solver Method used to compute the matrix exponential
+ * @return Magnetization at the end of the last pulse, as [Mxa, Mya, Mza, Mxb,
+ * Myb, Mzb]
+ */
+Eigen::Vector6d bm_train(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> pulse,
+    std::size_t count, std::size_t gap_steps, double step,
+    Eigen::Vector6d const & M, Solver solver=Solver::Pade);
+
+/**
+ * @brief Steady state of the two-pools Bloch-McConnell system under continuous
+ * saturation, i.e. the limit of the magnetization for an infinite duration.
+ * @param species_a
+ * @param species_b
+ * @param Cb Transition rate from B to A (Hz)
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offset of the saturation RF pulse (ppm)
+ * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
+ * @return Steady-state magnetization, as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ */
+Eigen::Vector6d bm_steady_state(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1);
+
+/**
+ * @brief Two-pools Bloch-McConnell simulation of a train of block pulses,
+ * separated by gaps without saturation.
+ * @param species_a
+ * @param species_b
+ * @param Cb Transition rate from B to A (Hz)
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offset of the saturation RF pulse (ppm)
+ * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
+ * @param pulse_duration Duration of each pulse in s
+ * @param gap_duration Duration of the gap between two pulses in s
+ * @param count Number of pulses, must be positive
+ * @param M magnetization as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ * @param solver Method used to compute the matrix exponential
+ * @return Magnetization at the end of the last pulse, as [Mxa, Mya, Mza, Mxb,
+ * Myb, Mzb]
+ */
+Eigen::Vector6d bm_pulsed(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1, double pulse_duration,
+    double gap_duration, std::size_t count, Eigen::Vector6d const & M,
+    Solver solver=Solver::Pade);
+
+/**
+ * @brief Pulsed steady state of the two-pools Bloch-McConnell system, i.e.
+ * the magnetization at the end of a pulse of an infinite train of block pulses
+ * separated by gaps without saturation.
+ * @param species_a
+ * @param species_b
+ * @param Cb Transition rate from B to A (Hz)
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offset of the saturation RF pulse (ppm)
+ * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
+ * @param pulse_duration Duration of each pulse in s
+ * @param gap_duration Duration of the gap between two pulses in s
+ * @param solver Method used to compute the matrix exponential
+ * @return Steady-state magnetization, as [Mxa, Mya, Mza, Mxb, Myb, Mzb]
+ */
+Eigen::Vector6d bm_pulsed_steady_state(
+    Species const & species_a, Species const & species_b, double Cb,
+    double w0, double delta_w_rf, double w1, double pulse_duration,
+    double gap_duration, Solver solver=Solver::Pade);
 
 void bm2(pybind11::module & m);
 
@@ -1,73 +1,49 @@
 #include "bm3_partial.h"
 
+#include <cstddef>
+#include <stdexcept>
+#include <string>
+
 #include <Eigen/Core>
 #include <unsupported/Eigen/MatrixFunctions>
 
 #include <pybind11/eigen.h>
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 
 #include "misc.h"
+#include "propagator.h"
+#include "propagator_cache.h"
 
-Eigen::Matrix10d
-bm(
-    Species const & species_a, Species const & species_b, Species const & species_c,
-    double Cb, double Cc,
-    double w0, double delta_w_rf, double w1, double duration)
+namespace
 {
-    auto const M0a = species_a.M0;
-    auto const R1a = 1/species_a.T1;
-    auto const R2a = 1/species_a.T2;
-    
-    auto const M0b = species_b.M0;
-    auto const R1b = 1/species_b.T1;
-    auto const R2b = 1/species_b.T2;
-    
-    auto const M0c = species_c.M0;
-    auto const R1c = 1/species_c.T1;
-    auto const R2c = 1/species_c.T2;
-    
-    auto const Cab = M0b/M0a * Cb;
-    auto const Cac = M0c/M0a * Cc;
-    auto const Ca = Cab + Cac;
-    
-    auto const k1a = R1a+Ca;
-    auto const k2a = R2a+Ca;
-    
-    auto const k1b = R1b+Cb;
-    auto const k2b = R2b+Cb;
-    
-    auto const k1c = R1c+Cc;
-    auto const k2c = R2c+Cc;
-    
-    auto const wa = w0*(1 + species_a.delta_w*1e-6);
-    auto const wb = w0*(1 + species_b.delta_w*1e-6);
-    auto const wc = w0*(1 + species_b.delta_w*1e-6);
-    
-    auto const w = w0*(1 + delta_w_rf*1e-6);
-    
-    Eigen::Matrix10d dM;
-    dM << 
-    //   Mxa      Mya   Mza   Mxb      Myb   Mzb   Mxc      Myc   Mzc            M0
-        -k2a, -(wa-w),    0,   Cb,       0,    0,   Cc,       0,    0,            0,
-        wa-w,    -k2a,  -w1,    0,      Cb,    0,    0,      Cc,    0,            0,
-           0,      w1, -k1a,    0,       0,   Cb,    0,       0,   Cc,      M0a*R1a,
-         Cab,       0,    0, -k2b, -(wb-w),    0,    0,       0,    0,            0,
-           0,     Cab,    0, wb-w,    -k2b,  -w1,    0,       0,    0,            0,
-           0,       0,  Cab,    0,      w1, -k1b,    0,       0,    0,      M0b*R1b,
-         Cac,       0,    0,    0,       0,    0, -k2c, -(wc-w),    0,            0,
-           0,     Cac,    0,    0,       0,    0, wc-w,    -k2c,  -w1,            0,
-           0,       0,  Cac,    0,       0,    0,    0,      w1, -k1c,      M0c*R1c;
-    
-    return (dM*duration).exp();
-}
 
+/// @brief Cached propagator of a single step of a shaped pulse
+Eigen::Matrix10d cached_propagator(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, double w1, double step, Solver solver)
+{
+    auto & cache = PropagatorCache::instance();
+    auto const w1_q = cache.quantize(w1);
+    return cache.get(
+        PropagatorCache::key(
+            {species_a, species_b, species_c},
+            {Cb, Cc, w0, delta_w_rf, w1_q, step, double(solver)}),
+        [&]() -> Eigen::MatrixXd {
+            return bm(
+                species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1_q,
+                step, solver);
+        });
+}
 
+}
 
-Eigen::Vector9d bm(
+void bm_system(
     Species const & species_a, Species const & species_b, Species const & species_c,
     double Cb, double Cc,
-    double w0, double delta_w_rf, double w1, double duration,
-    Eigen::Vector9d const & M)
+    double w0, double delta_w_rf, double w1,
+    Eigen::Matrix9d & A, Eigen::Vector9d & b)
 {
     auto const M0a = species_a.M0;
     auto const R1a = 1/species_a.T1;
@@ -100,7 +76,6 @@ Eigen::Vector9d bm(
     
     auto const w = w0*(1 + delta_w_rf*1e-6);
     
-    Eigen::Matrix9d A;
     A << 
     //   Mxa      Mya   Mza   Mxb      Myb   Mzb   Mxc      Myc   Mzc
         -k2a, -(wa-w),    0,   Cb,       0,    0,   Cc,       0,    0,
@@ -113,11 +88,37 @@ Eigen::Vector9d bm(
            0,     Cac,    0,    0,       0,    0, wc-w,    -k2c,  -w1,
            0,       0,  Cac,    0,       0,    0,    0,      w1, -k1c;
     
-    Eigen::Vector9d const b{0, 0, M0a*R1a, 0, 0, M0b*R1b, 0, 0, M0c*R1c};
+    b << 0, 0, M0a*R1a, 0, 0, M0b*R1b, 0, 0, M0c*R1c;
+}
+
+
+
+Eigen::Matrix10d
+bm(
+    Species const & species_a, Species const & species_b, Species const & species_c,
+    double Cb, double Cc,
+    double w0, double delta_w_rf, double w1, double duration, Solver solver)
+{
+    Eigen::Matrix9d A;
+    Eigen::Vector9d b;
+    bm_system(species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1, A, b);
     
-    Eigen::Vector9d const AinvB = A.partialPivLu().solve(b);
+    return propagator(A, b, duration, solver);
+}
+
+
+
+Eigen::Vector9d bm(
+    Species const & species_a, Species const & species_b, Species const & species_c,
+    double Cb, double Cc,
+    double w0, double delta_w_rf, double w1, double duration,
+    Eigen::Vector9d const & M, Solver solver)
+{
+    Eigen::Matrix9d A;
+    Eigen::Vector9d b;
+    bm_system(species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1, A, b);
     
-    return (A*duration).exp() * (M+AinvB) - AinvB;
+    return evolve(A, b, M, duration, solver);
 }
 
 
@@ -126,13 +127,17 @@ Eigen::Vector10d
 bm(
     Species const & species_a, Species const & species_b, Species const & species_c,
     double Cb, double Cc,
-    double w0, double delta_w_rf, Eigen::VectorXd const & w1,
-    double step, Eigen::Vector10d const & M0)
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> w1,
+    double step, Eigen::Vector10d const & M0, Solver solver)
 {
+    // Shaped pulses often repeat the same w1 values: re-use the propagators
     Eigen::Vector10d M = M0;
     for(auto && w1_: w1)
     {
-        M = bm(species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1_, step) * M;
+        M = cached_propagator(
+                species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1_,
+                step, solver)
+            * M;
     }
     return M;
 }
@@ -143,18 +148,142 @@ Eigen::Vector9d
 bm(
     Species const & species_a, Species const & species_b, Species const & species_c,
     double Cb, double Cc,
-    double w0, double delta_w_rf, Eigen::VectorXd const & w1,
-    double step, Eigen::Vector9d const & M0)
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> w1,
+    double step, Eigen::Vector9d const & M0, Solver solver)
 {
-    Eigen::Vector9d M = M0;
-    for(auto && w1_: w1)
+    // Use projective coordinates to benefit from the cached propagators
+    Eigen::Vector10d M;
+    M << M0, 1;
+    M = bm(species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1, step, M, solver);
+    return M.head<9>();
+}
+
+
+
+void bm(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration, Eigen::Vector9d const & M,
+    Eigen::Ref<Eigen::MatrixX9d> result, Solver solver)
+{
+    auto const size = batch_size({delta_w_rf.size(), w1.size(), duration.size()});
+    if(result.rows() != size)
     {
-        M = bm(species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1_, step, M);
+        throw std::invalid_argument(
+            "Result must have "+std::to_string(size)+" rows");
+    }
+    
+    Eigen::Matrix9d A;
+    Eigen::Vector9d b;
+    EigenPropagator<9> eigen_propagator;
+    for(Eigen::Index i=0; i!=size; ++i)
+    {
+        // Only assemble (and decompose) the system when it changes, i.e. not
+        // when only the duration changes.
+        auto const delta_w_rf_ = batch_item(delta_w_rf, i);
+        auto const w1_ = batch_item(w1, i);
+        if(
+            i == 0 || delta_w_rf_ != batch_item(delta_w_rf, i-1)
+            || w1_ != batch_item(w1, i-1))
+        {
+            bm_system(
+                species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf_, w1_,
+                A, b);
+            if(solver == Solver::Eigendecomposition)
+            {
+                eigen_propagator = EigenPropagator<9>(A, b);
+            }
+        }
+        
+        auto const duration_ = batch_item(duration, i);
+        result.row(i) = 
+            eigen_propagator.valid()
+            ? eigen_propagator.evolve(M, duration_)
+            : evolve(A, b, M, duration_, Solver::Pade);
     }
-    return M;
 }
 
 
+
+Eigen::Vector9d bm_train(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> pulse,
+    std::size_t count, std::size_t gap_steps, double step,
+    Eigen::Vector9d const & M, Solver solver)
+{
+    // Propagator of a single pulse, from the cached propagators of its steps
+    Eigen::Matrix10d pulse_propagator = Eigen::Matrix10d::Identity();
+    for(auto && w1: pulse)
+    {
+        pulse_propagator =
+            cached_propagator(
+                species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1,
+                step, solver)
+            * pulse_propagator;
+    }
+    
+    // Free precession during the whole gap
+    auto const gap_propagator = bm(
+        species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, 0,
+        gap_steps*step, solver);
+    
+    return pulse_train<9>(pulse_propagator, gap_propagator, count, M);
+}
+
+
+
+Eigen::Vector9d bm_steady_state(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, double w1)
+{
+    Eigen::Matrix9d A;
+    Eigen::Vector9d b;
+    bm_system(species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1, A, b);
+    
+    return steady_state(A, b);
+}
+
+
+
+Eigen::Vector9d bm_pulsed(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, double w1, double pulse_duration, double gap_duration,
+    std::size_t count, Eigen::Vector9d const & M, Solver solver)
+{
+    return pulse_train<9>(
+        bm(
+            species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1,
+            pulse_duration, solver),
+        bm(
+            species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, 0,
+            gap_duration, solver),
+        count, M);
+}
+
+
+
+Eigen::Vector9d bm_pulsed_steady_state(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, double w1, double pulse_duration, double gap_duration,
+    Solver solver)
+{
+    return pulsed_steady_state<9>(
+        bm(
+            species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, w1,
+            pulse_duration, solver),
+        bm(
+            species_a, species_b, species_c, Cb, Cc, w0, delta_w_rf, 0,
+            gap_duration, solver));
+}
+
+
+
 void bm3_partial(pybind11::module & m)
 {
     using namespace pybind11::literals;
@@ -163,33 +292,95 @@ void bm3_partial(pybind11::module & m)
         "bm",
         pybind11::overload_cast<
             Species const &, Species const &, Species const &,
-            double, double, double, double, double, double>(&bm),
+            double, double, double, double, double, double, Solver>(&bm),
         "species_a"_a, "species_b"_a, "species_c"_a,
-        "Cb"_a, "Cc"_a, "w0"_a, "delta_w_rf"_a, "w1"_a, "step"_a);
+        "Cb"_a, "Cc"_a, "w0"_a, "delta_w_rf"_a, "w1"_a, "step"_a,
+        "solver"_a=Solver::Pade);
     
     m.def(
         "bm",
         pybind11::overload_cast<
             Species const &, Species const &, Species const &,
-            double, double, double, double, double, double, Eigen::Vector9d const &>(&bm),
+            double, double, double, double, double, double, Eigen::Vector9d const &,
+            Solver>(&bm),
         "species_a"_a, "species_b"_a, "species_c"_a, "Cb"_a, "Cc"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
-        "step"_a, "M0"_a);
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade);
     
     m.def(
         "bm",
         pybind11::overload_cast<
-            Species const &, Species const &, Species const &,
-            double, double, double, double, Eigen::VectorXd const &, double,
-            Eigen::Vector10d const &>(&bm),
+            Species const &, Species const &, Species const &, double, double,
+            double, double, Eigen::Ref<Eigen::VectorXd const>, double,
+            Eigen::Vector10d const &, Solver>(&bm),
         "species_a"_a, "species_b"_a, "species_c"_a, "Cb"_a, "Cc"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
-        "step"_a, "M0"_a);
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade);
     
     m.def(
         "bm",
         pybind11::overload_cast<
-            Species const &, Species const &, Species const &,
-            double, double, double, double, Eigen::VectorXd const &, double,
-            Eigen::Vector9d const &>(&bm),
+            Species const &, Species const &, Species const &, double, double,
+            double, double, Eigen::Ref<Eigen::VectorXd const>, double,
+            Eigen::Vector9d const &, Solver>(&bm),
         "species_a"_a, "species_b"_a, "species_c"_a, "Cb"_a, "Cc"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
-        "step"_a, "M0"_a);
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade);
+    
+    m.def(
+        "bm_batch",
+        [](
+            Species const & species_a, Species const & species_b,
+            Species const & species_c, double Cb, double Cc, double w0,
+            ArrayOrScalar const & delta_w_rf, ArrayOrScalar const & w1,
+            ArrayOrScalar const & duration, Eigen::Vector9d const & M0,
+            Solver solver, pybind11::object const & out) {
+            auto const size = batch_size(
+                {delta_w_rf.size(), w1.size(), duration.size()});
+            auto result = output_array<double>(out, {size, 9});
+            Eigen::Map<Eigen::MatrixX9d> result_map(
+                result.mutable_data(), size, 9);
+            bm(
+                species_a, species_b, species_c, Cb, Cc, w0,
+                as_vector(delta_w_rf), as_vector(w1), as_vector(duration), M0,
+                result_map, solver);
+            return result;
+        },
+        "species_a"_a, "species_b"_a, "species_c"_a, "Cb"_a, "Cc"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade, "out"_a=pybind11::none());
+    
+    m.def(
+        "bm_train",
+        pybind11::overload_cast<
+            Species const &, Species const &, Species const &, double, double,
+            double, double, Eigen::Ref<Eigen::VectorXd const>, std::size_t,
+            std::size_t, double, Eigen::Vector9d const &, Solver>(&bm_train),
+        "species_a"_a, "species_b"_a, "species_c"_a, "Cb"_a, "Cc"_a, "w0"_a,
+        "delta_w_rf"_a, "pulse"_a, "count"_a, "gap_steps"_a, "step"_a, "M0"_a,
+        "solver"_a=Solver::Pade);
+    
+    m.def(
+        "bm_steady_state",
+        pybind11::overload_cast<
+            Species const &, Species const &, Species const &, double, double,
+            double, double, double>(&bm_steady_state),
+        "species_a"_a, "species_b"_a, "species_c"_a, "Cb"_a, "Cc"_a, "w0"_a,
+        "delta_w_rf"_a, "w1"_a);
+    
+    m.def(
+        "bm_pulsed",
+        pybind11::overload_cast<
+            Species const &, Species const &, Species const &, double, double,
+            double, double, double, double, double, std::size_t,
+            Eigen::Vector9d const &, Solver>(&bm_pulsed),
+        "species_a"_a, "species_b"_a, "species_c"_a, "Cb"_a, "Cc"_a, "w0"_a,
+        "delta_w_rf"_a, "w1"_a, "pulse_duration"_a, "gap_duration"_a,
+        "count"_a, "M0"_a, "solver"_a=Solver::Pade);
+    
+    m.def(
+        "bm_pulsed_steady_state",
+        pybind11::overload_cast<
+            Species const &, Species const &, Species const &, double, double,
+            double, double, double, double, double, Solver>(
+                &bm_pulsed_steady_state),
+        "species_a"_a, "species_b"_a, "species_c"_a, "Cb"_a, "Cc"_a, "w0"_a,
+        "delta_w_rf"_a, "w1"_a, "pulse_duration"_a, "gap_duration"_a,
+        "solver"_a=Solver::Pade);
 }
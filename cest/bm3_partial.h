@@ -1,37 +1,78 @@
 #ifndef _dd19598e_515e_45b2_a47a_8068ab5daef9
 #define _dd19598e_515e_45b2_a47a_8068ab5daef9
 
+#include <cstddef>
+
 #include <Eigen/Core>
 
 #include <pybind11/pybind11.h>
 
 #include "misc.h"
 
+void bm_system(
+    Species const & species_a, Species const & species_b, Species const & species_c,
+    double Cb, double Cc,
+    double w0, double delta_w_rf, double w1,
+    Eigen::Matrix9d & A, Eigen::Vector9d & b);
+
 Eigen::Matrix10d
 bm(
     Species const & species_a, Species const & species_b, Species const & species_c,
     double Cb, double Cc,
-    double w0, double delta_w_rf, double w1, double duration);
+    double w0, double delta_w_rf, double w1, double duration,
+    Solver solver=Solver::Pade);
 
 Eigen::Vector9d bm(
     Species const & species_a, Species const & species_b, Species const & species_c,
     double Cb, double Cc,
     double w0, double delta_w_rf, double w1, double duration,
-    Eigen::Vector9d const & M);
+    Eigen::Vector9d const & M, Solver solver=Solver::Pade);
 
 Eigen::Vector10d
 bm(
     Species const & species_a, Species const & species_b, Species const & species_c,
     double Cb, double Cc,
-    double w0, double delta_w_rf, Eigen::VectorXd const & w1,
-    double step, Eigen::Vector10d const & M0);
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> w1,
+    double step, Eigen::Vector10d const & M0, Solver solver=Solver::Pade);
 
 Eigen::Vector9d
 bm(
     Species const & species_a, Species const & species_b, Species const & species_c,
     double Cb, double Cc,
-    double w0, double delta_w_rf, Eigen::VectorXd const & w1,
-    double step, Eigen::Vector9d const & M0);
+    double w0, double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> w1,
+    double step, Eigen::Vector9d const & M0, Solver solver=Solver::Pade);
+
+void bm(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration, Eigen::Vector9d const & M,
+    Eigen::Ref<Eigen::MatrixX9d> result, Solver solver=Solver::Pade);
+
+Eigen::Vector9d bm_train(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, Eigen::Ref<Eigen::VectorXd const> pulse,
+    std::size_t count, std::size_t gap_steps, double step,
+    Eigen::Vector9d const & M, Solver solver=Solver::Pade);
+
+Eigen::Vector9d bm_steady_state(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, double w1);
+
+Eigen::Vector9d bm_pulsed(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, double w1, double pulse_duration, double gap_duration,
+    std::size_t count, Eigen::Vector9d const & M, Solver solver=Solver::Pade);
+
+Eigen::Vector9d bm_pulsed_steady_state(
+    Species const & species_a, Species const & species_b,
+    Species const & species_c, double Cb, double Cc, double w0,
+    double delta_w_rf, double w1, double pulse_duration, double gap_duration,
+    Solver solver=Solver::Pade);
 
 void bm3_partial(pybind11::module & m);
 
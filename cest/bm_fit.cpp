@@ -0,0 +1,441 @@
+#include "bm_fit.h"
+
+#include <cstddef>
+#include <limits>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <Eigen/Core>
+#include <unsupported/Eigen/MatrixFunctions>
+
+#include <pybind11/eigen.h>
+#include <pybind11/numpy.h>
+#include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+
+#include <tbb/blocked_range.h>
+#include <tbb/parallel_for.h>
+
+#include "bmn.h"
+#include "least_squares.h"
+#include "misc.h"
+#include "propagator.h"
+
+namespace
+{
+
+/// @brief Size of the block matrix used to compute a Fréchet derivative
+template<int N>
+struct DoubleSize
+{
+    static constexpr int value = (N == Eigen::Dynamic) ? Eigen::Dynamic : 2*N;
+};
+
+/**
+ * @brief Bloch-McConnell model of a Z-spectrum, as a function of the
+ * parameters described in bm_fit_names.
+ *
+ * The system is written in projective coordinates, d[M, 1]/dt = G [M, 1] with
+ * G = [[A, b], [0, 0]], so that the magnetization after the pulse is
+ * exp(G t) [M0, 1]. Its derivative with respect to a parameter is
+ * L(G t, dG/dp t) [M0, 1] + exp(G t) d[M0, 1]/dp, where the Fréchet derivative
+ * L is the top-right block of exp([[G, dG/dp], [0, G]] t).
+ */
+template<int Size>
+class Model
+{
+public:
+    using Parameters = Eigen::VectorXd;
+    using Jacobian = Eigen::MatrixXd;
+    
+    using Projective = typename EigenPropagator<Size>::Projective;
+    using ProjectiveVector = Eigen::Matrix<
+        double, ProjectiveSize<Size>::value, 1>;
+    using Block = Eigen::Matrix<
+        double,
+        DoubleSize<ProjectiveSize<Size>::value>::value,
+        DoubleSize<ProjectiveSize<Size>::value>::value>;
+    
+    Model(
+        std::vector<Species> const & species,
+        Eigen::Ref<Eigen::VectorXd const> exchange_rates, double w0,
+        Eigen::Ref<Eigen::VectorXd const> delta_w_rf, double w1,
+        double duration)
+    : species(species), exchange_rates(exchange_rates), w0(w0),
+        delta_w_rf(delta_w_rf), w1(w1), duration(duration),
+        size(3*species.size())
+    {
+        // Nothing else
+    }
+    
+    /// @brief Starting point of the fit
+    Parameters initial() const
+    {
+        Parameters p(2*this->species.size());
+        p[0] = 0;
+        p[1] = this->species[0].T2;
+        for(std::size_t i=1; i!=this->species.size(); ++i)
+        {
+            p[2*i] = this->species[i].M0;
+            p[2*i+1] = this->exchange_rates[i-1];
+        }
+        return p;
+    }
+    
+    /// @brief Compute the model
+    void operator()(Parameters const & p, Eigen::VectorXd & mu) const
+    {
+        std::vector<Species> species;
+        Eigen::MatrixXd rates;
+        this->system(p, species, rates);
+        auto const M = this->initial_magnetization(species);
+        
+        for(Eigen::Index k=0; k!=this->delta_w_rf.size(); ++k)
+        {
+            auto const G = this->generator(species, rates, p[0], k);
+            mu[k] =
+                ((G*this->duration).exp() * M)[2] / this->species[0].M0;
+        }
+    }
+    
+    /// @brief Compute the model and its Jacobian
+    void operator()(
+        Parameters const & p, Eigen::VectorXd & mu, Jacobian & J) const
+    {
+        std::vector<Species> species;
+        Eigen::MatrixXd rates;
+        this->system(p, species, rates);
+        auto const M = this->initial_magnetization(species);
+        auto const dG = this->generator_derivatives(species, p);
+        
+        auto const projective_size = this->size+1;
+        Block block = Block::Zero(2*projective_size, 2*projective_size);
+        for(Eigen::Index k=0; k!=this->delta_w_rf.size(); ++k)
+        {
+            Projective const G =
+                this->generator(species, rates, p[0], k) * this->duration;
+            block.topLeftCorner(projective_size, projective_size) = G;
+            block.bottomRightCorner(projective_size, projective_size) = G;
+            
+            for(Eigen::Index j=0; j!=p.size(); ++j)
+            {
+                block.topRightCorner(projective_size, projective_size) =
+                    dG[j] * this->duration;
+                Block const exp_block = block.exp();
+                auto const E =
+                    exp_block.topLeftCorner(projective_size, projective_size);
+                auto const L =
+                    exp_block.topRightCorner(projective_size, projective_size);
+                
+                ProjectiveVector dM = L * M;
+                // Only the M0 of the solute pools change the initial
+                // magnetization
+                if(j >= 2 && j%2 == 0)
+                {
+                    dM += E.col(3*(j/2)+2);
+                }
+                
+                if(j == 0)
+                {
+                    mu[k] = (E * M)[2] / this->species[0].M0;
+                }
+                J(k, j) = dM[2] / this->species[0].M0;
+            }
+        }
+    }
+
+private:
+    std::vector<Species> const & species;
+    Eigen::Ref<Eigen::VectorXd const> exchange_rates;
+    double w0;
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf;
+    double w1, duration;
+    Eigen::Index size;
+    
+    /// @brief Species and exchange rates matrix for given parameters
+    void system(
+        Parameters const & p, std::vector<Species> & species,
+        Eigen::MatrixXd & rates) const
+    {
+        auto const pools = this->species.size();
+        species = this->species;
+        species[0].T2 = p[1];
+        
+        rates.setZero(pools, pools);
+        for(std::size_t i=1; i!=pools; ++i)
+        {
+            species[i].M0 = p[2*i];
+            rates(i, 0) = p[2*i+1];
+            rates(0, i) = species[i].M0/species[0].M0 * p[2*i+1];
+        }
+    }
+    
+    /// @brief Equilibrium magnetization, in projective coordinates
+    ProjectiveVector initial_magnetization(
+        std::vector<Species> const & species) const
+    {
+        ProjectiveVector M = ProjectiveVector::Zero(this->size+1);
+        for(std::size_t i=0; i!=species.size(); ++i)
+        {
+            M[3*i+2] = species[i].M0;
+        }
+        M[this->size] = 1;
+        return M;
+    }
+    
+    /// @brief System matrix in projective coordinates at given offset
+    Projective generator(
+        std::vector<Species> const & species, Eigen::MatrixXd const & rates,
+        double B0, Eigen::Index k) const
+    {
+        Eigen::Matrix<double, Size, Size> A;
+        Eigen::Matrix<double, Size, 1> b;
+        // A shift of all the pools is a shift of the RF pulse in the other
+        // direction
+        bm_system(
+            species, rates, this->w0, this->delta_w_rf[k]-B0, this->w1, A, b);
+        
+        Projective G = Projective::Zero(this->size+1, this->size+1);
+        G.topLeftCorner(this->size, this->size) = A;
+        G.topRightCorner(this->size, 1) = b;
+        return G;
+    }
+    
+    /**
+     * @brief Derivatives of the system matrix in projective coordinates with
+     * respect to each parameter, which do not depend on the offset.
+     */
+    std::vector<Projective> generator_derivatives(
+        std::vector<Species> const & species, Parameters const & p) const
+    {
+        auto const pools = species.size();
+        std::vector<Projective> dG(
+            p.size(), Projective::Zero(this->size+1, this->size+1));
+        
+        // B0: the off-resonance terms of each pool
+        for(std::size_t i=0; i!=pools; ++i)
+        {
+            dG[0](3*i, 3*i+1) = -this->w0*1e-6;
+            dG[0](3*i+1, 3*i) = this->w0*1e-6;
+        }
+        
+        // T2 of water: R2 = 1/T2
+        dG[1](0, 0) = dG[1](1, 1) = 1/(p[1]*p[1]);
+        
+        for(std::size_t i=1; i!=pools; ++i)
+        {
+            // Derivatives of the transition rates from water to pool i (r)
+            // and from pool i to water (s)
+            Projective dr = Projective::Zero(this->size+1, this->size+1);
+            dr.block(0, 0, 3, 3).diagonal().setConstant(-1);
+            dr.block(3*i, 0, 3, 3).diagonal().setConstant(1);
+            Projective ds = Projective::Zero(this->size+1, this->size+1);
+            ds.block(3*i, 3*i, 3, 3).diagonal().setConstant(-1);
+            ds.block(0, 3*i, 3, 3).diagonal().setConstant(1);
+            
+            // r = M0_i/M0_a * C_i and s = C_i; M0_i also drives the
+            // longitudinal relaxation of pool i
+            auto const M0_a = species[0].M0;
+            dG[2*i] = p[2*i+1]/M0_a * dr;
+            dG[2*i](3*i+2, this->size) = 1/species[i].T1;
+            dG[2*i+1] = p[2*i]/M0_a * dr + ds;
+        }
+        
+        return dG;
+    }
+};
+
+template<int Size>
+void fit(
+    std::vector<Species> const & species,
+    Eigen::Ref<Eigen::VectorXd const> exchange_rates, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf, double w1, double duration,
+    Eigen::Ref<Eigen::MatrixXNd const> Z,
+    Eigen::Ref<Eigen::VectorXd const> lower,
+    Eigen::Ref<Eigen::VectorXd const> upper,
+    Eigen::Ref<Eigen::MatrixXNd> estimates,
+    Eigen::Ref<Eigen::MatrixXNd> residuals)
+{
+    Model<Size> const model(
+        species, exchange_rates, w0, delta_w_rf, w1, duration);
+    Eigen::VectorXd const lower_ = lower, upper_ = upper;
+    
+    tbb::parallel_for(
+        tbb::blocked_range<Eigen::Index>(0, Z.rows()),
+        [&](tbb::blocked_range<Eigen::Index> const & range) {
+            Eigen::VectorXd mu(Z.cols());
+            for(auto row=range.begin(); row!=range.end(); ++row)
+            {
+                Eigen::VectorXd const Z_ = Z.row(row).transpose();
+                if(!Z_.allFinite())
+                {
+                    estimates.row(row).setConstant(
+                        std::numeric_limits<double>::quiet_NaN());
+                    residuals.row(row).setConstant(
+                        std::numeric_limits<double>::quiet_NaN());
+                    continue;
+                }
+                
+                auto p = model.initial();
+                levenberg_marquardt(model, Z_, p, lower_, upper_);
+                model(p, mu);
+                
+                estimates.row(row) = p.transpose();
+                residuals.row(row) = (Z_ - mu).transpose();
+            }
+        });
+}
+
+}
+
+std::vector<std::string> bm_fit_names(std::size_t pools)
+{
+    std::vector<std::string> names{"B0", "T2_a"};
+    for(std::size_t i=1; i<pools; ++i)
+    {
+        std::string const pool(1, char('a'+i));
+        names.push_back("M0_"+pool);
+        names.push_back("C"+pool);
+    }
+    return names;
+}
+
+void fit_bm(
+    std::vector<Species> const & species,
+    Eigen::Ref<Eigen::VectorXd const> exchange_rates, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf, double w1, double duration,
+    Eigen::Ref<Eigen::MatrixXNd const> Z,
+    Eigen::Ref<Eigen::VectorXd const> lower,
+    Eigen::Ref<Eigen::VectorXd const> upper,
+    Eigen::Ref<Eigen::MatrixXNd> estimates,
+    Eigen::Ref<Eigen::MatrixXNd> residuals)
+{
+    Eigen::Index const pools = species.size();
+    if(pools < 2)
+    {
+        throw std::invalid_argument("At least two species are required");
+    }
+    if(exchange_rates.size() != pools-1)
+    {
+        throw std::invalid_argument(
+            "Exchange rates must have "+std::to_string(pools-1)+" items");
+    }
+    
+    auto const parameters = 2*pools;
+    if(delta_w_rf.size() < parameters)
+    {
+        throw std::invalid_argument(
+            "At least "+std::to_string(parameters)
+            +" frequency offsets are required");
+    }
+    if(Z.cols() != delta_w_rf.size())
+    {
+        throw std::invalid_argument(
+            "Signal must have "+std::to_string(delta_w_rf.size())+" columns");
+    }
+    if(lower.size() != parameters || upper.size() != parameters)
+    {
+        throw std::invalid_argument(
+            "Bounds must have "+std::to_string(parameters)+" items");
+    }
+    if(estimates.rows() != Z.rows() || estimates.cols() != parameters)
+    {
+        throw std::invalid_argument(
+            "Estimates must have "+std::to_string(Z.rows())+" rows and "
+            +std::to_string(parameters)+" columns");
+    }
+    if(residuals.rows() != Z.rows() || residuals.cols() != Z.cols())
+    {
+        throw std::invalid_argument(
+            "Residuals must have the same shape as the signal");
+    }
+    
+    // Use fixed-size matrices for the usual number of pools
+    switch(pools)
+    {
+        case 2: fit<6>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, Z, lower,
+            upper, estimates, residuals);
+            break;
+        case 3: fit<9>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, Z, lower,
+            upper, estimates, residuals);
+            break;
+        default: fit<Eigen::Dynamic>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, Z, lower,
+            upper, estimates, residuals);
+    }
+}
+
+void bm_fit(pybind11::module & m)
+{
+    using namespace pybind11::literals;
+    
+    m.def(
+        "bm_fit",
+        [](
+            std::vector<Species> const & species,
+            ArrayOrScalar const & exchange_rates, double w0,
+            ArrayOrScalar const & delta_w_rf, double w1, double duration,
+            ArrayOrScalar const & Z, pybind11::object const & lower,
+            pybind11::object const & upper) {
+            if(Z.ndim() != 2)
+            {
+                throw std::invalid_argument("Signal must be 2D");
+            }
+            
+            // Default bounds: the B0 shift is free, the other parameters
+            // are positive
+            pybind11::ssize_t const parameters = 2*species.size();
+            auto const infinity = std::numeric_limits<double>::infinity();
+            Eigen::VectorXd lower_ = Eigen::VectorXd::Zero(parameters);
+            lower_[0] = -infinity;
+            if(!lower.is_none())
+            {
+                lower_ = lower.cast<Eigen::VectorXd>();
+            }
+            Eigen::VectorXd upper_ =
+                Eigen::VectorXd::Constant(parameters, infinity);
+            if(!upper.is_none())
+            {
+                upper_ = upper.cast<Eigen::VectorXd>();
+            }
+            
+            pybind11::array_t<double> estimates({Z.shape(0), parameters});
+            pybind11::array_t<double> residuals({Z.shape(0), Z.shape(1)});
+            Eigen::Map<Eigen::MatrixXNd const> const Z_map(
+                Z.data(), Z.shape(0), Z.shape(1));
+            Eigen::Map<Eigen::MatrixXNd> estimates_map(
+                estimates.mutable_data(), Z.shape(0), parameters);
+            Eigen::Map<Eigen::MatrixXNd> residuals_map(
+                residuals.mutable_data(), Z.shape(0), Z.shape(1));
+            auto const exchange_rates_ = as_vector(exchange_rates),
+                delta_w_rf_ = as_vector(delta_w_rf);
+            {
+                pybind11::gil_scoped_release release_gil;
+                fit_bm(
+                    species, exchange_rates_, w0, delta_w_rf_, w1, duration,
+                    Z_map, lower_, upper_, estimates_map, residuals_map);
+            }
+            
+            return std::make_tuple(
+                estimates, residuals, bm_fit_names(species.size()));
+        },
+        "Least-squares fit of the N-pools Bloch-McConnell model to Z-spectra, "
+        "with one spectrum per row in Z. species are water followed by the "
+        "solute pools, and exchange_rates are the transition rates (Hz) from "
+        "each solute pool to water: together, they define the fixed "
+        "parameters of the model (relaxation times and chemical shifts) and "
+        "the starting point of the fit. The saturation is a block pulse of "
+        "frequency w1 (rad/s) and given duration (s), at the offsets "
+        "delta_w_rf (ppm), starting from the equilibrium magnetization. The "
+        "voxels are fitted in parallel with the Levenberg-Marquardt algorithm, "
+        "and the parameters are bounded by lower and upper (defaults: B0 is "
+        "free, the other parameters are positive). Return the estimates, with "
+        "one row per voxel, the residuals, with the same shape as Z, and the "
+        "names of the parameters.",
+        "species"_a, "exchange_rates"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
+        "duration"_a, "Z"_a, "lower"_a=pybind11::none(),
+        "upper"_a=pybind11::none());
+}
@@ -0,0 +1,57 @@
+#ifndef _9c30cee3_d929_4b10_b13c_fd747814e15d
+#define _9c30cee3_d929_4b10_b13c_fd747814e15d
+
+#include <cstddef>
+#include <string>
+#include <vector>
+
+#include <Eigen/Core>
+
+#include <pybind11/pybind11.h>
+
+#include "misc.h"
+
+/**
+ * @brief Names of the parameters fitted by fit_bm: B0 shift (ppm), T2 of
+ * water (s), then the equilibrium magnetization and the transition rate to
+ * water (Hz) of each solute pool, e.g. B0, T2_a, M0_b, Cb, M0_c, Cc.
+ */
+std::vector<std::string> bm_fit_names(std::size_t pools);
+
+/**
+ * @brief Least-squares fit of the N-pools Bloch-McConnell model to the
+ * Z-spectrum of each voxel, using the Levenberg-Marquardt algorithm. The
+ * solute pools only exchange with water (the first pool), and the saturation
+ * is a block pulse starting from the equilibrium magnetization. The Jacobian
+ * is computed from the Fréchet derivatives of the matrix exponential. The
+ * voxels are fitted in parallel.
+ * @param species Water, then the solute pools: the relaxation times and
+ * frequency offsets are fixed, T2 of water and the M0 of the solute pools
+ * are the starting point of the fit
+ * @param exchange_rates Transition rates from each solute pool to water (Hz),
+ * starting point of the fit
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offsets of the saturation RF pulse (ppm)
+ * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
+ * @param duration Duration of the saturation RF pulse (s)
+ * @param Z Z-spectra, i.e. Mz of water normalized by its M0, one voxel per
+ * row
+ * @param lower Lower bounds of the parameters, in the order of bm_fit_names
+ * @param upper Upper bounds of the parameters, in the order of bm_fit_names
+ * @param estimates Estimated parameters, one voxel per row
+ * @param residuals Difference between the data and the fitted model, one
+ * voxel per row
+ */
+void fit_bm(
+    std::vector<Species> const & species,
+    Eigen::Ref<Eigen::VectorXd const> exchange_rates, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf, double w1, double duration,
+    Eigen::Ref<Eigen::MatrixXNd const> Z,
+    Eigen::Ref<Eigen::VectorXd const> lower,
+    Eigen::Ref<Eigen::VectorXd const> upper,
+    Eigen::Ref<Eigen::MatrixXNd> estimates,
+    Eigen::Ref<Eigen::MatrixXNd> residuals);
+
+void bm_fit(pybind11::module & m);
+
+#endif // _9c30cee3_d929_4b10_b13c_fd747814e15d
@@ -0,0 +1,216 @@
+#include "bmn.h"
+
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <Eigen/Core>
+
+#include <pybind11/eigen.h>
+#include <pybind11/numpy.h>
+#include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+
+#include <tbb/blocked_range.h>
+#include <tbb/parallel_for.h>
+
+#include "misc.h"
+#include "propagator.h"
+
+namespace
+{
+
+void check_system(
+    std::vector<Species> const & species, Eigen::MatrixXd const & exchange_rates,
+    Eigen::VectorXd const & M)
+{
+    Eigen::Index const pools = species.size();
+    if(pools == 0)
+    {
+        throw std::invalid_argument("At least one species is required");
+    }
+    if(exchange_rates.rows() != pools || exchange_rates.cols() != pools)
+    {
+        throw std::invalid_argument(
+            "Exchange rates must be a "+std::to_string(pools)+"x"
+            +std::to_string(pools)+" matrix");
+    }
+    if(M.size() != 3*pools)
+    {
+        throw std::invalid_argument(
+            "Magnetization must have "+std::to_string(3*pools)+" items");
+    }
+}
+
+template<int Size>
+Eigen::VectorXd evolve_n(
+    std::vector<Species> const & species, Eigen::MatrixXd const & exchange_rates,
+    double w0, double delta_w_rf, double w1, double duration,
+    Eigen::VectorXd const & M, Solver solver)
+{
+    Eigen::Matrix<double, Size, Size> A;
+    Eigen::Matrix<double, Size, 1> b;
+    bm_system(species, exchange_rates, w0, delta_w_rf, w1, A, b);
+    
+    Eigen::Matrix<double, Size, 1> const M_ = M;
+    return evolve(A, b, M_, duration, solver);
+}
+
+template<int Size>
+void evolve_n(
+    std::vector<Species> const & species,
+    Eigen::MatrixXd const & exchange_rates, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration, Eigen::VectorXd const & M,
+    Solver solver, Eigen::Ref<Eigen::MatrixXNd> result)
+{
+    Eigen::Matrix<double, Size, 1> const M_ = M;
+    
+    tbb::parallel_for(
+        tbb::blocked_range<Eigen::Index>(0, result.rows()),
+        [&](tbb::blocked_range<Eigen::Index> const & range) {
+            Eigen::Matrix<double, Size, Size> A;
+            Eigen::Matrix<double, Size, 1> b;
+            EigenPropagator<Size> eigen_propagator;
+            for(auto i=range.begin(); i!=range.end(); ++i)
+            {
+                // Only assemble (and decompose) the system when it changes,
+                // i.e. not when only the duration changes.
+                auto const delta_w_rf_ = batch_item(delta_w_rf, i);
+                auto const w1_ = batch_item(w1, i);
+                if(
+                    i == range.begin()
+                    || delta_w_rf_ != batch_item(delta_w_rf, i-1)
+                    || w1_ != batch_item(w1, i-1))
+                {
+                    bm_system(
+                        species, exchange_rates, w0, delta_w_rf_, w1_, A, b);
+                    if(solver == Solver::Eigendecomposition)
+                    {
+                        eigen_propagator = EigenPropagator<Size>(A, b);
+                    }
+                }
+                
+                auto const duration_ = batch_item(duration, i);
+                result.row(i) =
+                    eigen_propagator.valid()
+                    ? eigen_propagator.evolve(M_, duration_)
+                    : evolve(A, b, M_, duration_, Solver::Pade);
+            }
+        });
+}
+
+}
+
+Eigen::VectorXd bm_n(
+    std::vector<Species> const & species, Eigen::MatrixXd const & exchange_rates,
+    double w0, double delta_w_rf, double w1, double duration,
+    Eigen::VectorXd const & M, Solver solver)
+{
+    check_system(species, exchange_rates, M);
+    
+    // Use fixed-size matrices for the usual number of pools
+    switch(species.size())
+    {
+        case 1: return evolve_n<3>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver);
+        case 2: return evolve_n<6>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver);
+        case 3: return evolve_n<9>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver);
+        case 4: return evolve_n<12>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver);
+        default: return evolve_n<Eigen::Dynamic>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver);
+    }
+}
+
+void bm_n(
+    std::vector<Species> const & species,
+    Eigen::MatrixXd const & exchange_rates, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration, Eigen::VectorXd const & M,
+    Eigen::Ref<Eigen::MatrixXNd> result, Solver solver)
+{
+    check_system(species, exchange_rates, M);
+    auto const size = batch_size({delta_w_rf.size(), w1.size(), duration.size()});
+    if(result.rows() != size || result.cols() != M.size())
+    {
+        throw std::invalid_argument(
+            "Result must have "+std::to_string(size)+" rows and "
+            +std::to_string(M.size())+" columns");
+    }
+    
+    // Use fixed-size matrices for the usual number of pools
+    switch(species.size())
+    {
+        case 1: evolve_n<3>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver,
+            result);
+            break;
+        case 2: evolve_n<6>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver,
+            result);
+            break;
+        case 3: evolve_n<9>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver,
+            result);
+            break;
+        case 4: evolve_n<12>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver,
+            result);
+            break;
+        default: evolve_n<Eigen::Dynamic>(
+            species, exchange_rates, w0, delta_w_rf, w1, duration, M, solver,
+            result);
+    }
+}
+
+void bmn(pybind11::module & m)
+{
+    using namespace pybind11::literals;
+    
+    m.def(
+        "bm_n",
+        pybind11::overload_cast<
+            std::vector<Species> const &, Eigen::MatrixXd const &,
+            double, double, double, double, Eigen::VectorXd const &,
+            Solver>(&bm_n),
+        "N-pools Bloch-McConnell simulation. exchange_rates[i, j] is the "
+        "transition rate (Hz) from pool i to pool j, and the magnetization is "
+        "given as [Mx1, My1, Mz1, ..., MxN, MyN, MzN]",
+        "species"_a, "exchange_rates"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade);
+    
+    m.def(
+        "bm_n_batch",
+        [](
+            std::vector<Species> const & species,
+            Eigen::MatrixXd const & exchange_rates, double w0,
+            ArrayOrScalar const & delta_w_rf, ArrayOrScalar const & w1,
+            ArrayOrScalar const & duration, Eigen::VectorXd const & M0,
+            Solver solver, pybind11::object const & out) {
+            auto const size = batch_size(
+                {delta_w_rf.size(), w1.size(), duration.size()});
+            auto result = output_array<double>(out, {size, M0.size()});
+            Eigen::Map<Eigen::MatrixXNd> result_map(
+                result.mutable_data(), size, M0.size());
+            auto const delta_w_rf_ = as_vector(delta_w_rf), w1_ = as_vector(w1),
+                duration_ = as_vector(duration);
+            {
+                pybind11::gil_scoped_release release_gil;
+                bm_n(
+                    species, exchange_rates, w0, delta_w_rf_, w1_, duration_,
+                    M0, result_map, solver);
+            }
+            return result;
+        },
+        "N-pools Bloch-McConnell simulation of a batch of block pulses. "
+        "delta_w_rf, w1 and step may be scalars or arrays of the same size, "
+        "the result has one row per item of the batch, and is written to out "
+        "if specified. The items of the batch are simulated in parallel.",
+        "species"_a, "exchange_rates"_a, "w0"_a, "delta_w_rf"_a, "w1"_a,
+        "step"_a, "M0"_a, "solver"_a=Solver::Pade, "out"_a=pybind11::none());
+}
@@ -0,0 +1,77 @@
+#ifndef _02efafd1_50b5_41a6_9edd_583a4abd3e14
+#define _02efafd1_50b5_41a6_9edd_583a4abd3e14
+
+#include <vector>
+
+#include <Eigen/Core>
+
+#include <pybind11/pybind11.h>
+
+#include "misc.h"
+
+/**
+ * @brief N-pools Bloch-McConnell system, as dM/dt = A M + b. Only the blocks
+ * of A corresponding to non-zero exchange rates are filled.
+ * @param species
+ * @param exchange_rates Exchange rates between pools (Hz): item (i, j) is the
+ * transition rate from pool i to pool j. The diagonal is ignored.
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offset of the saturation RF pulse (ppm)
+ * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
+ * @param A System matrix, applied to [Mx1, My1, Mz1, ..., MxN, MyN, MzN]
+ * @param b Constant term of the system
+ */
+template<int Size>
+void bm_system(
+    std::vector<Species> const & species, Eigen::MatrixXd const & exchange_rates,
+    double w0, double delta_w_rf, double w1,
+    Eigen::Matrix<double, Size, Size> & A, Eigen::Matrix<double, Size, 1> & b);
+
+/**
+ * @brief N-pools Bloch-McConnell simulation
+ * @param species
+ * @param exchange_rates Exchange rates between pools (Hz): item (i, j) is the
+ * transition rate from pool i to pool j. The diagonal is ignored.
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offset of the saturation RF pulse (ppm)
+ * @param w1 Frequency of the B1 field of the saturation RF pulse (rad/s)
+ * @param duration Duration of the simulation in s
+ * @param M magnetization as [Mx1, My1, Mz1, ..., MxN, MyN, MzN]
+ * @param solver Method used to compute the matrix exponential
+ * @return Magnetization after evolution, as [Mx1, My1, Mz1, ..., MxN, MyN, MzN]
+ */
+Eigen::VectorXd bm_n(
+    std::vector<Species> const & species, Eigen::MatrixXd const & exchange_rates,
+    double w0, double delta_w_rf, double w1, double duration,
+    Eigen::VectorXd const & M, Solver solver=Solver::Pade);
+
+/**
+ * @brief N-pools Bloch-McConnell simulation of a batch of block pulses. The
+ * items of the batch are simulated in parallel.
+ * @param species
+ * @param exchange_rates Exchange rates between pools (Hz): item (i, j) is the
+ * transition rate from pool i to pool j. The diagonal is ignored.
+ * @param w0 Larmor frequency (rad/s)
+ * @param delta_w_rf Frequency offsets of the saturation RF pulse (ppm)
+ * @param w1 Frequencies of the B1 field of the saturation RF pulse (rad/s)
+ * @param duration Durations of the simulation in s
+ * @param M magnetization as [Mx1, My1, Mz1, ..., MxN, MyN, MzN]
+ * @param result Magnetization after evolution, one row per item of the batch
+ * @param solver Method used to compute the matrix exponential
+ *
+ * delta_w_rf, w1 and duration must have the same size, or have a size of 1 in
+ * which case their value is used for the whole batch.
+ */
+void bm_n(
+    std::vector<Species> const & species,
+    Eigen::MatrixXd const & exchange_rates, double w0,
+    Eigen::Ref<Eigen::VectorXd const> delta_w_rf,
+    Eigen::Ref<Eigen::VectorXd const> w1,
+    Eigen::Ref<Eigen::VectorXd const> duration, Eigen::VectorXd const & M,
+    Eigen::Ref<Eigen::MatrixXNd> result, Solver solver=Solver::Pade);
+
+void bmn(pybind11::module & m);
+
+#include "bmn.txx"
+
+#endif // _02efafd1_50b5_41a6_9edd_583a4abd3e14
@@ -0,0 +1,58 @@
+#ifndef _17f8d9fe_1a21_40f4_b2fe_ebd69c134b5e
+#define _17f8d9fe_1a21_40f4_b2fe_ebd69c134b5e
+
+#include "bmn.h"
+
+#include <vector>
+
+#include <Eigen/Core>
+
+#include "misc.h"
+
+template<int Size>
+void bm_system(
+    std::vector<Species> const & species, Eigen::MatrixXd const & exchange_rates,
+    double w0, double delta_w_rf, double w1,
+    Eigen::Matrix<double, Size, Size> & A, Eigen::Matrix<double, Size, 1> & b)
+{
+    Eigen::Index const pools = species.size();
+    
+    auto const w = w0*(1 + delta_w_rf*1e-6);
+    
+    A.setZero(3*pools, 3*pools);
+    b.setZero(3*pools);
+    for(Eigen::Index i=0; i!=pools; ++i)
+    {
+        auto const & species_i = species[i];
+        auto const R1 = 1/species_i.T1;
+        auto const R2 = 1/species_i.T2;
+        
+        // Total transition rate from pool i to the other pools
+        auto const C = exchange_rates.row(i).sum() - exchange_rates(i, i);
+        
+        auto const k1 = R1+C;
+        auto const k2 = R2+C;
+        
+        auto const wi = w0*(1 + species_i.delta_w*1e-6);
+        
+        A.template block<3, 3>(3*i, 3*i) <<
+        //   Mxi      Myi   Mzi
+             -k2, -(wi-w),    0,
+            wi-w,     -k2,  -w1,
+               0,      w1,  -k1;
+        
+        b[3*i+2] = species_i.M0*R1;
+        
+        // Transitions from the other pools to pool i
+        for(Eigen::Index j=0; j!=pools; ++j)
+        {
+            if(j != i && exchange_rates(j, i) != 0)
+            {
+                A.template block<3, 3>(3*i, 3*j).diagonal().setConstant(
+                    exchange_rates(j, i));
+            }
+        }
+    }
+}
+
+#endif // _17f8d9fe_1a21_40f4_b2fe_ebd69c134b5e
@@ -0,0 +1,421 @@
+#include "interpolation.h"
+
+#include <algorithm>
+#include <array>
+#include <cmath>
+#include <limits>
+#include <numeric>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <Eigen/Core>
+#include <Eigen/Dense>
+
+#include <pybind11/numpy.h>
+#include <pybind11/pybind11.h>
+
+#include <tbb/blocked_range.h>
+#include <tbb/parallel_for.h>
+
+#include "misc.h"
+
+namespace
+{
+
+/**
+ * @brief Linear operator mapping the sampled values to the slopes of the
+ * not-a-knot cubic spline at the sample points, as in
+ * scipy.interpolate.CubicSpline. It only depends on the sample points.
+ */
+Eigen::MatrixXd cubic_slopes(Eigen::VectorXd const & x)
+{
+    auto const size = x.size();
+    Eigen::VectorXd const dx = x.tail(size-1) - x.head(size-1);
+    
+    // Slopes of the segments, as a function of the sampled values
+    Eigen::MatrixXd segments = Eigen::MatrixXd::Zero(size-1, size);
+    for(Eigen::Index i=0; i!=size-1; ++i)
+    {
+        segments(i, i) = -1/dx[i];
+        segments(i, i+1) = 1/dx[i];
+    }
+    
+    // Slopes s at sample points are given by A s = B y
+    Eigen::MatrixXd A = Eigen::MatrixXd::Zero(size, size);
+    Eigen::MatrixXd B = Eigen::MatrixXd::Zero(size, size);
+    if(size == 2)
+    {
+        // Linear function
+        A.setIdentity();
+        B.row(0) = B.row(1) = segments.row(0);
+    }
+    else if(size == 3)
+    {
+        // Both not-a-knot conditions are identical: use a parabola
+        A << 1, 1, 0, dx[1], 2*(dx[0]+dx[1]), dx[0], 0, 1, 1;
+        B.row(0) = 2*segments.row(0);
+        B.row(1) = 3*(dx[0]*segments.row(1) + dx[1]*segments.row(0));
+        B.row(2) = 2*segments.row(1);
+    }
+    else
+    {
+        // Continuity of the second derivative
+        for(Eigen::Index i=1; i!=size-1; ++i)
+        {
+            A(i, i-1) = dx[i];
+            A(i, i) = 2*(dx[i-1]+dx[i]);
+            A(i, i+1) = dx[i-1];
+            B.row(i) = 3*(dx[i]*segments.row(i-1) + dx[i-1]*segments.row(i));
+        }
+        
+        // Not-a-knot conditions
+        auto d = x[2]-x[0];
+        A(0, 0) = dx[1];
+        A(0, 1) = d;
+        B.row(0) = (
+                (dx[0]+2*d)*dx[1]*segments.row(0)
+                + dx[0]*dx[0]*segments.row(1)
+            ) / d;
+        
+        d = x[size-1]-x[size-3];
+        A(size-1, size-1) = dx[size-3];
+        A(size-1, size-2) = d;
+        B.row(size-1) = (
+                dx[size-2]*dx[size-2]*segments.row(size-3)
+                + (2*d+dx[size-2])*dx[size-3]*segments.row(size-2)
+            ) / d;
+    }
+    
+    return A.partialPivLu().solve(B);
+}
+
+/**
+ * @brief Slopes of the Akima interpolant at the sample points, as in
+ * scipy.interpolate.Akima1DInterpolator.
+ * @param x Sample points, in increasing order
+ * @param y Sampled values
+ * @param m Buffer for the slopes of the segments, of size x.size()+3
+ * @param slopes Slopes at the sample points
+ */
+void akima_slopes(
+    Eigen::VectorXd const & x, Eigen::VectorXd const & y, Eigen::VectorXd & m,
+    Eigen::VectorXd & slopes)
+{
+    auto const size = x.size();
+    if(size == 2)
+    {
+        slopes.setConstant((y[1]-y[0])/(x[1]-x[0]));
+        return;
+    }
+    
+    // Slopes of the segments, with two additional segments on each side
+    m.segment(2, size-1) =
+        (y.tail(size-1) - y.head(size-1)).cwiseQuotient(
+            x.tail(size-1) - x.head(size-1));
+    m[1] = 2*m[2] - m[3];
+    m[0] = 2*m[1] - m[2];
+    m[size+1] = 2*m[size] - m[size-1];
+    m[size+2] = 2*m[size+1] - m[size];
+    
+    auto const dm = (m.tail(size+2) - m.head(size+2)).cwiseAbs().eval();
+    auto const f1 = dm.tail(size);
+    auto const f2 = dm.head(size);
+    auto const threshold = 1e-9 * (f1+f2).maxCoeff();
+    
+    for(Eigen::Index i=0; i!=size; ++i)
+    {
+        auto const f12 = f1[i]+f2[i];
+        slopes[i] =
+            (f12 > threshold)
+            ? m[i+1] + f2[i]/f12 * (m[i+2]-m[i+1])
+            // Slope is not defined, use the fill value
+            : 0.5*(m[i+3]+m[i]);
+    }
+}
+
+/**
+ * @brief Interval containing an interpolation position, and weights of the
+ * values and of the slopes at the ends of the interval: the interpolated value
+ * is w0*y[i] + w1*s[i] + w2*y[i+1] + w3*s[i+1]
+ */
+struct Stencil
+{
+    Eigen::Index interval;
+    std::array<double, 4> weights;
+};
+
+/**
+ * @brief Stencil of an interpolation position
+ * @param x Sample points, in increasing order, at least two of them
+ * @param position Interpolation position
+ * @param kind Interpolation method
+ * @param clamp Whether positions outside of the sampled range are clamped to
+ *        it, or yield NaN
+ * @param hint Interval of the previous position, updated with the interval of
+ *        the current position: successive positions are usually close, which
+ *        avoids a binary search.
+ */
+Stencil stencil(
+    Eigen::VectorXd const & x, double position, Interpolation kind,
+    bool clamp, Eigen::Index & hint)
+{
+    auto const size = x.size();
+    Stencil result{0, {0, 0, 0, 0}};
+    if(
+        std::isnan(position)
+        || (!clamp && (position < x[0] || position > x[size-1])))
+    {
+        result.weights[0] = std::numeric_limits<double>::quiet_NaN();
+    }
+    else if(position <= x[0])
+    {
+        result.weights[0] = 1;
+    }
+    else if(position >= x[size-1])
+    {
+        result.interval = size-2;
+        result.weights[2] = 1;
+    }
+    else
+    {
+        if(position < x[hint] || position >= x[hint+1])
+        {
+            hint = std::upper_bound(x.data(), x.data()+size, position)
+                - x.data() - 1;
+        }
+        result.interval = hint;
+        
+        auto const h = x[hint+1]-x[hint];
+        auto const t = (position-x[hint])/h;
+        auto const u = 1-t;
+        if(kind == Interpolation::Linear)
+        {
+            result.weights = {u, 0, t, 0};
+        }
+        else
+        {
+            // Cubic Hermite basis
+            result.weights = {(1+2*t)*u*u, t*u*u*h, t*t*(3-2*t), -t*t*u*h};
+        }
+    }
+    
+    return result;
+}
+
+}
+
+template<typename T>
+void interpolate(
+    Eigen::Ref<Eigen::VectorXd const> x,
+    Eigen::Ref<Eigen::MatrixXNd const> y,
+    Eigen::Ref<Eigen::MatrixXNd const> x_new, Interpolation kind, bool clamp,
+    Eigen::Ref<
+        Eigen::Matrix<T, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>
+    > result)
+{
+    auto const size = x.size();
+    if(size == 0)
+    {
+        throw std::invalid_argument("At least one sample point is required");
+    }
+    if(y.cols() != size)
+    {
+        throw std::invalid_argument(
+            "Sampled values must have "+std::to_string(size)+" columns");
+    }
+    if(x_new.rows() != y.rows() && x_new.rows() != 1)
+    {
+        throw std::invalid_argument(
+            "Interpolation points must have 1 or "+std::to_string(y.rows())
+            +" rows");
+    }
+    if(result.rows() != y.rows() || result.cols() != x_new.cols())
+    {
+        throw std::invalid_argument(
+            "Result must have "+std::to_string(y.rows())+" rows and "
+            +std::to_string(x_new.cols())+" columns");
+    }
+    
+    // Sort the sample points once for all functions
+    std::vector<Eigen::Index> order(size);
+    std::iota(order.begin(), order.end(), 0);
+    std::sort(
+        order.begin(), order.end(),
+        [&](Eigen::Index i, Eigen::Index j) { return x[i] < x[j]; });
+    Eigen::VectorXd x_sorted(size);
+    for(Eigen::Index i=0; i!=size; ++i)
+    {
+        x_sorted[i] = x[order[i]];
+        if(i != 0 && x_sorted[i] == x_sorted[i-1])
+        {
+            throw std::invalid_argument("Sample points must be distinct");
+        }
+    }
+    
+    Eigen::MatrixXd const cubic =
+        (kind == Interpolation::Cubic && size > 1)
+        ? cubic_slopes(x_sorted) : Eigen::MatrixXd();
+    
+    // When all functions are interpolated at the same positions, the stencils
+    // only depend on the sample points and are computed once.
+    bool const shared = (x_new.rows() == 1);
+    std::vector<Stencil> shared_stencils;
+    if(shared && size > 1)
+    {
+        shared_stencils.reserve(x_new.cols());
+        Eigen::Index hint = 0;
+        for(Eigen::Index column=0; column!=x_new.cols(); ++column)
+        {
+            shared_stencils.push_back(
+                stencil(x_sorted, x_new(0, column), kind, clamp, hint));
+        }
+    }
+    
+    tbb::parallel_for(
+        tbb::blocked_range<Eigen::Index>(0, y.rows()),
+        [&](tbb::blocked_range<Eigen::Index> const & range) {
+            Eigen::VectorXd values(size), segments(size+3);
+            // Slopes are not used by linear interpolation, but are multiplied
+            // by a null weight: they must be finite.
+            Eigen::VectorXd slopes = Eigen::VectorXd::Zero(size);
+            for(auto row=range.begin(); row!=range.end(); ++row)
+            {
+                auto const positions = x_new.row(shared ? 0 : row);
+                
+                for(Eigen::Index i=0; i!=size; ++i)
+                {
+                    values[i] = y(row, order[i]);
+                }
+                
+                if(size == 1)
+                {
+                    for(Eigen::Index column=0; column!=x_new.cols(); ++column)
+                    {
+                        auto const position = positions[column];
+                        result(row, column) =
+                            (
+                                std::isnan(position)
+                                || (!clamp && position != x_sorted[0]))
+                            ? std::numeric_limits<T>::quiet_NaN()
+                            : T(values[0]);
+                    }
+                    continue;
+                }
+                
+                if(kind == Interpolation::Cubic)
+                {
+                    slopes.noalias() = cubic * values;
+                }
+                else if(kind == Interpolation::Akima)
+                {
+                    akima_slopes(x_sorted, values, segments, slopes);
+                }
+                
+                Eigen::Index hint = 0;
+                for(Eigen::Index column=0; column!=x_new.cols(); ++column)
+                {
+                    auto const stencil_ =
+                        shared
+                        ? shared_stencils[column]
+                        : stencil(
+                            x_sorted, positions[column], kind, clamp, hint);
+                    auto const i = stencil_.interval;
+                    auto const & w = stencil_.weights;
+                    result(row, column) = T(
+                        w[0]*values[i] + w[1]*slopes[i]
+                        + w[2]*values[i+1] + w[3]*slopes[i+1]);
+                }
+            }
+        });
+}
+
+template void interpolate<double>(
+    Eigen::Ref<Eigen::VectorXd const>, Eigen::Ref<Eigen::MatrixXNd const>,
+    Eigen::Ref<Eigen::MatrixXNd const>, Interpolation, bool,
+    Eigen::Ref<Eigen::MatrixXNd>);
+template void interpolate<float>(
+    Eigen::Ref<Eigen::VectorXd const>, Eigen::Ref<Eigen::MatrixXNd const>,
+    Eigen::Ref<Eigen::MatrixXNd const>, Interpolation, bool,
+    Eigen::Ref<Eigen::MatrixXNf>);
+
+void interpolation(pybind11::module & m)
+{
+    using namespace pybind11::literals;
+    
+    pybind11::enum_<Interpolation>(
+            m, "Interpolation", "Interpolation method of sampled functions")
+        .value("linear", Interpolation::Linear, "Piecewise linear interpolation")
+        .value(
+            "cubic", Interpolation::Cubic,
+            "Cubic spline, with not-a-knot boundary conditions")
+        .value("akima", Interpolation::Akima, "Akima interpolation");
+    
+    m.def(
+        "interpolate",
+        [](
+            ArrayOrScalar const & x, ArrayOrScalar const & y,
+            ArrayOrScalar const & x_new, Interpolation kind, bool clamp,
+            pybind11::object const & dtype, pybind11::object const & out) {
+            if(y.ndim() != 2 || x_new.ndim() != 2)
+            {
+                throw std::invalid_argument(
+                    "Sampled values and interpolation points must be 2D");
+            }
+            auto const dtype_ = pybind11::dtype::from_args(dtype);
+            if(
+                dtype_.kind() != 'f'
+                || (dtype_.itemsize() != 4 && dtype_.itemsize() != 8))
+            {
+                throw std::invalid_argument(
+                    "Result must be in single or double precision");
+            }
+            
+            Eigen::Map<Eigen::MatrixXNd const> const y_map(
+                y.data(), y.shape(0), y.shape(1));
+            Eigen::Map<Eigen::MatrixXNd const> const x_new_map(
+                x_new.data(), x_new.shape(0), x_new.shape(1));
+            auto const x_ = as_vector(x);
+            
+            std::vector<pybind11::ssize_t> const shape{
+                y.shape(0), x_new.shape(1)};
+            pybind11::array result;
+            if(dtype_.itemsize() == 4)
+            {
+                auto result_ = output_array<float>(out, shape);
+                Eigen::Map<Eigen::MatrixXNf> result_map(
+                    result_.mutable_data(), shape[0], shape[1]);
+                {
+                    pybind11::gil_scoped_release release_gil;
+                    interpolate<float>(
+                        x_, y_map, x_new_map, kind, clamp, result_map);
+                }
+                result = result_;
+            }
+            else
+            {
+                auto result_ = output_array<double>(out, shape);
+                Eigen::Map<Eigen::MatrixXNd> result_map(
+                    result_.mutable_data(), shape[0], shape[1]);
+                {
+                    pybind11::gil_scoped_release release_gil;
+                    interpolate<double>(
+                        x_, y_map, x_new_map, kind, clamp, result_map);
+                }
+                result = result_;
+            }
+            
+            return result;
+        },
+        "Interpolate a batch of functions sampled on the same points x: y has "
+        "one row per function, x_new has either one row per function or a "
+        "single row of positions shared by all functions. Positions outside "
+        "of the sampled range yield NaN, or are clamped to it if clamp is "
+        "true. The functions are "
+        "interpolated in parallel, and the result is stored in single or "
+        "double precision according to dtype. If specified, the result is "
+        "written to out, which must have the same dtype.",
+        "x"_a, "y"_a, "x_new"_a, "kind"_a=Interpolation::Linear,
+        "clamp"_a=false,
+        "dtype"_a=pybind11::dtype::of<double>(), "out"_a=pybind11::none());
+}
@@ -0,0 +1,47 @@
+#ifndef _e85d4744_86ca_4783_ae7c_24f976cbbb51
+#define _e85d4744_86ca_4783_ae7c_24f976cbbb51
+
+#include <Eigen/Core>
+
+#include <pybind11/pybind11.h>
+
+#include "misc.h"
+
+/// @brief Interpolation method of sampled functions
+enum class Interpolation
+{
+    /// @brief Piecewise linear interpolation
+    Linear,
+    /// @brief Cubic spline, with not-a-knot boundary conditions
+    Cubic,
+    /// @brief Akima interpolation
+    Akima
+};
+
+/**
+ * @brief Interpolate a batch of functions sampled on the same points, each at
+ * its own positions or all at the same positions. The functions are
+ * interpolated in parallel.
+ * @param x Sample points, in any order
+ * @param y Sampled values, one function per row
+ * @param x_new Interpolation points, one row per function, or a single row
+ *        shared by all functions: the interpolation weights are then only
+ *        computed once
+ * @param kind Interpolation method
+ * @param clamp Whether positions outside of the sampled range are clamped to
+ *        it, as in numpy.interp, or yield NaN
+ * @param result Interpolated values, one row per function and one column per
+ *        interpolation point, in single or double precision
+ */
+template<typename T>
+void interpolate(
+    Eigen::Ref<Eigen::VectorXd const> x,
+    Eigen::Ref<Eigen::MatrixXNd const> y,
+    Eigen::Ref<Eigen::MatrixXNd const> x_new, Interpolation kind, bool clamp,
+    Eigen::Ref<
+        Eigen::Matrix<T, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>
+    > result);
+
+void interpolation(pybind11::module & m);
+
+#endif // _e85d4744_86ca_4783_ae7c_24f976cbbb51
@@ -0,0 +1,37 @@
+#ifndef _1c91da43_8f1f_4c66_ab3c_9384b0957908
+#define _1c91da43_8f1f_4c66_ab3c_9384b0957908
+
+#include <Eigen/Core>
+
+/**
+ * @brief Levenberg-Marquardt minimization of the sum of squared residuals of
+ * a model, starting from p.
+ *
+ * The model must define the Parameters and Jacobian types, compute its
+ * prediction with model(p, mu), and its prediction and Jacobian with
+ * model(p, mu, J).
+ *
+ * @return Half of the sum of squared residuals at the minimum
+ */
+template<typename Model>
+double levenberg_marquardt(
+    Model const & model, Eigen::VectorXd const & y,
+    typename Model::Parameters & p);
+
+/**
+ * @brief Levenberg-Marquardt minimization of the sum of squared residuals of
+ * a model, starting from p, with box constraints: each step is projected on
+ * the [lower, upper] box.
+ *
+ * @return Half of the sum of squared residuals at the minimum
+ */
+template<typename Model>
+double levenberg_marquardt(
+    Model const & model, Eigen::VectorXd const & y,
+    typename Model::Parameters & p,
+    typename Model::Parameters const & lower,
+    typename Model::Parameters const & upper);
+
+#include "least_squares.txx"
+
+#endif // _1c91da43_8f1f_4c66_ab3c_9384b0957908
@@ -0,0 +1,85 @@
+#ifndef _615fde5e_d5d0_46a4_a2d7_fc626ee3fece
+#define _615fde5e_d5d0_46a4_a2d7_fc626ee3fece
+
+#include "least_squares.h"
+
+#include <limits>
+
+#include <Eigen/Core>
+#include <Eigen/Dense>
+
+template<typename Model>
+double levenberg_marquardt(
+    Model const & model, Eigen::VectorXd const & y,
+    typename Model::Parameters & p)
+{
+    using Parameters = typename Model::Parameters;
+    
+    auto const infinity = std::numeric_limits<double>::infinity();
+    return levenberg_marquardt(
+        model, y, p, Parameters::Constant(p.size(), -infinity),
+        Parameters::Constant(p.size(), infinity));
+}
+
+template<typename Model>
+double levenberg_marquardt(
+    Model const & model, Eigen::VectorXd const & y,
+    typename Model::Parameters & p,
+    typename Model::Parameters const & lower,
+    typename Model::Parameters const & upper)
+{
+    using Parameters = typename Model::Parameters;
+    using Hessian = Eigen::Matrix<
+        double, Parameters::RowsAtCompileTime, Parameters::RowsAtCompileTime>;
+    
+    auto const size = y.size();
+    Eigen::VectorXd mu(size), mu_new(size);
+    typename Model::Jacobian J(size, p.size());
+    
+    p = p.cwiseMax(lower).cwiseMin(upper);
+    model(p, mu, J);
+    auto cost = 0.5*(mu-y).squaredNorm();
+    
+    double lambda = 1e-3;
+    for(int iteration=0; iteration!=100 && lambda < 1e10; ++iteration)
+    {
+        Hessian const H = J.transpose()*J;
+        Parameters const gradient = J.transpose()*(mu-y);
+        
+        Hessian damped = H;
+        damped.diagonal() += lambda*H.diagonal();
+        Parameters const p_new = (p + damped.ldlt().solve(-gradient))
+            .cwiseMax(lower).cwiseMin(upper);
+        
+        // The projected step vanishes when the minimum is on the boundary
+        Parameters const step = p_new - p;
+        if(step.norm() <= 1e-10*p.norm())
+        {
+            break;
+        }
+        
+        // Only compute the Jacobian of the accepted steps
+        model(p_new, mu_new);
+        auto const cost_new = 0.5*(mu_new-y).squaredNorm();
+        if(cost_new < cost)
+        {
+            auto const decrease = cost-cost_new;
+            p = p_new;
+            model(p, mu, J);
+            cost = cost_new;
+            lambda /= 10;
+            if(decrease <= 1e-12*cost || step.norm() <= 1e-10*p.norm())
+            {
+                break;
+            }
+        }
+        else
+        {
+            lambda *= 10;
+        }
+    }
+    
+    return cost;
+}
+
+#endif // _615fde5e_d5d0_46a4_a2d7_fc626ee3fece
@@ -1,9 +1,41 @@
 #include "misc.h"
 
+#include <algorithm>
+#include <initializer_list>
+#include <stdexcept>
+
 #include <Eigen/Core>
 
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 
+Eigen::Map<Eigen::VectorXd const> as_vector(ArrayOrScalar const & x)
+{
+    if(x.ndim() > 1)
+    {
+        throw std::invalid_argument("Expected a scalar or a 1D array");
+    }
+    return Eigen::Map<Eigen::VectorXd const>(x.data(), x.size());
+}
+
+Eigen::Index batch_size(std::initializer_list<Eigen::Index> sizes)
+{
+    // Size of the first non-broadcast parameter, 1 if all are broadcast
+    auto const non_broadcast = std::find_if(
+        sizes.begin(), sizes.end(), [](Eigen::Index x) { return x != 1; });
+    auto const size = (non_broadcast != sizes.end()) ? *non_broadcast : 1;
+    
+    for(auto && item: sizes)
+    {
+        if(item != 1 && item != size)
+        {
+            throw std::invalid_argument(
+                "Batch parameters must have the same size or a size of 1");
+        }
+    }
+    return size;
+}
+
 void misc(pybind11::module m)
 {
     using namespace pybind11::literals;
@@ -36,4 +68,15 @@ void misc(pybind11::module m)
                 species.M0 = state["M0"].cast<double>();
                 return species;
             }));
+    
+    pybind11::enum_<Solver>(
+            m, "Solver",
+            "Method used to compute the propagators of the Bloch-McConnell "
+            "system")
+        .value(
+            "pade", Solver::Pade, "Padé approximant of the matrix exponential")
+        .value(
+            "eigendecomposition", Solver::Eigendecomposition,
+            "Eigendecomposition of the system matrix, re-used for all the "
+            "durations of a same system");
 }
@@ -1,8 +1,12 @@
 #ifndef _94ad7880_73fb_49c3_87f2_2f780574a299
 #define _94ad7880_73fb_49c3_87f2_2f780574a299
 
+#include <initializer_list>
+#include <vector>
+
 #include <Eigen/Core>
 
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 
 namespace Eigen
@@ -22,6 +26,14 @@ using RowVector9d = Eigen::Matrix<double, 1, 9>;
 using Matrix10d = Eigen::Matrix<double, 10, 10>;
 using Vector10d = Eigen::Matrix<double, 10, 1>;
 using RowVector10d = Eigen::Matrix<double, 1, 10>;
+
+// Batches of magnetizations, one magnetization per row
+using MatrixX6d = Eigen::Matrix<double, Eigen::Dynamic, 6, Eigen::RowMajor>;
+using MatrixX9d = Eigen::Matrix<double, Eigen::Dynamic, 9, Eigen::RowMajor>;
+using MatrixXNd = Eigen::Matrix<
+    double, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>;
+using MatrixXNf = Eigen::Matrix<
+    float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>;
 }
 
 /// @brief Chemical species
@@ -38,6 +50,56 @@ public:
     double M0;
 };
 
+/// @brief Method used to compute the propagators of the Bloch-McConnell system
+enum class Solver
+{
+    /// @brief Padé approximant of the matrix exponential
+    Pade,
+    /**
+     * @brief Eigendecomposition of the system matrix, re-used for all the
+     * durations of a same system. Falls back to Pade if the system matrix is
+     * not diagonalizable.
+     */
+    Eigendecomposition
+};
+
+/// @brief Scalar or 1D array of values, as received from Python
+using ArrayOrScalar = pybind11::array_t<
+    double, pybind11::array::c_style | pybind11::array::forcecast>;
+
+/**
+ * @brief View a scalar or a 1D array as a vector, without copying it: the
+ * array must outlive the vector.
+ */
+Eigen::Map<Eigen::VectorXd const> as_vector(ArrayOrScalar const & x);
+
+/**
+ * @brief Return the output array passed by the caller, or a new array if out
+ * is None. The output array is checked without being converted, so that the
+ * results are not written to a temporary copy.
+ * @throw std::invalid_argument if out is not a writeable, C-contiguous array
+ * with the expected type and shape
+ */
+template<typename T>
+pybind11::array_t<T, pybind11::array::c_style> output_array(
+    pybind11::object const & out, std::vector<pybind11::ssize_t> const & shape);
+
+/**
+ * @brief Common size of batched parameters: each parameter must either have 
+ * the same size or a size of 1 (in which case it is broadcast).
+ * @throw std::invalid_argument if sizes are not compatible
+ */
+Eigen::Index batch_size(std::initializer_list<Eigen::Index> sizes);
+
+/// @brief Item of a batched parameter, taking broadcasting into account
+inline double batch_item(
+    Eigen::Ref<Eigen::VectorXd const> const & values, Eigen::Index i)
+{
+    return values[values.size() == 1 ? 0 : i];
+}
+
 void misc(pybind11::module m);
 
+#include "misc.txx"
+
 #endif // _94ad7880_73fb_49c3_87f2_2f780574a299
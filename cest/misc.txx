@@ -0,0 +1,47 @@
+#ifndef _2a18118a_5ada_4747_b976_fd36e0523ab9
+#define _2a18118a_5ada_4747_b976_fd36e0523ab9
+
+#include "misc.h"
+
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <pybind11/numpy.h>
+#include <pybind11/pybind11.h>
+
+template<typename T>
+pybind11::array_t<T, pybind11::array::c_style> output_array(
+    pybind11::object const & out, std::vector<pybind11::ssize_t> const & shape)
+{
+    using Result = pybind11::array_t<T, pybind11::array::c_style>;
+    
+    if(out.is_none())
+    {
+        return Result(shape);
+    }
+    
+    // isinstance does not convert, unlike cast
+    if(!pybind11::isinstance<Result>(out))
+    {
+        throw std::invalid_argument(
+            "Output must be a C-contiguous array of "
+            +std::string(pybind11::str(pybind11::dtype::of<T>())));
+    }
+    auto result = out.cast<Result>();
+    if(!result.writeable())
+    {
+        throw std::invalid_argument("Output must be writeable");
+    }
+    if(
+        std::vector<pybind11::ssize_t>(
+            result.shape(), result.shape()+result.ndim())
+        != shape)
+    {
+        throw std::invalid_argument("Output has the wrong shape");
+    }
+    
+    return result;
+}
+
+#endif // _2a18118a_5ada_4747_b976_fd36e0523ab9
@@ -0,0 +1,133 @@
+#ifndef _effb83fd_1d9d_4b43_9cb6_a46e81c8a01e
+#define _effb83fd_1d9d_4b43_9cb6_a46e81c8a01e
+
+#include <complex>
+#include <cstddef>
+
+#include <Eigen/Core>
+#include <Eigen/Dense>
+#include <unsupported/Eigen/MatrixFunctions>
+
+#include "misc.h"
+
+/// @brief Size of the projective coordinates of an N-dimensional system
+template<int N>
+struct ProjectiveSize
+{
+    static constexpr int value = (N == Eigen::Dynamic) ? Eigen::Dynamic : N+1;
+};
+
+/**
+ * @brief Propagator of the affine system dM/dt = A M + b based on the
+ * eigendecomposition of A: once computed, the propagator over any duration
+ * only requires scalar exponentials and two matrix products.
+ */
+template<int N>
+class EigenPropagator
+{
+public:
+    using Matrix = Eigen::Matrix<double, N, N>;
+    using Vector = Eigen::Matrix<double, N, 1>;
+    using Projective = Eigen::Matrix<
+        double, ProjectiveSize<N>::value, ProjectiveSize<N>::value>;
+    
+    /// @brief Create an invalid propagator
+    EigenPropagator();
+    
+    /// @brief Decompose the system matrix
+    EigenPropagator(Matrix const & A, Vector const & b);
+    
+    /**
+     * @brief Whether A is diagonalizable with well-conditioned eigenvectors.
+     * The propagators must not be used otherwise.
+     */
+    bool valid() const;
+    
+    /// @brief Matrix exponential exp(A*duration)
+    Matrix exp(double duration) const;
+    
+    /// @brief Evolution of the magnetization over given duration
+    Vector evolve(Vector const & M, double duration) const;
+    
+    /// @brief Propagator over given duration in projective coordinates
+    Projective projective(double duration) const;
+
+private:
+    using ComplexMatrix = Eigen::Matrix<std::complex<double>, N, N>;
+    using ComplexVector = Eigen::Matrix<std::complex<double>, N, 1>;
+    
+    ComplexVector _eigenvalues;
+    ComplexMatrix _eigenvectors, _inverse_eigenvectors;
+    Vector _AinvB;
+    bool _valid;
+};
+
+/**
+ * @brief Propagator of the affine system dM/dt = A M + b over given duration,
+ * in projective coordinates.
+ */
+template<int N>
+typename EigenPropagator<N>::Projective
+propagator(
+    Eigen::Matrix<double, N, N> const & A, Eigen::Matrix<double, N, 1> const & b,
+    double duration, Solver solver);
+
+/// @brief Evolution of the affine system dM/dt = A M + b over given duration
+template<int N>
+Eigen::Matrix<double, N, 1>
+evolve(
+    Eigen::Matrix<double, N, N> const & A, Eigen::Matrix<double, N, 1> const & b,
+    Eigen::Matrix<double, N, 1> const & M, double duration, Solver solver);
+
+/// @brief Steady state of the affine system dM/dt = A M + b, i.e. -A^-1 b
+template<int N>
+Eigen::Matrix<double, N, 1>
+steady_state(
+    Eigen::Matrix<double, N, N> const & A, Eigen::Matrix<double, N, 1> const & b);
+
+/**
+ * @brief Integer power of a propagator, computed by repeated squaring, i.e.
+ * with O(log(count)) matrix products
+ */
+template<typename Matrix>
+Matrix power(Matrix const & P, std::size_t count);
+
+/**
+ * @brief Fixed point of a propagator in projective coordinates, i.e. the
+ * magnetization M such that P [M, 1] = [M, 1]
+ */
+template<int N>
+Eigen::Matrix<double, N, 1>
+fixed_point(typename EigenPropagator<N>::Projective const & P);
+
+/**
+ * @brief Evolution of the magnetization during a train of count identical
+ * pulses separated by gaps, i.e. Pulse*(Gap*Pulse)^(count-1) M: the
+ * magnetization is given at the end of the last pulse.
+ * @param pulse Propagator of a single pulse, in projective coordinates
+ * @param gap Propagator of the gap between two pulses, in projective
+ * coordinates
+ * @param count Number of pulses, must be positive
+ * @param M Initial magnetization
+ */
+template<int N>
+Eigen::Matrix<double, N, 1>
+pulse_train(
+    typename EigenPropagator<N>::Projective const & pulse,
+    typename EigenPropagator<N>::Projective const & gap, std::size_t count,
+    Eigen::Matrix<double, N, 1> const & M);
+
+/**
+ * @brief Magnetization at the end of a pulse of an infinite train of
+ * identical pulses separated by gaps, i.e. the limit of pulse_train when count
+ * tends to infinity.
+ */
+template<int N>
+Eigen::Matrix<double, N, 1>
+pulsed_steady_state(
+    typename EigenPropagator<N>::Projective const & pulse,
+    typename EigenPropagator<N>::Projective const & gap);
+
+#include "propagator.txx"
+
+#endif // _effb83fd_1d9d_4b43_9cb6_a46e81c8a01e
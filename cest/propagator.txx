@@ -0,0 +1,218 @@
+#ifndef _fed55abf_8798_4d4c_88b0_51136048cbd4
+#define _fed55abf_8798_4d4c_88b0_51136048cbd4
+
+#include "propagator.h"
+
+#include <complex>
+#include <cstddef>
+#include <stdexcept>
+
+#include <Eigen/Core>
+#include <Eigen/Dense>
+#include <unsupported/Eigen/MatrixFunctions>
+
+#include "misc.h"
+
+template<int N>
+EigenPropagator<N>
+::EigenPropagator()
+: _valid(false)
+{
+    // Nothing else.
+}
+
+template<int N>
+EigenPropagator<N>
+::EigenPropagator(Matrix const & A, Vector const & b)
+: _valid(false)
+{
+    Eigen::EigenSolver<Matrix> const solver(A);
+    if(solver.info() != Eigen::Success)
+    {
+        return;
+    }
+    
+    this->_eigenvalues = solver.eigenvalues();
+    this->_eigenvectors = solver.eigenvectors();
+    
+    // A defective (or nearly defective) matrix has (nearly) colinear
+    // eigenvectors: the decomposition cannot be used.
+    Eigen::PartialPivLU<ComplexMatrix> const lu(this->_eigenvectors);
+    if(!(lu.rcond() > 1e-10))
+    {
+        return;
+    }
+    this->_inverse_eigenvectors = lu.inverse();
+    
+    this->_AinvB = A.partialPivLu().solve(b);
+    
+    this->_valid = true;
+}
+
+template<int N>
+bool
+EigenPropagator<N>
+::valid() const
+{
+    return this->_valid;
+}
+
+template<int N>
+typename EigenPropagator<N>::Matrix
+EigenPropagator<N>
+::exp(double duration) const
+{
+    ComplexVector const scale = (this->_eigenvalues * duration).array().exp();
+    return (
+            this->_eigenvectors * scale.asDiagonal()
+            * this->_inverse_eigenvectors
+        ).real();
+}
+
+template<int N>
+typename EigenPropagator<N>::Vector
+EigenPropagator<N>
+::evolve(Vector const & M, double duration) const
+{
+    ComplexVector const scale = (this->_eigenvalues * duration).array().exp();
+    ComplexVector const coordinates =
+        this->_inverse_eigenvectors
+        * (M + this->_AinvB).template cast<std::complex<double>>();
+    return
+        (this->_eigenvectors * scale.cwiseProduct(coordinates)).real()
+        - this->_AinvB;
+}
+
+template<int N>
+typename EigenPropagator<N>::Projective
+EigenPropagator<N>
+::projective(double duration) const
+{
+    auto const size = this->_AinvB.size();
+    auto const E = this->exp(duration);
+    
+    Projective result = Projective::Zero(size+1, size+1);
+    result.topLeftCorner(size, size) = E;
+    result.topRightCorner(size, 1) = E * this->_AinvB - this->_AinvB;
+    result(size, size) = 1;
+    return result;
+}
+
+template<int N>
+typename EigenPropagator<N>::Projective
+propagator(
+    Eigen::Matrix<double, N, N> const & A, Eigen::Matrix<double, N, 1> const & b,
+    double duration, Solver solver)
+{
+    using Projective = typename EigenPropagator<N>::Projective;
+    
+    if(solver == Solver::Eigendecomposition)
+    {
+        EigenPropagator<N> const eigen_propagator(A, b);
+        if(eigen_propagator.valid())
+        {
+            return eigen_propagator.projective(duration);
+        }
+    }
+    
+    auto const size = b.size();
+    Projective dM = Projective::Zero(size+1, size+1);
+    dM.topLeftCorner(size, size) = A;
+    dM.topRightCorner(size, 1) = b;
+    return (dM*duration).exp();
+}
+
+template<int N>
+Eigen::Matrix<double, N, 1>
+evolve(
+    Eigen::Matrix<double, N, N> const & A, Eigen::Matrix<double, N, 1> const & b,
+    Eigen::Matrix<double, N, 1> const & M, double duration, Solver solver)
+{
+    if(solver == Solver::Eigendecomposition)
+    {
+        EigenPropagator<N> const eigen_propagator(A, b);
+        if(eigen_propagator.valid())
+        {
+            return eigen_propagator.evolve(M, duration);
+        }
+    }
+    
+    Eigen::Matrix<double, N, 1> const AinvB = A.partialPivLu().solve(b);
+    return (A*duration).exp() * (M+AinvB) - AinvB;
+}
+
+template<int N>
+Eigen::Matrix<double, N, 1>
+steady_state(
+    Eigen::Matrix<double, N, N> const & A, Eigen::Matrix<double, N, 1> const & b)
+{
+    return -A.partialPivLu().solve(b);
+}
+
+template<typename Matrix>
+Matrix power(Matrix const & P, std::size_t count)
+{
+    Matrix result = Matrix::Identity(P.rows(), P.cols());
+    Matrix square = P;
+    while(count != 0)
+    {
+        if(count % 2 == 1)
+        {
+            result = result * square;
+        }
+        count /= 2;
+        if(count != 0)
+        {
+            square = square * square;
+        }
+    }
+    return result;
+}
+
+template<int N>
+Eigen::Matrix<double, N, 1>
+fixed_point(typename EigenPropagator<N>::Projective const & P)
+{
+    // With P = [[E, t], [0, 1]], the fixed point is the solution of
+    // (I - E) M = t
+    auto const size = P.rows()-1;
+    Eigen::Matrix<double, N, N> const I_minus_E =
+        Eigen::Matrix<double, N, N>::Identity(size, size)
+        - P.topLeftCorner(size, size);
+    return I_minus_E.partialPivLu().solve(P.topRightCorner(size, 1));
+}
+
+template<int N>
+Eigen::Matrix<double, N, 1>
+pulse_train(
+    typename EigenPropagator<N>::Projective const & pulse,
+    typename EigenPropagator<N>::Projective const & gap, std::size_t count,
+    Eigen::Matrix<double, N, 1> const & M)
+{
+    using Projective = typename EigenPropagator<N>::Projective;
+    
+    if(count == 0)
+    {
+        throw std::invalid_argument("Number of pulses must be positive");
+    }
+    
+    auto const size = M.size();
+    Eigen::Matrix<double, ProjectiveSize<N>::value, 1> M_(size+1);
+    M_ << M, 1;
+    Projective const period = gap * pulse;
+    M_ = pulse * (power(period, count-1) * M_);
+    return M_.head(size);
+}
+
+template<int N>
+Eigen::Matrix<double, N, 1>
+pulsed_steady_state(
+    typename EigenPropagator<N>::Projective const & pulse,
+    typename EigenPropagator<N>::Projective const & gap)
+{
+    // Steady state at the end of a pulse: fixed point of the period starting
+    // with the gap
+    return fixed_point<N>(pulse * gap);
+}
+
+#endif // _fed55abf_8798_4d4c_88b0_51136048cbd4
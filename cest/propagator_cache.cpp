@@ -0,0 +1,228 @@
+#include "propagator_cache.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstddef>
+#include <functional>
+#include <initializer_list>
+#include <mutex>
+#include <stdexcept>
+
+#include <Eigen/Core>
+
+#include <pybind11/pybind11.h>
+
+#include "misc.h"
+
+PropagatorCache &
+PropagatorCache
+::instance()
+{
+    static PropagatorCache cache;
+    return cache;
+}
+
+PropagatorCache
+::PropagatorCache(std::size_t capacity, double tolerance)
+: _capacity(capacity), _tolerance(tolerance), _hits(0), _misses(0)
+{
+    this->set_tolerance(tolerance);
+}
+
+std::size_t
+PropagatorCache
+::capacity() const
+{
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    return this->_capacity;
+}
+
+void
+PropagatorCache
+::set_capacity(std::size_t capacity)
+{
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    this->_capacity = capacity;
+    this->_shrink();
+}
+
+double
+PropagatorCache
+::tolerance() const
+{
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    return this->_tolerance;
+}
+
+void
+PropagatorCache
+::set_tolerance(double tolerance)
+{
+    if(tolerance < 0)
+    {
+        throw std::invalid_argument("Tolerance must be positive");
+    }
+    
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    this->_tolerance = tolerance;
+}
+
+std::size_t
+PropagatorCache
+::size() const
+{
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    return this->_items.size();
+}
+
+std::size_t
+PropagatorCache
+::hits() const
+{
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    return this->_hits;
+}
+
+std::size_t
+PropagatorCache
+::misses() const
+{
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    return this->_misses;
+}
+
+void
+PropagatorCache
+::clear()
+{
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    this->_items.clear();
+    this->_index.clear();
+    this->_hits = 0;
+    this->_misses = 0;
+}
+
+double
+PropagatorCache
+::quantize(double w1) const
+{
+    auto const tolerance = this->tolerance();
+    return (tolerance > 0) ? tolerance * std::round(w1/tolerance) : w1;
+}
+
+PropagatorCache::Key
+PropagatorCache
+::key(
+    std::initializer_list<Species> species,
+    std::initializer_list<double> parameters)
+{
+    Key key;
+    key.reserve(4*species.size()+parameters.size());
+    for(auto && item: species)
+    {
+        key.insert(key.end(), {item.T1, item.T2, item.delta_w, item.M0});
+    }
+    key.insert(key.end(), parameters);
+    return key;
+}
+
+Eigen::MatrixXd
+PropagatorCache
+::get(Key const & key, std::function<Eigen::MatrixXd()> const & compute)
+{
+    // NaN never compares equal, so such keys could never be found nor
+    // removed from the index: do not cache them.
+    auto const is_nan = [](double x) { return std::isnan(x); };
+    if(std::any_of(key.begin(), key.end(), is_nan))
+    {
+        {
+            std::lock_guard<std::mutex> const lock(this->_mutex);
+            ++this->_misses;
+        }
+        return compute();
+    }
+    
+    {
+        std::lock_guard<std::mutex> const lock(this->_mutex);
+        
+        auto const iterator = this->_index.find(key);
+        if(iterator != this->_index.end())
+        {
+            // Move the item to the front of the list (most recently used)
+            this->_items.splice(
+                this->_items.begin(), this->_items, iterator->second);
+            ++this->_hits;
+            return iterator->second->second;
+        }
+        
+        ++this->_misses;
+    }
+    
+    // Compute without holding the lock, so that other threads may use the
+    // cache in the meantime.
+    auto const value = compute();
+    
+    std::lock_guard<std::mutex> const lock(this->_mutex);
+    if(this->_capacity > 0 && this->_index.find(key) == this->_index.end())
+    {
+        this->_items.emplace_front(key, value);
+        this->_index[key] = this->_items.begin();
+        this->_shrink();
+    }
+    
+    return value;
+}
+
+std::size_t
+PropagatorCache::Hash
+::operator()(Key const & key) const
+{
+    std::size_t seed = key.size();
+    for(auto && item: key)
+    {
+        // Same combination as boost::hash_combine
+        seed ^= std::hash<double>()(item) + 0x9e3779b9 + (seed<<6) + (seed>>2);
+    }
+    return seed;
+}
+
+void
+PropagatorCache
+::_shrink()
+{
+    while(this->_items.size() > this->_capacity)
+    {
+        this->_index.erase(this->_items.back().first);
+        this->_items.pop_back();
+    }
+}
+
+void propagator_cache(pybind11::module & m)
+{
+    pybind11::class_<PropagatorCache>(
+            m, "PropagatorCache",
+            "Least-recently-used cache of the propagators of shaped pulses")
+        .def_property(
+            "capacity", &PropagatorCache::capacity,
+            &PropagatorCache::set_capacity,
+            "Maximum number of propagators, 0 disables the cache")
+        .def_property(
+            "tolerance", &PropagatorCache::tolerance,
+            &PropagatorCache::set_tolerance,
+            "Quantization step of w1 (rad/s), 0 disables the quantization")
+        .def_property_readonly(
+            "size", &PropagatorCache::size,
+            "Number of propagators currently in the cache")
+        .def_property_readonly(
+            "hits", &PropagatorCache::hits,
+            "Number of propagators found in the cache")
+        .def_property_readonly(
+            "misses", &PropagatorCache::misses,
+            "Number of propagators which had to be computed")
+        .def(
+            "clear", &PropagatorCache::clear,
+            "Remove all propagators and reset the statistics");
+    
+    m.attr("propagator_cache") = pybind11::cast(
+        &PropagatorCache::instance(), pybind11::return_value_policy::reference);
+}
@@ -0,0 +1,100 @@
+#ifndef _11bd1bc0_13b5_41ae_be09_d9ac2051b0c5
+#define _11bd1bc0_13b5_41ae_be09_d9ac2051b0c5
+
+#include <cstddef>
+#include <functional>
+#include <initializer_list>
+#include <list>
+#include <mutex>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+#include <Eigen/Core>
+
+#include <pybind11/pybind11.h>
+
+#include "misc.h"
+
+/**
+ * @brief Least-recently-used cache of propagators, keyed on the parameters of
+ * the simulation. The B1 frequency of the keys may be quantized, so that
+ * close values share the same propagator.
+ */
+class PropagatorCache
+{
+public:
+    using Key = std::vector<double>;
+    
+    /// @brief Cache shared by all simulation functions
+    static PropagatorCache & instance();
+    
+    /**
+     * @brief Create a cache
+     * @param capacity Maximum number of propagators, 0 disables the cache
+     * @param tolerance Quantization step of w1 (rad/s), 0 disables the
+     * quantization
+     */
+    PropagatorCache(std::size_t capacity=1024, double tolerance=0);
+    
+    PropagatorCache(PropagatorCache const &) = delete;
+    PropagatorCache & operator=(PropagatorCache const &) = delete;
+    
+    std::size_t capacity() const;
+    void set_capacity(std::size_t capacity);
+    
+    double tolerance() const;
+    void set_tolerance(double tolerance);
+    
+    /// @brief Number of propagators currently in the cache
+    std::size_t size() const;
+    
+    /// @brief Number of propagators found in the cache
+    std::size_t hits() const;
+    
+    /// @brief Number of propagators which had to be computed
+    std::size_t misses() const;
+    
+    /// @brief Remove all propagators and reset the statistics
+    void clear();
+    
+    /// @brief Quantize a B1 frequency according to the tolerance
+    double quantize(double w1) const;
+    
+    /// @brief Build a key from the species and the simulation parameters
+    static Key key(
+        std::initializer_list<Species> species,
+        std::initializer_list<double> parameters);
+    
+    /**
+     * @brief Return the propagator associated with the key, computing and
+     * storing it if it is not in the cache. Keys containing NaN are never
+     * stored.
+     */
+    Eigen::MatrixXd get(
+        Key const & key, std::function<Eigen::MatrixXd()> const & compute);
+
+private:
+    struct Hash
+    {
+        std::size_t operator()(Key const & key) const;
+    };
+    
+    using Item = std::pair<Key, Eigen::MatrixXd>;
+    
+    std::size_t _capacity;
+    double _tolerance;
+    std::size_t _hits, _misses;
+    
+    /// @brief Items, from most recently used to least recently used
+    std::list<Item> _items;
+    std::unordered_map<Key, std::list<Item>::iterator, Hash> _index;
+    
+    mutable std::mutex _mutex;
+    
+    void _shrink();
+};
+
+void propagator_cache(pybind11::module & m);
+
+#endif // _11bd1bc0_13b5_41ae_be09_d9ac2051b0c5
@@ -1,39 +1,111 @@
 """
 Library of RF pulses. Each pulse function has the same first parameter, i.e. the
-number of steps of the pulse support. The integral of each pulse is normalized
+number of steps of the pulse support. The integral of each pulse is normalized.
+
+The pulses are memoized on their parameters: the returned arrays are shared,
+and thus read-only.
 """
 
+import collections
+import functools
+
 import numpy
 
+def _memoized(function):
+    """ Memoize a pulse function and make its results read-only.
+    """
+    
+    @functools.lru_cache(maxsize=256)
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        y = function(*args, **kwargs)
+        y.flags.writeable = False
+        return y
+    
+    return wrapper
+
+@_memoized
 def block(steps):
     y = numpy.ones(steps)
     return y/y.sum()
-    
+
+@_memoized
 def gaussian(steps, sigma=1, x_max=3.5):
     x = numpy.linspace(-x_max, x_max, steps)
     y = numpy.exp(-(x**2 / (2*sigma**2))) / (sigma * numpy.sqrt(2*numpy.pi))
     return y/y.sum()
 
+@_memoized
 def sinc(steps, side_lobes=2):
     x = numpy.linspace(-side_lobes-1, +side_lobes+1, steps)
     y = numpy.sinc(x)
     return y/y.sum()
 
+@_memoized
 def sech(steps, x_max=10):
     x = numpy.linspace(-1, +1, steps)
     y = 1/numpy.cosh(x_max * x)
     return y/y.sum()
 
 def train(pulse, count, gap_steps):
-    y = numpy.empty(count*len(pulse)+(count-1)*gap_steps)
-    begin = 0
-    for i in range(count-1):
-        y[begin:begin+len(pulse)] = pulse
-        begin += len(pulse)
-        
-        y[begin:begin+gap_steps] = 0
-        begin += gap_steps
+    # Arrays are not hashable: memoize on the content of the pulse
+    pulse = numpy.asarray(pulse, float)
+    return _train(pulse.tobytes(), count, gap_steps)
+
+@_memoized
+def _train(pulse, count, gap_steps):
+    pulse = numpy.frombuffer(pulse)
     
-    y[-len(pulse):] = pulse
+    # Repeat the period (pulse and gap), without the last gap
+    period = numpy.concatenate([pulse, numpy.zeros(gap_steps)])
+    y = numpy.tile(period, count)[:count*len(period)-gap_steps]
     
     return y/y.sum()
+
+def resample(pulse, steps):
+    """ Resample a pulse on a support of given number of steps, using linear
+        interpolation, and normalize its integral.
+    """
+    
+    pulse = numpy.asarray(pulse, float)
+    return _resample(pulse.tobytes(), steps)
+
+@_memoized
+def _resample(pulse, steps):
+    pulse = numpy.frombuffer(pulse)
+    y = numpy.interp(
+        numpy.linspace(0, 1, steps), numpy.linspace(0, 1, len(pulse)), pulse)
+    return y/y.sum()
+
+Metadata = collections.namedtuple(
+    "Metadata",
+    ["integral", "power_integral", "duty_cycle", "amplitudes", "run_lengths"])
+Metadata.__doc__ = """ Metadata of a pulse, in units of steps: integral and
+    power integral (i.e. integral of the squared pulse), ratio of steps with a
+    non-zero amplitude, and run-length encoding of the pulse, i.e. amplitudes
+    of consecutive steps and number of repetitions of each amplitude.
+"""
+
+def metadata(pulse):
+    """ Return the metadata of a pulse. The metadata of the most recent pulses
+        are memoized.
+    """
+    
+    pulse = numpy.asarray(pulse, float)
+    return _metadata(pulse.tobytes())
+
+@functools.lru_cache(maxsize=256)
+def _metadata(pulse):
+    pulse = numpy.frombuffer(pulse)
+    
+    # Start of each run of identical amplitudes
+    starts = numpy.flatnonzero(
+        numpy.concatenate([[True], pulse[1:] != pulse[:-1]]))
+    amplitudes = pulse[starts]
+    run_lengths = numpy.diff(numpy.append(starts, len(pulse)))
+    for array in [amplitudes, run_lengths]:
+        array.flags.writeable = False
+    
+    return Metadata(
+        pulse.sum(), numpy.square(pulse).sum(),
+        numpy.count_nonzero(pulse)/len(pulse), amplitudes, run_lengths)
@@ -1,5 +1,10 @@
+from .batch import run_batch
+from .dictionary import Dictionary
 from .edit_spectrum import EditSpectrum
+from .fingerprinting import Fingerprinting
+from .lorentzian_fit import LorentzianFit
 from .mtr import MTR
+from .pipeline import Pipeline
 from .refine import Refine
 from .shift_spectrum import ShiftSpectrum
 from .wassr import WASSR
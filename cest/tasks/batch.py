@@ -0,0 +1,276 @@
+import collections
+import concurrent.futures
+import multiprocessing.shared_memory
+import os
+import re
+import subprocess
+
+import nibabel
+import numpy
+import spire
+
+from . import utils
+
+def run_batch(tasks=None, workers=None, memory=None, shared=None):
+    """
+    Run tasks in a pool of processes, e.g. the processing chains of all the
+    subjects of a cohort. A task is started once the tasks creating its
+    dependencies are done, and is skipped if its targets are newer than its
+    dependencies.
+    
+    Read-only images used across subjects, e.g. a common mask, are loaded in
+    shared memory before the first task using them is started, are read from
+    there by the tasks instead of from the disk (cf. utils.load), and are
+    released once the last task using them is done.
+    
+    Parameters
+    ----------
+    tasks : sequence of spire.TaskFactory, optional
+        Tasks to run, defaults to all the tasks created so far. The actions of
+        the tasks must be picklable, i.e. not lambdas.
+    workers : int, optional
+        Number of processes, defaults to the number of processors
+    memory : int, optional
+        Memory budget, in bytes: a task is not started while the estimated
+        memory of the running tasks (the size of their source images) and of
+        the images currently in shared memory would exceed it. Sizes are
+        estimated as double-precision values. A task is always started if no
+        other task is running. Defaults to no limit.
+    shared : sequence of path_like, optional
+        Images loaded in shared memory, defaults to the images which exist
+        before the batch is run and are used by tasks whose targets are in
+        different directories, i.e. by several subjects
+    """
+    
+    if tasks is None:
+        tasks = spire.TaskFactory._task_registry
+    tasks = [x for x in tasks if not getattr(x, "skipped", False)]
+    workers = workers or os.cpu_count()
+    
+    # Tasks creating each target, and tasks required by each task
+    producers = {
+        os.path.realpath(target): index
+        for index, task in enumerate(tasks) for target in task.targets}
+    dependencies = [
+        {
+            producers[os.path.realpath(x)] for x in task.file_dep
+            if os.path.realpath(x) in producers}
+        for task in tasks]
+    
+    if shared is None:
+        # Directories of the targets of the tasks using each source image:
+        # images used by a single subject are not worth keeping in memory.
+        directories = collections.defaultdict(set)
+        for task in tasks:
+            for path in {os.path.realpath(x) for x in task.file_dep}:
+                if path not in producers:
+                    directories[path].update(
+                        os.path.dirname(os.path.realpath(x))
+                        for x in task.targets)
+        shared = [
+            x for x, y in directories.items()
+            if len(y) > 1 and _is_image(x) and os.path.isfile(x)]
+    shared = {os.path.realpath(x) for x in shared}
+    
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        _schedule(executor, tasks, dependencies, workers, memory, shared)
+
+def _schedule(executor, tasks, dependencies, workers, memory, shared):
+    """ Submit the tasks to the executor as soon as their dependencies are
+        done, within the memory budget. The shared images are loaded before
+        their first user is submitted and released after their last user is
+        done.
+    """
+    
+    # Shared images used by each task, and tasks using each shared image
+    uses = [
+        {os.path.realpath(x) for x in task.file_dep} & shared
+        for task in tasks]
+    users = {
+        path: {index for index, x in enumerate(uses) if path in x}
+        for path in shared}
+    
+    # Shared images currently in memory, as (segment, descriptor, size)
+    segments = {}
+    
+    pending = set(range(len(tasks)))
+    done = set()
+    running = {}
+    used = 0
+    error = None
+    
+    def release(index):
+        """ Release the shared images which are not used anymore. """
+        
+        nonlocal used
+        for path in uses[index]:
+            users[path].discard(index)
+            if not users[path] and path in segments:
+                segment, _, size = segments.pop(path)
+                segment.close()
+                segment.unlink()
+                used -= size
+    
+    try:
+        while running or (pending and error is None):
+            if error is None:
+                ready = [
+                    x for x in sorted(pending) if dependencies[x] <= done]
+                if not ready and not running:
+                    raise Exception(
+                        "Circular dependencies between tasks: "
+                        f"{[tasks[x].basename for x in pending]}")
+                for index in ready:
+                    if len(running) == workers:
+                        break
+                    
+                    if _is_up_to_date(tasks[index]):
+                        pending.remove(index)
+                        done.add(index)
+                        release(index)
+                        continue
+                    
+                    missing = {
+                        x: _size(x) for x in uses[index] if x not in segments}
+                    cost = _memory(tasks[index], shared)
+                    if (
+                            running and memory is not None
+                            and used+cost+sum(missing.values()) > memory):
+                        continue
+                    
+                    for path, size in missing.items():
+                        segments[path] = (*_share(path), size)
+                        used += size
+                    
+                    pending.remove(index)
+                    future = executor.submit(
+                        _run, tasks[index].actions,
+                        [segments[x][1] for x in uses[index]])
+                    running[future] = (index, cost)
+                    used += cost
+                
+                # Up-to-date tasks may have made other tasks ready
+                if not running:
+                    continue
+            
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                index, cost = running.pop(future)
+                used -= cost
+                release(index)
+                try:
+                    future.result()
+                except Exception as e:
+                    if error is None:
+                        error = Exception(
+                            f"Task {tasks[index].basename} failed: {e}")
+                        error.__cause__ = e
+                else:
+                    done.add(index)
+    finally:
+        for segment, _, _ in segments.values():
+            segment.close()
+            segment.unlink()
+    
+    if error is not None:
+        raise error
+
+def _share(path):
+    """ Load an image in a new shared memory segment, return the segment and
+        the descriptor used by the workers to attach to it.
+    """
+    
+    image = nibabel.load(path)
+    data = numpy.asarray(image.dataobj)
+    segment = multiprocessing.shared_memory.SharedMemory(
+        create=True, size=max(data.nbytes, 1))
+    numpy.ndarray(data.shape, data.dtype, segment.buf)[...] = data
+    descriptor = (
+        path, segment.name, data.shape, data.dtype.str, image.affine)
+    return segment, descriptor
+
+def _run(actions, descriptors):
+    """ Run the actions of a task, in a worker process, with the given images
+        in shared memory.
+    """
+    
+    _attach(descriptors)
+    try:
+        for action in actions:
+            if isinstance(action, str):
+                subprocess.run(action, shell=True, check=True)
+            elif isinstance(action, list):
+                subprocess.run([str(x) for x in action], check=True)
+            else:
+                function, args, *kwargs = action
+                if function(*args, **(kwargs[0] if kwargs else {})) is False:
+                    raise Exception(f"{function.__qualname__} failed")
+    finally:
+        _detach(descriptors)
+
+def _attach(descriptors):
+    """ Make the images in shared memory available to utils.load, in a worker
+        process.
+    """
+    
+    for path, name, shape, dtype, affine in descriptors:
+        # The segment is unlinked by the parent process, which shares its
+        # resource tracker with the workers
+        segment = multiprocessing.shared_memory.SharedMemory(name)
+        data = numpy.ndarray(shape, dtype, segment.buf)
+        data.flags.writeable = False
+        image = nibabel.Nifti1Image(data, affine)
+        # Keep the segment open as long as the image is used
+        image.segment = segment
+        utils._shared_images[path] = image
+
+def _detach(descriptors):
+    """ Remove the images in shared memory from utils.load, and unmap them, in
+        a worker process.
+    """
+    
+    for path, *_ in descriptors:
+        image = utils._shared_images.pop(path)
+        segment = image.segment
+        del image
+        try:
+            segment.close()
+        except BufferError:
+            # The data is still referenced: the segment is unmapped when the
+            # reference is collected
+            pass
+
+def _is_image(path):
+    """ Test whether a path is a NIfTI image.
+    """
+    
+    return re.search(r"\.nii(\.gz)?$", str(path)) is not None
+
+def _is_up_to_date(task):
+    """ Test whether all the targets of a task exist and are newer than its
+        dependencies.
+    """
+    
+    if not task.targets or not all(os.path.exists(x) for x in task.targets):
+        return False
+    if not all(os.path.exists(x) for x in task.file_dep):
+        return False
+    oldest_target = min(os.path.getmtime(x) for x in task.targets)
+    return all(os.path.getmtime(x) <= oldest_target for x in task.file_dep)
+
+def _memory(task, shared):
+    """ Estimated memory of a task: size of its source images which are not
+        shared.
+    """
+    
+    return sum(
+        _size(x) for x in task.file_dep
+        if _is_image(x) and os.path.isfile(x)
+            and os.path.realpath(x) not in shared)
+
+def _size(path):
+    """ Estimated memory of an image, as double-precision values.
+    """
+    
+    return 8*int(numpy.prod(nibabel.load(path).shape))
@@ -0,0 +1,149 @@
+import json
+import pathlib
+
+import numpy
+import spire
+
+from .. import _cest
+from . import utils
+
+class Dictionary(spire.TaskFactory):
+    """Pre-compute a dictionary of Z-spectra simulated with the two-pools
+    Bloch-McConnell model, over the Cartesian product of the model parameters,
+    for CEST fingerprinting. The saturation is a block pulse, starting from
+    the equilibrium magnetization.
+    
+    The Z-spectra are stored as a memory-mapped, single-precision numpy array
+    in dictionary, with one dimension per parameter followed by the frequency
+    offsets. The parameter values and the frequency offsets are stored in the
+    index, a JSON file next to the dictionary (``name.npy`` →
+    ``name.index.json``).
+    
+    Parameters
+    ----------
+    
+    dictionary : path-like
+        Path to the target dictionary, usually with a ``.npy`` suffix
+    ppm : path-like or array
+        Frequency offsets of the Z-spectra. If path-like, the values will be
+        loaded from the meta-data at this path.
+    Cb : array_like
+        Transition rates from the solute pool to water (Hz)
+    M0_b : array_like
+        Equilibrium magnetizations of the solute pool, relative to water
+    T1_a, T2_a : array_like
+        Relaxation times of water (s)
+    B0 : array_like, optional
+        Frequency shifts of the whole spectrum caused by B0 inhomogeneities
+        (ppm), defaults to no shift
+    B1 : array_like, optional
+        Relative amplitudes of the RF pulse, defaults to the nominal
+        amplitude
+    T1_b, T2_b : float, optional
+        Relaxation times of the solute pool (s)
+    delta_w_b : float, optional
+        Chemical shift of the solute pool (ppm), defaults to amides
+    field : float, optional
+        Main magnetic field (T)
+    w1 : float, optional
+        Nominal frequency of the B1 field of the RF pulse (rad/s)
+    duration : float, optional
+        Duration of the RF pulse (s)
+    
+    Returns
+    -------
+    
+    tuple
+        Dictionary, as an array, and index, only applicable when used as a
+        function.
+    """
+    
+    # Order of the parameters in the dictionary
+    parameters = ["T1_a", "T2_a", "M0_b", "Cb", "B1", "B0"]
+    
+    def __init__(
+            self, dictionary, ppm, Cb, M0_b, T1_a, T2_a, B0=(0,), B1=(1,),
+            T1_b=1., T2_b=10e-3, delta_w_b=3.5, field=3., w1=2*numpy.pi*100,
+            duration=2.):
+        spire.TaskFactory.__init__(self, str(dictionary))
+        self.file_dep = (
+            [ppm] if isinstance(ppm, (str, pathlib.Path)) else [])
+        self.targets = [dictionary, __class__.index_path(dictionary)]
+        self.actions = [(
+            __class__.action, (
+                dictionary, ppm, Cb, M0_b, T1_a, T2_a, B0, B1, T1_b, T2_b,
+                delta_w_b, field, w1, duration))]
+    
+    @staticmethod
+    def action(
+            dictionary, ppm, Cb, M0_b, T1_a, T2_a, B0=(0,), B1=(1,), T1_b=1.,
+            T2_b=10e-3, delta_w_b=3.5, field=3., w1=2*numpy.pi*100,
+            duration=2.):
+        if isinstance(ppm, (str, pathlib.Path)):
+            ppm = utils.get_ppm(ppm)
+        ppm = numpy.asarray(ppm, float)
+        
+        grid = {
+            name: numpy.atleast_1d(numpy.asarray(values, float))
+            for name, values in zip(
+                __class__.parameters, [T1_a, T2_a, M0_b, Cb, B1, B0])}
+        w0 = 2.6752218708e8*field
+        
+        atoms = numpy.lib.format.open_memmap(
+            dictionary, "w+", numpy.float32,
+            (*[len(x) for x in grid.values()], len(ppm)))
+        
+        # Simulate all solute pools and relaxation times of water at once;
+        # the B0 shifts change the RF offsets, and are simulated separately.
+        species_b = [
+            _cest.Species(T1_b, T2_b, delta_w_b, x) for x in grid["M0_b"]]
+        for index, T1 in enumerate(grid["T1_a"]):
+            species_a = [_cest.Species(T1, x, 0, 1) for x in grid["T2_a"]]
+            for shift_index, shift in enumerate(grid["B0"]):
+                magnetization = _cest.bm_sweep(
+                    species_a, species_b, grid["Cb"], w0, ppm-shift,
+                    grid["B1"]*w1, duration)
+                # Remove the duration dimension, keep Mza
+                atoms[index, ..., shift_index, :] = magnetization[
+                    :, :, :, :, 0, :, 2]
+        atoms.flush()
+        
+        index = {
+            "ppm": ppm.tolist(),
+            "parameters": {k: v.tolist() for k, v in grid.items()}}
+        with open(__class__.index_path(dictionary), "w") as fd:
+            json.dump(index, fd)
+        
+        return atoms, index
+    
+    @staticmethod
+    def index_path(dictionary):
+        """ Path to the index of a dictionary.
+        """
+        
+        return pathlib.Path(dictionary).with_suffix(".index.json")
+    
+    @staticmethod
+    def load(dictionary):
+        """ Load a dictionary as a read-only memory-mapped array, and its
+            index.
+            
+            Parameters
+            ----------
+            
+            dictionary : path-like
+                Path to the dictionary
+            
+            Returns
+            -------
+            
+            tuple
+                Z-spectra of the dictionary, with one dimension per parameter,
+                and index, with the frequency offsets ("ppm") and the values
+                of each parameter ("parameters")
+        """
+        
+        atoms = numpy.load(dictionary, mmap_mode="r")
+        with open(__class__.index_path(dictionary)) as fd:
+            index = json.load(fd)
+        return atoms, index
@@ -1,6 +1,5 @@
 import json
 
-import nibabel
 import numpy
 import spire
 
@@ -10,11 +9,12 @@ from . import utils
 def EditSpectrum(
         source_image: spire.file_dep, source_meta_data: spire.file_dep,
         operations,
-        target_image: spire.target, target_meta_data: spire.target):
-    source_image = nibabel.load(source_image)
-    data = numpy.asarray(source_image.dataobj)
+        target_image: spire.target, target_meta_data: spire.target,
+        chunk_size=None):
     ppm = utils.get_ppm(source_meta_data)
     
+    # Indices of the volumes to keep
+    volumes = numpy.arange(len(ppm))
     for name, *operands in operations:
         if name == "range":
             (low, high), inclusion = operands
@@ -25,11 +25,13 @@ def EditSpectrum(
                 selector = ~selector
             
             ppm = ppm[selector]
-            data = data[..., selector]
+            volumes = volumes[selector]
         else:
             raise Exception(f"Unknown operation {name!r}")
     
-    nibabel.save(nibabel.Nifti1Image(data, source_image.affine), target_image)
+    utils.stream(
+        lambda data: data[..., volumes], [utils.load(source_image)],
+        target_image, chunk_size)
     
     with open(target_meta_data, "w") as fd:
         json.dump({"SaturationPulse": [{"FrequencyOffset": x} for x in ppm]}, fd)
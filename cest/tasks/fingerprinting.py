@@ -0,0 +1,158 @@
+import numpy
+import spire
+
+from . import utils
+from .dictionary import Dictionary
+
+class Fingerprinting(spire.TaskFactory):
+    """Estimate the Bloch-McConnell parameters of each voxel by matching its
+    Z-spectrum to the closest item of a dictionary (cf. Dictionary), using
+    the normalized inner product.
+    
+    Parameters
+    ----------
+    
+    image : path_like
+        Path to the source Z-spectrum image
+    meta_data : path_like
+        Path to the meta-data related to the source image. The frequency
+        offsets of the dictionary must be in the image.
+    dictionary : path_like
+        Path to the dictionary
+    estimates : path_like
+        Path to the target image, with one volume per parameter of the
+        dictionary, in the order of Dictionary.parameters, followed by the
+        normalized inner product of the match. Voxels whose Z-spectrum is
+        null or has missing values get NaN estimates.
+    mask : path_like, optional
+        Path to a mask image: only the voxels inside the mask are processed,
+        the other voxels are set to 0
+    chunk_size : int, optional
+        Approximate number of voxels loaded in memory at once, defaults to
+        the whole image
+    workers : int, optional
+        Number of threads, defaults to the number of processors
+    
+    Each thread compares chunks of spectra_batch_size voxels to batches of
+    atoms_batch_size items of the dictionary: with the default values, the
+    inner products use 2048*8192*4 bytes = 64 MiB per thread, in addition
+    to the slab of the image and to the dictionary, which is memory-mapped.
+    
+    References
+    ----------
+    
+    *Magnetic resonance fingerprinting*, Ma et al., Nature 495, 2013.
+    `doi:10.1038/nature11971 <https://doi.org/10.1038/nature11971>`_.
+    """
+    
+    # Number of Z-spectra and of items of the dictionary compared at once by
+    # each thread
+    spectra_batch_size = 2048
+    atoms_batch_size = 8192
+    
+    def __init__(
+            self, image, meta_data, dictionary, estimates, mask=None,
+            chunk_size=None, workers=None):
+        spire.TaskFactory.__init__(self, str(estimates))
+        self.file_dep = [
+            image, meta_data, dictionary, Dictionary.index_path(dictionary),
+            *([mask] if mask else [])]
+        self.targets = [estimates]
+        self.actions = [(
+            __class__.action, (
+                image, meta_data, dictionary, estimates, mask, chunk_size,
+                workers))]
+    
+    @staticmethod
+    def action(
+            image, meta_data, dictionary, estimates, mask=None,
+            chunk_size=None, workers=None):
+        ppm = utils.get_ppm(meta_data)
+        atoms, index = Dictionary.load(dictionary)
+        
+        # Volumes of the image matching the frequency offsets of the dictionary
+        offsets = numpy.asarray(index["ppm"])
+        order = numpy.abs(ppm[:, None] - offsets).argmin(axis=0)
+        missing = ~numpy.isclose(ppm[order], offsets)
+        if numpy.any(missing):
+            raise Exception(
+                f"Frequencies not in the Z-spectrum: {offsets[missing]}")
+        
+        grid = [
+            numpy.asarray(index["parameters"][x])
+            for x in Dictionary.parameters]
+        atoms = atoms.reshape(-1, atoms.shape[-1])
+        
+        def estimate(spectra):
+            best, score = __class__.match(
+                spectra[:, order], atoms, __class__.atoms_batch_size)
+            
+            # Spectra which do not match any item have no estimates
+            matched = best >= 0
+            positions = numpy.unravel_index(
+                best[matched], [len(x) for x in grid])
+            result = numpy.full((len(spectra), len(grid)+1), numpy.nan)
+            for index, (values, position) in enumerate(zip(grid, positions)):
+                result[matched, index] = values[position]
+            result[:, -1] = score
+            return result
+        
+        utils.stream(
+            lambda data, mask=None: utils.map_voxels(
+                estimate, data, __class__.spectra_batch_size, workers, mask),
+            [utils.load(x) for x in [image, *([mask] if mask else [])]],
+            estimates, chunk_size)
+    
+    @staticmethod
+    def match(spectra, atoms, batch_size=8192):
+        """ Return the item of the dictionary closest to each Z-spectrum, i.e.
+            with the largest normalized inner product.
+            
+            Parameters
+            ----------
+            
+            spectra : array
+                Z-spectra, with a shape of (n, m)
+            atoms : array
+                Z-spectra of the dictionary, with a shape of (p, m), e.g. a
+                memory-mapped array
+            batch_size : int, optional
+                Number of items of the dictionary compared at once, the peak
+                memory being 4*n*batch_size bytes
+            
+            Returns
+            -------
+            
+            tuple of arrays
+                Index of the closest item of the dictionary and normalized
+                inner product, for each Z-spectrum. Null Z-spectra or
+                Z-spectra with missing values do not match any item: their
+                index is -1 and their inner product is NaN.
+        """
+        
+        spectra = numpy.asarray(spectra, numpy.float32)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            spectra = spectra / numpy.linalg.norm(spectra, axis=1)[:, None]
+        
+        best = numpy.full(len(spectra), -1)
+        score = numpy.full(len(spectra), -numpy.inf, numpy.float32)
+        for start in range(0, len(atoms), batch_size):
+            batch = numpy.asarray(atoms[start:start+batch_size], numpy.float32)
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                batch = batch / numpy.linalg.norm(batch, axis=1)[:, None]
+            
+            # Inner products, shape is (n, batch_size), in single precision.
+            # Null spectra or atoms yield NaN: discard them without copy.
+            products = spectra @ batch.T
+            numpy.nan_to_num(products, copy=False, nan=-numpy.inf)
+            batch_best = numpy.argmax(products, axis=1)
+            batch_score = products[numpy.arange(len(spectra)), batch_best]
+            
+            better = batch_score > score
+            best[better] = start + batch_best[better]
+            score[better] = batch_score[better]
+        
+        # Null spectra, e.g. outside of the object, do not match any item
+        score[best < 0] = numpy.nan
+        
+        return best, score
@@ -0,0 +1,255 @@
+import pathlib
+
+import numpy
+import spire
+
+from . import utils
+
+class LorentzianFit(spire.TaskFactory):
+    """Fit a sum of Lorentzian lines to each Z-spectrum, i.e.
+    Z(x) = Z_0 - Σ A/(1+4((x-δ)/Γ)²), where each pool (water, MT, amide,
+    ...) has an amplitude A, a full width at half maximum Γ (ppm) and an
+    offset δ (ppm).
+    
+    The voxels of each slice are fitted at once by a batched
+    Levenberg-Marquardt algorithm, starting from the estimates of the same
+    voxel in the previous slice, or from the initial values of the pools if
+    this voxel was not fitted.
+    
+    Parameters
+    ----------
+    
+    z_spectrum : path-like
+        Path to the source normalized Z-spectrum image
+    ppms : path-like or array
+        PPM values of the z-spectrum. If path-like, the values will be loaded
+        from the path.
+    estimates : path-like
+        Path to the target image, with the amplitude, width and offset of each
+        pool, in the order of pools, followed by Z_0 and the RMS of the
+        residuals
+    pools : sequence of str or dict, optional
+        Names of the pools, taken from LorentzianFit.pools, or dictionary
+        mapping the name of each pool to its initial values, lower bounds and
+        upper bounds, each given as (amplitude, width, offset). Defaults to
+        all the pools of LorentzianFit.pools.
+    mask : path-like, optional
+        Path to a mask image: only the voxels inside the mask are processed,
+        the other voxels are set to 0
+    chunk_size : int, optional
+        Approximate number of voxels loaded in memory at once, defaults to
+        the whole image
+    workers : int, optional
+        Number of threads, defaults to the number of processors
+    
+    References
+    ----------
+    
+    *Relaxation-compensated CEST-MRI of the human brain at 7T: Unbiased
+    insight into NOE and amide signal changes*, Zaiss et al., NeuroImage 112,
+    2015. `doi:10.1016/j.neuroimage.2015.02.040 \
+    <https://doi.org/10.1016/j.neuroimage.2015.02.040>`_.
+    """
+    
+    # Initial values, lower bounds and upper bounds of the amplitude, width
+    # (ppm) and offset (ppm) of the usual pools at 3 T
+    pools = {
+        "water": ((0.9, 1.4, 0), (0.02, 0.3, -1), (1, 10, 1)),
+        "MT": ((0.1, 25, -2), (0, 10, -4), (1, 100, 4)),
+        "NOE": ((0.02, 3, -3.5), (0, 1, -4.5), (0.4, 5, -2)),
+        "amide": ((0.025, 0.5, 3.5), (0, 0.4, 3), (0.2, 3, 4)),
+        "amine": ((0.01, 1.5, 2.2), (0, 0.5, 1), (0.2, 5, 3))}
+    
+    # Initial value, lower bound and upper bound of Z_0
+    baseline = (1, 0.5, 1.5)
+    
+    def __init__(
+            self, z_spectrum, ppms, estimates, pools=None, mask=None,
+            chunk_size=None, workers=None):
+        spire.TaskFactory.__init__(self, str(estimates))
+        self.file_dep = [
+            z_spectrum,
+            *([ppms] if isinstance(ppms, (str, pathlib.Path)) else []),
+            *([mask] if mask else [])]
+        self.targets = [estimates]
+        self.actions = [(
+            __class__.action, (
+                z_spectrum, ppms, estimates, pools, mask, chunk_size,
+                workers))]
+    
+    @staticmethod
+    def action(
+            z_spectrum, ppms, estimates, pools=None, mask=None,
+            chunk_size=None, workers=None):
+        if isinstance(ppms, (str, pathlib.Path)):
+            ppms = utils.get_ppm(ppms)
+        ppms = numpy.asarray(ppms, float)
+        
+        if pools is None:
+            pools = __class__.pools
+        if not isinstance(pools, dict):
+            unknown = [x for x in pools if x not in __class__.pools]
+            if unknown:
+                raise Exception(f"Unknown pools: {unknown}")
+            pools = {x: __class__.pools[x] for x in pools}
+        
+        # Parameters as [A_1, Γ_1, δ_1, ..., A_n, Γ_n, δ_n, Z_0]
+        initial, lower, upper = [
+            numpy.array(
+                [y for x in pools.values() for y in x[index]]
+                +[__class__.baseline[index]],
+                float)
+            for index in range(3)]
+        
+        # Estimates of the previous slice, carried over the slabs
+        previous = None
+        
+        def fit_slab(data, mask=None):
+            nonlocal previous
+            
+            data = numpy.asarray(data, float)
+            if mask is None:
+                mask = numpy.ones(data.shape[:3], bool)
+            mask = numpy.asarray(mask).astype(bool)
+            
+            result = numpy.zeros((*data.shape[:3], len(initial)+1))
+            for slice_ in range(data.shape[2]):
+                start = numpy.broadcast_to(
+                    initial, (*data.shape[:2], len(initial))).copy()
+                if previous is not None:
+                    start[previous[1]] = previous[0][previous[1]]
+                
+                result[:, :, slice_] = utils.map_voxels(
+                    lambda spectra, start: numpy.column_stack(
+                        __class__.fit(ppms, spectra, start, lower, upper)),
+                    [data[:, :, slice_], start], workers=workers,
+                    mask=mask[:, :, slice_])
+                
+                fitted = result[:, :, slice_, :-1]
+                previous = (
+                    fitted,
+                    mask[:, :, slice_] & numpy.isfinite(fitted).all(axis=-1))
+            
+            return result
+        
+        utils.stream(
+            fit_slab,
+            [utils.load(x) for x in [z_spectrum, *([mask] if mask else [])]],
+            estimates, chunk_size)
+    
+    @staticmethod
+    def model(ppms, parameters):
+        """ Sum of Lorentzian lines and its Jacobian.
+        
+            Parameters
+            ----------
+            
+            ppms : array
+                Frequency offsets, with a shape of (m, )
+            parameters : array
+                Parameters, as [A_1, Γ_1, δ_1, ..., A_n, Γ_n, δ_n, Z_0], with
+                a shape of (n, 3*pools+1)
+            
+            Returns
+            -------
+            
+            tuple of arrays
+                Z-spectra, with a shape of (n, m), and Jacobian with a shape
+                of (n, m, 3*pools+1)
+        """
+        
+        A, width, offset = [
+            parameters[:, index:-1:3, None] for index in range(3)]
+        u = (ppms-offset)/width
+        L = 1/(1+4*u**2)
+        
+        Z = parameters[:, -1, None] - (A*L).sum(axis=1)
+        
+        J = numpy.empty((*Z.shape, parameters.shape[1]))
+        dL_du = -8*u*L**2
+        J[..., 0:-1:3] = numpy.moveaxis(-L, 1, 2)
+        J[..., 1:-1:3] = numpy.moveaxis(A*dL_du*u/width, 1, 2)
+        J[..., 2:-1:3] = numpy.moveaxis(A*dL_du/width, 1, 2)
+        J[..., -1] = 1
+        
+        return Z, J
+    
+    @staticmethod
+    def fit(ppms, spectra, initial, lower, upper, iterations=100):
+        """ Batched Levenberg-Marquardt fit of the sum of Lorentzian lines to
+            each Z-spectrum: all the spectra are updated at once, each one
+            with its own damping factor, until it converges.
+            
+            Parameters
+            ----------
+            
+            ppms : array
+                Frequency offsets, with a shape of (m, )
+            spectra : array
+                Z-spectra, with a shape of (n, m)
+            initial : array
+                Initial parameters, with a shape of (n, p) or (p, ), cf. model
+            lower, upper : array
+                Bounds of the parameters, with a shape of (p, )
+            iterations : int, optional
+                Maximum number of iterations
+            
+            Returns
+            -------
+            
+            tuple of arrays
+                Parameters, with a shape of (n, p), and RMS of the residuals
+        """
+        
+        spectra = numpy.asarray(spectra, float)
+        parameters = numpy.clip(
+            numpy.broadcast_to(initial, (len(spectra), len(lower))),
+            lower, upper)
+        
+        Z, J = __class__.model(ppms, parameters)
+        cost = 0.5*((Z-spectra)**2).sum(axis=1)
+        damping = numpy.full(len(spectra), 1e-3)
+        active = numpy.isfinite(cost)
+        
+        for _ in range(iterations):
+            index = numpy.flatnonzero(active)
+            if len(index) == 0:
+                break
+            
+            # Damped normal equations of the active spectra
+            J_ = J[index]
+            H = numpy.einsum("nmi,nmj->nij", J_, J_)
+            gradient = numpy.einsum("nmi,nm->ni", J_, Z[index]-spectra[index])
+            diagonal = numpy.maximum(
+                numpy.diagonal(H, axis1=1, axis2=2), 1e-12)
+            damped = H + damping[index, None, None]*(
+                diagonal[:, :, None]*numpy.eye(H.shape[1]))
+            step = numpy.linalg.solve(damped, -gradient[..., None])[..., 0]
+            
+            candidate = numpy.clip(parameters[index]+step, lower, upper)
+            step = candidate - parameters[index]
+            Z_new, J_new = __class__.model(ppms, candidate)
+            cost_new = 0.5*((Z_new-spectra[index])**2).sum(axis=1)
+            
+            better = cost_new < cost[index]
+            accepted = index[better]
+            decrease = cost[accepted]-cost_new[better]
+            parameters[accepted] = candidate[better]
+            Z[accepted] = Z_new[better]
+            J[accepted] = J_new[better]
+            cost[accepted] = cost_new[better]
+            damping[accepted] /= 10
+            damping[index[~better]] *= 10
+            
+            # Stop on small decrease, small step, or large damping
+            step_norm = numpy.linalg.norm(step, axis=1)
+            converged = (
+                (step_norm <= 1e-10*numpy.linalg.norm(candidate, axis=1))
+                | (damping[index] >= 1e10))
+            converged[better] |= decrease <= 1e-12*cost[accepted]
+            active[index[converged]] = False
+        
+        # Spectra with missing values are not fitted
+        parameters[~numpy.isfinite(cost)] = numpy.nan
+        
+        return parameters, numpy.sqrt(2*cost/spectra.shape[1])
@@ -8,7 +8,7 @@ from . import utils
 
 class MTR(spire.TaskFactory):
     """Compute an MTR map.
-        
+    
     Parameters
     ----------
     
@@ -24,12 +24,25 @@ class MTR(spire.TaskFactory):
     normalization : string, optional
         Normalization method, must be one of *asym*, *normref* (default 
         value), *pcm*, *rex*
+    offsets : array_like, optional
+        Frequency offsets at which the MTR is computed, e.g. [3.5, 2, -3.5]:
+        the label and reference frequencies of each offset must be in ppms.
+        Defaults to all the non-negative frequency offsets.
+    dtype : data-type, optional
+        Type of the MTR data, defaults to double precision
+    mask : path-like or image or array, optional
+        Mask of the voxels to process, the other voxels are set to 0. It must
+        be path-like if used as a task.
+    chunk_size : int, optional
+        Approximate number of voxels loaded in memory at once when saving to
+        mtr, defaults to the whole image
     
     Returns
     -------
     
     array or image
-        MTR data, only applicable when used as a function.
+        MTR data, with one volume per offset, only applicable when used as a
+        function.
     
     References
     ----------
@@ -39,54 +52,136 @@ class MTR(spire.TaskFactory):
     stroke*. Zaiss et al. NMR in Biomedicine 27(3), 2014.
     `doi:10.1002/nbm.3054 <https://doi.org/10.1002/nbm.3054>`_.
     """
-    def __init__(self, z_spectrum, ppms, mtr, normalization="normref"):
+    def __init__(
+            self, z_spectrum, ppms, mtr, normalization="normref", offsets=None,
+            dtype=float, mask=None, chunk_size=None):
         spire.TaskFactory.__init__(self, str(mtr))
         self.file_dep = [
             z_spectrum,
-            *([ppms] if isinstance(ppms, (str, pathlib.Path)) else [])]
+            *([ppms] if isinstance(ppms, (str, pathlib.Path)) else []),
+            *([mask] if mask else [])]
         self.targets = [mtr]
-        self.actions = [
-            (__class__.action, (z_spectrum, ppms, mtr, normalization))]
+        self.actions = [(
+            __class__.action,
+            (
+                z_spectrum, ppms, mtr, normalization, offsets, dtype, mask,
+                chunk_size))]
     
     @staticmethod
-    def action(z_spectrum, ppms, mtr=None, normalization="normref"):
+    def action(
+            z_spectrum, ppms, mtr=None, normalization="normref", offsets=None,
+            dtype=float, mask=None, chunk_size=None):
         if isinstance(ppms, (str, pathlib.Path)):
             ppms = utils.get_ppm(ppms)
         
-        # WARNING: must be symmetrical, as stated in docstring
-        positive = ppms >=0
-        negative = ppms <= 0
+        def compute_slab(z_spectrum, mask=None):
+            if mask is None:
+                return __class__.compute(
+                    z_spectrum, ppms, normalization, offsets, dtype)
+            else:
+                return utils.map_voxels(
+                    lambda x: __class__.compute(
+                        x, ppms, normalization, offsets, dtype),
+                    z_spectrum, mask=mask)
         
         if isinstance(z_spectrum, (str, pathlib.Path)):
-            z_spectrum = nibabel.load(z_spectrum)
+            z_spectrum = utils.load(z_spectrum)
         if isinstance(z_spectrum, nibabel.Nifti1Image):
             image = z_spectrum
-            z_spectrum = numpy.asarray(z_spectrum.dataobj)
             affine = image.affine
         else:
             image = None
             affine = numpy.identity(4)
         
-        z_label = z_spectrum[..., positive]
-        z_reference = z_spectrum[..., negative][::-1]
+        if isinstance(mask, (str, pathlib.Path)):
+            mask = utils.load(mask)
+        sources = [x for x in [z_spectrum, mask] if x is not None]
+        
+        if mtr is None:
+            mtr_data = compute_slab(*[
+                numpy.asarray(x.dataobj if isinstance(x, nibabel.Nifti1Image)
+                    else x)
+                for x in sources])
+            return (
+                nibabel.Nifti1Image(mtr_data, affine) if image is not None
+                else mtr_data)
+        
+        utils.stream(
+            compute_slab,
+            [
+                x if isinstance(x, nibabel.Nifti1Image)
+                else nibabel.Nifti1Image(numpy.asarray(x, float), affine)
+                for x in sources],
+            mtr, chunk_size)
+    
+    @staticmethod
+    def compute(
+            z_spectrum, ppms, normalization="normref", offsets=None,
+            dtype=float):
+        """ Compute the MTR of Z-spectra. Only the label and reference
+            frequencies of the target offsets are read.
+            
+            Parameters
+            ----------
+            
+            z_spectrum : array
+                Z-spectra, the frequency offsets being the last dimension
+            ppms : array
+                Frequency offsets of the Z-spectra, symmetric with respect
+                to 0
+            normalization : string, optional
+                Normalization method, cf. MTR
+            offsets : array, optional
+                Target frequency offsets, defaults to the non-negative
+                frequency offsets of the Z-spectra
+            dtype : data-type, optional
+                Type of the result
+            
+            Returns
+            -------
+            
+            array
+                MTR at the target frequency offsets, the offsets being the
+                last dimension
+        """
+        
+        ppms = numpy.asarray(ppms)
+        if offsets is None:
+            # WARNING: must be symmetrical, as stated in docstring
+            offsets = ppms[ppms >= 0]
+        offsets = numpy.atleast_1d(offsets)
+        
+        def indices(frequencies):
+            # Closest frequency offsets of the Z-spectra, which must match
+            closest = numpy.abs(ppms[:, None] - frequencies).argmin(axis=0)
+            missing = ~numpy.isclose(ppms[closest], frequencies)
+            if numpy.any(missing):
+                raise Exception(
+                    f"Frequencies not in the Z-spectrum: {frequencies[missing]}")
+            return closest
+        
+        # Advanced indexing creates new arrays, which are then updated in place
+        # to avoid one temporary array per operation.
+        z_label = z_spectrum[..., indices(offsets)].astype(dtype, copy=False)
+        z_reference = (
+            z_spectrum[..., indices(-offsets)].astype(dtype, copy=False))
         
         if normalization.lower() == "asym": # Eq. 7
-            mtr_data = z_reference - z_label
+            mtr_data = numpy.subtract(z_reference, z_label, out=z_reference)
         elif normalization.lower() == "normref": # Eq. 8
-            mtr_data = (z_reference - z_label) / z_reference
+            mtr_data = numpy.subtract(z_reference, z_label, out=z_label)
+            numpy.divide(mtr_data, z_reference, out=mtr_data)
         elif normalization.lower() == "pcm": # Eq. 9
-            mtr_data = (
-                (z_reference - z_label)
-                / (z_reference - z_label + z_label*z_reference))
+            mtr_data = z_reference - z_label
+            denominator = numpy.multiply(z_label, z_reference, out=z_label)
+            numpy.add(denominator, mtr_data, out=denominator)
+            numpy.divide(mtr_data, denominator, out=mtr_data)
         elif normalization.lower() == "rex": # Eq. 10
-            mtr_data = 1/z_label - 1/z_reference
+            mtr_data = numpy.reciprocal(z_label, out=z_label)
+            numpy.subtract(
+                mtr_data, numpy.reciprocal(z_reference, out=z_reference),
+                out=mtr_data)
         else:
             raise Exception(f"Unknown normalization: {normalization}")
         
-        if mtr is None:
-            return (
-                nibabel.Nifti1Image(mtr_data, affine) if image is not None
-                else mtr_data)
-        
-        nibabel.save(nibabel.Nifti1Image(mtr_data, affine), mtr)
-
+        return mtr_data
@@ -0,0 +1,106 @@
+import numpy
+import spire
+
+from . import utils
+from .mtr import MTR
+from .refine import Refine
+from .shift_spectrum import ShiftSpectrum
+from .wassr import WASSR
+
+class Pipeline(spire.TaskFactory):
+    """Compute an MTR map from a Z-spectrum, chaining WASSR, ShiftSpectrum,
+    Refine and MTR in memory. Only the MTR map, and the intermediate results
+    whose path is specified, are saved.
+    
+    Parameters
+    ----------
+    
+    image : path_like
+        Path to the source Z-spectrum image
+    meta_data : path_like
+        Path to the meta-data related to the source image
+    ppms : array_like
+        Frequencies of the refined Z-spectrum, symmetric with respect to 0
+    mtr : path_like
+        Path to the target MTR map
+    B0 : path_like, optional
+        Path to the frequency shift map. If not specified, it is computed from
+        the source Z-spectrum using the WASSR method.
+    wassr : path_like, optional
+        Path to the target WASSR map, must not be specified with B0
+    shifted : path_like, optional
+        Path to the target shifted Z-spectrum
+    refined : path_like, optional
+        Path to the target interpolated Z-spectrum
+    delta_ppm : float or None, optional
+        Resolution of the WASSR map, cf. WASSR
+    ppm_range : pair_of_floats, optional
+        Range over which to interpolate the Z-spectrum in WASSR, defaults to
+        full range defined by meta-data.
+    kind : str, optional
+        Interpolation method of ShiftSpectrum
+    normalization : string, optional
+        Normalization method of MTR
+    mask : path_like, optional
+        Path to a mask image: only the voxels inside the mask are processed,
+        the other voxels are set to 0
+    chunk_size : int, optional
+        Approximate number of voxels loaded in memory at once, defaults to
+        the whole image
+    workers : int, optional
+        Number of threads, defaults to the number of processors
+    """
+    
+    def __init__(
+            self, image, meta_data, ppms, mtr, B0=None, wassr=None,
+            shifted=None, refined=None, delta_ppm=0.001, ppm_range=None,
+            kind="linear", normalization="normref", mask=None, chunk_size=None,
+            workers=None):
+        if B0 and wassr:
+            raise Exception("WASSR map cannot be saved when B0 is specified")
+        
+        spire.TaskFactory.__init__(self, str(mtr))
+        self.file_dep = [
+            image, meta_data, *([B0] if B0 else []), *([mask] if mask else [])]
+        self.targets = [mtr, *[x for x in [wassr, shifted, refined] if x]]
+        self.actions = [(
+            __class__.action, (
+                image, meta_data, ppms, mtr, B0, wassr, shifted, refined,
+                delta_ppm, ppm_range, kind, normalization, mask, chunk_size,
+                workers))]
+    
+    @staticmethod
+    def action(
+            image, meta_data, ppms, mtr, B0=None, wassr=None, shifted=None,
+            refined=None, delta_ppm=0.001, ppm_range=None, kind="linear",
+            normalization="normref", mask=None, chunk_size=None, workers=None):
+        if B0 and wassr:
+            raise Exception("WASSR map cannot be saved when B0 is specified")
+        
+        ppm = utils.get_ppm(meta_data)
+        ppms = numpy.asarray(ppms)
+        
+        # Frequencies used by WASSR: sorted and in the requested range
+        wassr_order = numpy.argsort(ppm)
+        if ppm_range:
+            selector = (
+                (ppm[wassr_order] >= ppm_range[0])
+                & (ppm[wassr_order] <= ppm_range[1]))
+            wassr_order = wassr_order[selector]
+        
+        def process(data, B0=None):
+            if B0 is None:
+                B0 = WASSR.minimum(
+                    ppm[wassr_order], data[:, wassr_order], delta_ppm)
+            shifted = ShiftSpectrum.shift(ppm, data, B0, kind)
+            refined = Refine.refine(ppm, shifted, ppms)
+            mtr = MTR.compute(refined, ppms, normalization)
+            return mtr, refined, shifted, B0
+        
+        sources = [image, *([B0] if B0 else [])]
+        utils.stream(
+            lambda *slabs: utils.map_voxels(
+                process, slabs[:len(sources)], workers=workers,
+                mask=slabs[-1] if mask else None),
+            [utils.load(x) for x in [*sources, *([mask] if mask else [])]],
+            [mtr, refined, shifted, wassr], chunk_size)
@@ -1,12 +1,11 @@
-import nibabel
 import numpy
-import scipy
 import spire
 
 from . import utils
 
 class Refine(spire.TaskFactory):
-    """Interpolate a Z-spectrum.
+    """Interpolate a Z-spectrum. The interpolation weights only depend on the
+    source and target frequencies, and are computed once for all voxels.
     
     Parameters
     ----------
@@ -15,29 +14,74 @@ class Refine(spire.TaskFactory):
     meta_data : path_like
         Path to the meta-data related to the source image
     ppms : array_like
-        Target frequencies
+        Target frequencies. The refined Z-spectrum is NaN at the frequencies
+        outside of the range of the source Z-spectrum.
     refined : path_like
         Path to the target interpolated Z-spectrum
+    kind : str, optional
+        Interpolation method, cf. utils.interpolate, defaults to Akima
+        interpolation
+    dtype : data-type, optional
+        Type of the target interpolated Z-spectrum, either single or double
+        (default value) precision
+    mask : path_like, optional
+        Path to a mask image: only the voxels inside the mask are processed,
+        the other voxels are set to 0
+    chunk_size : int, optional
+        Approximate number of voxels loaded in memory at once, defaults to
+        the whole image
     """
     
-    def __init__(self, z_spectrum, meta_data, ppms, refined):
+    def __init__(
+            self, z_spectrum, meta_data, ppms, refined, kind="akima",
+            dtype=float, mask=None, chunk_size=None):
         spire.TaskFactory.__init__(self, str(refined))
-        self.file_dep = [z_spectrum, meta_data]
+        self.file_dep = [z_spectrum, meta_data, *([mask] if mask else [])]
         self.targets = [refined]
-        self.actions = [
-            (__class__.action, (z_spectrum, meta_data, ppms, refined))]
+        self.actions = [(
+            __class__.action,
+            (
+                z_spectrum, meta_data, ppms, refined, kind, dtype, mask,
+                chunk_size))]
     
     @staticmethod
-    def action(z_spectrum, meta_data, ppms, refined):
+    def action(
+            z_spectrum, meta_data, ppms, refined, kind="akima", dtype=float,
+            mask=None, chunk_size=None):
         source_ppms = utils.get_ppm(meta_data)
         
-        z_spectrum_image = nibabel.load(z_spectrum)
-        z_spectrum = numpy.array(z_spectrum_image.dataobj)
+        utils.stream(
+            lambda z_spectrum, mask=None: utils.map_voxels(
+                lambda z_spectrum: __class__.refine(
+                    source_ppms, z_spectrum, ppms, kind, dtype),
+                z_spectrum, mask=mask),
+            [utils.load(x) for x in [z_spectrum, *([mask] if mask else [])]],
+            refined, chunk_size)
+    
+    @staticmethod
+    def refine(source_ppms, spectra, ppms, kind="akima", dtype=float):
+        """ Interpolate Z-spectra at the target frequencies.
         
-        interpolator = scipy.interpolate.Akima1DInterpolator(
-            source_ppms, z_spectrum, axis=3)
-        refined_data = interpolator(ppms)
+            Parameters
+            ----------
+            
+            source_ppms : array
+                Frequency offsets of the Z-spectra
+            spectra : array
+                Z-spectra, with a shape of (n, len(source_ppms))
+            ppms : array
+                Target frequencies
+            kind : str, optional
+                Interpolation method, cf. utils.interpolate
+            dtype : data-type, optional
+                Type of the result
+            
+            Returns
+            -------
+            
+            array
+                Interpolated Z-spectra, with a shape of (n, len(ppms))
+        """
         
-        nibabel.save(
-            nibabel.Nifti1Image(refined_data, z_spectrum_image.affine), refined)
-
+        return utils.interpolate(
+            source_ppms, spectra, numpy.asarray(ppms, float), kind, dtype)
@@ -1,8 +1,3 @@
-import re
-
-import nibabel
-import numpy
-import scipy
 import spire
 
 from . import utils
@@ -21,6 +16,17 @@ class ShiftSpectrum(spire.TaskFactory):
         Path to the frequency shift map
     shifted : path_like
         Path to the target shifted Z-spectrum
+    kind : str, optional
+        Interpolation method, must be one of *linear* (default value),
+        *cubic* (cubic spline) or *akima*
+    mask : path_like, optional
+        Path to a mask image: only the voxels inside the mask are processed,
+        the other voxels are set to 0
+    chunk_size : int, optional
+        Approximate number of voxels loaded in memory at once, defaults to
+        the whole image
+    workers : int, optional
+        Number of threads, defaults to the number of processors
     
     References
     ----------
@@ -31,32 +37,57 @@ class ShiftSpectrum(spire.TaskFactory):
         `doi:10.1002/mrm.21873 <https://doi.org/10.1002/mrm.21873>`_.
     """
     
-    def __init__(self, image, meta_data, B0, shifted):
+    def __init__(
+            self, image, meta_data, B0, shifted, kind="linear", mask=None,
+            chunk_size=None, workers=None):
         spire.TaskFactory.__init__(self, str(shifted))
-        self.file_dep = [image, meta_data, B0]
+        self.file_dep = [image, meta_data, B0, *([mask] if mask else [])]
         self.targets = [shifted]
-        self.actions = [(__class__.action, (image, meta_data, B0, shifted))]
+        self.actions = [(
+            __class__.action, (
+                image, meta_data, B0, shifted, kind, mask, chunk_size,
+                workers))]
     
     @staticmethod
-    def action(image, meta_data, B0, shifted):
+    def action(
+            image, meta_data, B0, shifted, kind="linear", mask=None,
+            chunk_size=None, workers=None):
         # Get the frequency information from the meta-data
         ppm = utils.get_ppm(meta_data)
         
-        # Load the image and the B0 map
-        image, B0_image = [nibabel.load(x) for x in [image, B0]]
-        data, B0_data = [numpy.array(x.dataobj) for x in [image, B0_image]]
-        
-        # Correct the nominal voxel-wise using the B0 map
-        shifted_ppm = ppm[None, None, None, :]+B0_data[..., None]
-        
-        # Interpolate the data pixel-wise to shift the Z-spectrum
-        shifted_ppm_flat = shifted_ppm.reshape(-1, shifted_ppm.shape[-1])
-        data_flat = data.reshape(-1, data.shape[-1])
-        shifted_data_flat = numpy.zeros_like(data_flat)
-        # NOTE: is linear interpolation the best choice?
-        for index, (x, fp) in enumerate(zip(shifted_ppm_flat, data_flat)):
-            shifted_data_flat[index] = numpy.interp(x, ppm, fp)
-        
-        shifted_data = shifted_data_flat.reshape(data.shape)
+        # Interpolate the data voxel-wise at the nominal frequencies corrected
+        # by the B0 map, to shift the Z-spectrum
+        utils.stream(
+            lambda data, B0, mask=None: utils.map_voxels(
+                lambda data, B0: __class__.shift(ppm, data, B0, kind),
+                [data, B0], workers=workers, mask=mask),
+            [utils.load(x) for x in [image, B0, *([mask] if mask else [])]],
+            shifted, chunk_size)
+    
+    @staticmethod
+    def shift(ppm, spectra, B0, kind="linear"):
+        """ Shift each Z-spectrum by its frequency shift.
+            
+            Parameters
+            ----------
+            
+            ppm : array
+                Frequency offsets of the Z-spectra
+            spectra : array
+                Z-spectra, with a shape of (n, len(ppm))
+            B0 : array
+                Frequency shift of each Z-spectrum, in PPM
+            kind : str, optional
+                Interpolation method, cf. utils.interpolate
+            
+            Returns
+            -------
+            
+            array
+                Shifted Z-spectra, with the same shape as spectra
+        """
         
-        nibabel.save(nibabel.Nifti1Image(shifted_data, image.affine), shifted)
+        # Shifted frequencies outside of the sampled range take the value at
+        # the closest end, as in numpy.interp
+        return utils.interpolate(
+            ppm, spectra, ppm[None, :]+B0[:, None], kind, clamp=True)
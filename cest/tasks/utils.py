@@ -1,18 +1,69 @@
 import base64
+import concurrent.futures
+import functools
 import json
+import os
+import pathlib
+import re
+import tempfile
 
 import dicomifier
+import nibabel
 import numpy
 
-def get_ppm(path):
+from .. import _cest
+
+def get_ppm(path, sidecar=False):
     """
-    Return the frequency offsets as PPM from the meta-data.
+    Return the frequency offsets as PPM from the meta-data. The values are
+    cached in memory, and optionally in a sidecar file, until the meta-data
+    file is modified.
     
     Parameters
     ----------
     path : path_like
         Path to the meta-data
+    sidecar : bool, optional
+        If True, store the values in, and read them from, a sidecar file next
+        to the meta-data (``name.json`` → ``name.ppm.json``)
+    """
+    
+    stat = os.stat(path)
+    ppm = _get_ppm(
+        os.path.realpath(path), stat.st_mtime_ns, stat.st_size, sidecar)
+    # Don't let the caller modify the cached values
+    return ppm.copy()
+
+@functools.lru_cache(maxsize=256)
+def _get_ppm(path, mtime_ns, size, sidecar):
+    """ Cached version of get_ppm, keyed on the path and on the modification
+        time and size of the meta-data.
     """
+    
+    source = {"mtime_ns": mtime_ns, "size": size}
+    sidecar_path = pathlib.Path(path).with_suffix(".ppm.json")
+    
+    if sidecar and sidecar_path.is_file():
+        try:
+            with open(sidecar_path) as fd:
+                cached = json.load(fd)
+        except ValueError:
+            cached = None
+        if cached is not None and cached.get("source") == source:
+            return numpy.array(cached["ppm"])
+    
+    ppm = _read_ppm(path)
+    
+    if sidecar:
+        with open(sidecar_path, "w") as fd:
+            json.dump({"source": source, "ppm": ppm.tolist()}, fd)
+    
+    return ppm
+
+def _read_ppm(path):
+    """ Read the frequency offsets as PPM from the meta-data.
+    """
+    
     with open(path) as fd:
         meta_data = json.load(fd)
     
@@ -27,18 +78,249 @@ def get_ppm(path):
             encapsulated = encapsulated[:-1]
         data = json.loads(encapsulated)
         
-        data_set = dicomifier.bruker.Dataset()
-        data_set.loads(data["acqp"])
-        data_set.loads(data["method"])
+        # Only parse the required fields, and use the full Bruker parser as a
+        # fallback
+        names = ["BF1", "PVM_MagTransFL", "PVM_SatTransFreqValues"]
+        fields = _parse_bruker(data["acqp"]+"\n"+data["method"], names)
+        if (
+                fields is None or "BF1" not in fields
+                or all(x not in fields for x in names[1:])):
+            data_set = dicomifier.bruker.Dataset()
+            data_set.loads(data["acqp"])
+            data_set.loads(data["method"])
+            fields = {
+                name: data_set[name].value for name in names
+                if name in data_set}
         
-        omega_0_MHz = data_set["BF1"].value[0]
-        if "PVM_MagTransFL" in data_set:
-            delta_omega_Hz = data_set["PVM_MagTransFL"].value
+        omega_0_MHz = fields["BF1"][0]
+        if "PVM_MagTransFL" in fields:
+            delta_omega_Hz = fields["PVM_MagTransFL"]
             ppm = numpy.divide(delta_omega_Hz, omega_0_MHz)
-        elif "PVM_SatTransFreqValues" in data_set:
-            ppm = numpy.array(data_set["PVM_SatTransFreqValues"].value)
+        elif "PVM_SatTransFreqValues" in fields:
+            ppm = numpy.array(fields["PVM_SatTransFreqValues"])
     
     if ppm is None:
         raise Exception("Cannot find PPM information")
     
     return ppm
+
+def _parse_bruker(text, names):
+    """ Parse numeric fields from the JCAMP-DX text of Bruker parameter files,
+        e.g. acqp or method. Return a dictionary of lists of values, or None
+        if a field cannot be parsed. Later occurrences of a field override
+        the earlier ones.
+    """
+    
+    fields = {}
+    for match in re.finditer(
+            r"^##\$(\w+)=(.*?)(?=^##|^\$\$|\Z)", text, re.M|re.S):
+        name, value = match.groups()
+        if name not in names:
+            continue
+        
+        # Arrays are prefixed by their shape, on the first line
+        first_line, _, rest = value.partition("\n")
+        if re.match(r"\s*\(.*\)\s*$", first_line):
+            value = rest
+        
+        values = []
+        for item in value.split():
+            # Run-length encoding: @count*(value)
+            repeated = re.match(r"@(\d+)\*\((.*)\)$", item)
+            count, item = (
+                (int(repeated.group(1)), repeated.group(2)) if repeated
+                else (1, item))
+            try:
+                values.extend(count*[float(item)])
+            except ValueError:
+                return None
+        fields[name] = values
+    
+    return fields
+
+# Images loaded in shared memory by run_batch, keyed on their real path
+_shared_images = {}
+
+def load(path):
+    """
+    Load an image. If it was loaded in shared memory by run_batch, the shared
+    image is returned instead of reading the file.
+    
+    Parameters
+    ----------
+    path : path_like
+        Path to the image
+    """
+    
+    image = _shared_images.get(os.path.realpath(path))
+    return image if image is not None else nibabel.load(path)
+
+def map_voxels(function, data, chunk_size=10000, workers=None, mask=None):
+    """
+    Apply a function to chunks of voxels, in parallel. The peak memory used by
+    the function is proportional to the chunk size.
+    
+    Parameters
+    ----------
+    function : callable
+        Function applied to chunks of n voxels, returning an array, or a tuple
+        of arrays, whose first dimension has size n. It receives one chunk per
+        source array, with a shape of (n, ...), where ... are the non-spatial
+        dimensions.
+    data : array_like or sequence of array_like
+        Source data. The spatial dimensions are given by the first array,
+        without its last dimension, and must be shared by all arrays.
+    chunk_size : int, optional
+        Number of voxels in each chunk
+    workers : int, optional
+        Number of threads, defaults to the number of processors
+    mask : array_like, optional
+        If specified, only process the voxels where the mask is non-zero. The
+        other voxels are set to 0 in the result.
+    
+    Returns
+    -------
+    array or tuple of arrays
+        Result, with the spatial shape of data followed by the shape of the
+        result of function for a single voxel
+    """
+    
+    if not isinstance(data, (list, tuple)):
+        data = [data]
+    data = [numpy.asarray(x) for x in data]
+    shape = data[0].shape[:-1]
+    
+    if mask is None:
+        flat = [x.reshape(-1, *x.shape[len(shape):]) for x in data]
+    else:
+        mask = numpy.asarray(mask).astype(bool)
+        flat = [x[mask] for x in data]
+    
+    # Call the function at least once, so that the shape of its result is
+    # known even without any voxel.
+    starts = range(0, max(len(flat[0]), 1), chunk_size)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        chunks = list(executor.map(
+            lambda start: function(*[x[start:start+chunk_size] for x in flat]),
+            starts))
+    
+    def expand(result):
+        if mask is None:
+            return result.reshape(shape+result.shape[1:])
+        else:
+            full = numpy.zeros(shape+result.shape[1:], result.dtype)
+            full[mask] = result
+            return full
+    
+    if isinstance(chunks[0], tuple):
+        return tuple(expand(numpy.concatenate(x)) for x in zip(*chunks))
+    else:
+        return expand(numpy.concatenate(chunks))
+
+def stream(function, sources, target, chunk_size=None):
+    """
+    Apply a function to slabs of images along their third (i.e. last spatial)
+    dimension, and save the result. The slabs are read through the array
+    proxies of the images and written to temporary memory-mapped arrays, so
+    that only one slab is held in memory at once.
+    
+    Parameters
+    ----------
+    function : callable
+        Function applied to the slabs of the sources, as arrays, and returning
+        the slab of the result, or a tuple of slabs if target is a sequence
+    sources : sequence of nibabel images
+        Source images, with the same spatial shape
+    target : path_like or sequence of path_like
+        Path to the result images, with the affine of the first source. If
+        an item is None, the matching result is not saved.
+    chunk_size : int, optional
+        Approximate number of voxels in each slab, defaults to the whole image
+    """
+    
+    multiple = isinstance(target, (list, tuple))
+    targets = target if multiple else [target]
+    apply = lambda *slabs: function(*slabs) if multiple else [function(*slabs)]
+    
+    shape = sources[0].shape[:3]
+    thickness = (
+        shape[2] if chunk_size is None
+        else max(1, chunk_size // (shape[0]*shape[1])))
+    slabs = [
+        slice(start, start+thickness) for start in range(0, shape[2], thickness)]
+    
+    if len(slabs) == 1:
+        results = apply(*[numpy.asarray(x.dataobj) for x in sources])
+        for result, target in zip(results, targets):
+            if target is not None:
+                nibabel.save(
+                    nibabel.Nifti1Image(result, sources[0].affine), target)
+        return
+    
+    # Store the temporary results next to the first target, where there should
+    # be enough space
+    directory = pathlib.Path(
+        [x for x in targets if x is not None][0]).parent
+    with tempfile.TemporaryDirectory(dir=directory) as directory:
+        results = len(targets)*[None]
+        for slab in slabs:
+            result_slabs = apply(
+                *[numpy.asarray(x.dataobj[:, :, slab]) for x in sources])
+            for index, (result_slab, target) in enumerate(
+                    zip(result_slabs, targets)):
+                if target is None:
+                    continue
+                if results[index] is None:
+                    results[index] = numpy.memmap(
+                        pathlib.Path(directory)/f"{index}.dat",
+                        result_slab.dtype, "w+",
+                        shape=shape+result_slab.shape[3:])
+                results[index][:, :, slab] = result_slab
+        
+        for result, target in zip(results, targets):
+            if target is not None:
+                nibabel.save(
+                    nibabel.Nifti1Image(result, sources[0].affine), target)
+        del results
+
+def interpolate(
+        x, y, x_new, kind="linear", dtype=float, out=None, clamp=False):
+    """
+    Interpolate a batch of functions sampled on the same points, each at its
+    own positions or all at the same positions. The functions are
+    interpolated in parallel.
+    
+    Parameters
+    ----------
+    x : array_like
+        Sample points, with a shape of (m, ), in any order
+    y : array_like
+        Sampled values, with a shape of (n, m)
+    x_new : array_like
+        Interpolation points, with a shape of (n, p), or with a shape of (p, )
+        if they are shared by all functions: the interpolation weights are
+        then computed only once.
+    kind : str, optional
+        Interpolation method, must be one of *linear* (default value),
+        *cubic* (cubic spline) or *akima*
+    dtype : data-type, optional
+        Type of the result, either single or double (default value) precision
+    out : array, optional
+        C-contiguous and writeable array of the given dtype, e.g. a
+        numpy.memmap, in which the result is stored instead of a new array
+    clamp : bool, optional
+        Whether positions outside of the sampled range are clamped to it, as
+        in numpy.interp, or yield NaN (default value), as in scipy
+    
+    Returns
+    -------
+    array
+        Interpolated values, with a shape of (n, p)
+    """
+    
+    if kind not in _cest.Interpolation.__members__:
+        raise Exception(f"Unknown interpolation: {kind}")
+    
+    return _cest.interpolate(
+        x, y, numpy.atleast_2d(x_new), _cest.Interpolation.__members__[kind],
+        clamp, numpy.dtype(dtype), out)
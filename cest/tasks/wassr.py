@@ -1,6 +1,5 @@
 import re
 
-import nibabel
 import numpy
 import scipy
 import spire
@@ -19,11 +18,21 @@ class WASSR(spire.TaskFactory):
         Path to the meta-data related to the source image
     wassr : path_like
         Path to the target WASSR map
-    delta_ppm : float, optional
-        Interpolation step
+    delta_ppm : float or None, optional
+        Resolution of the shift map: the minimum of the interpolated
+        Z-spectrum is rounded to this step. If None, the exact minimum is
+        used.
     ppm_range : pair_of_floats, optional
         Range over which to interpolate the Z-spectrum, defaults to full range
         defined by meta-data.
+    mask : path_like, optional
+        Path to a mask image: only the voxels inside the mask are processed,
+        the other voxels are set to 0
+    chunk_size : int, optional
+        Approximate number of voxels loaded in memory at once, defaults to
+        the whole image
+    workers : int, optional
+        Number of threads, defaults to the number of processors
     
     References
     ----------
@@ -34,40 +43,95 @@ class WASSR(spire.TaskFactory):
         `doi:10.1002/mrm.21873 <https://doi.org/10.1002/mrm.21873>`_.
     """
         
-    def __init__(self, image, meta_data, wassr, delta_ppm=0.001, ppm_range=None):
+    def __init__(
+            self, image, meta_data, wassr, delta_ppm=0.001, ppm_range=None,
+            mask=None, chunk_size=None, workers=None):
         spire.TaskFactory.__init__(self, str(wassr))
-        self.file_dep = [image, meta_data]
+        self.file_dep = [image, meta_data, *([mask] if mask else [])]
         self.targets = [wassr]
-        self.actions = [
-            (__class__.action, (image, meta_data, wassr, delta_ppm, ppm_range))]
+        self.actions = [(
+            __class__.action, (
+                image, meta_data, wassr, delta_ppm, ppm_range, mask,
+                chunk_size, workers))]
     
     @staticmethod
-    def action(image, meta_data, wassr, delta_ppm=0.001, ppm_range=None):
+    def action(
+            image, meta_data, wassr, delta_ppm=0.001, ppm_range=None,
+            mask=None, chunk_size=None, workers=None):
         # Get the frequency information from the meta-data
         ppm = utils.get_ppm(meta_data)
         
-        # Load the image data
-        image = nibabel.load(image)
-        data = numpy.array(image.dataobj)
-        
         # Sort the volumes in increasing PPM order
         order = numpy.argsort(ppm)
         ppm = ppm[order]
-        data = data[..., order]
         
         # Keep the requested data
         if ppm_range:
             selector = (ppm >= ppm_range[0]) & (ppm <= ppm_range[1])
             ppm = ppm[selector]
-            data = data[..., selector]
+            order = order[selector]
         
-        # Interpolate the Z-spectrum
-        ppm_fine = numpy.arange(ppm.min(), ppm.max()+delta_ppm, delta_ppm)
-        interpolator = scipy.interpolate.CubicSpline(ppm, data, axis=3)
-        interpolated = interpolator(ppm_fine)
+        utils.stream(
+            lambda data, mask=None: utils.map_voxels(
+                lambda x: __class__.minimum(ppm, x, delta_ppm), data[..., order],
+                workers=workers, mask=mask),
+            [utils.load(x) for x in [image, *([mask] if mask else [])]],
+            wassr, chunk_size)
+    
+    @staticmethod
+    def minimum(ppm, spectra, delta_ppm=None):
+        """ Return the position of the minimum of the cubic spline
+            interpolating each Z-spectrum. The minimum is found analytically
+            from the roots of the derivative of the spline on each interval,
+            without evaluating the spline on a fine grid.
+            
+            Parameters
+            ----------
+            
+            ppm : array
+                Increasing frequency offsets of the Z-spectra
+            spectra : array
+                Z-spectra, with a shape of (n, len(ppm))
+            delta_ppm : float or None, optional
+                If not None, round the minimum to the grid starting at
+                min(ppm) with this step
+            
+            Returns
+            -------
+            
+            array
+                Position of the minimum of each Z-spectrum
+        """
         
-        # Compute the B0 map from the minimum of the interpolated Z-spectrum
-        min_index = numpy.argmin(interpolated, axis=3)
-        B0_ppm = ppm_fine[min_index]
-
-        nibabel.save(nibabel.Nifti1Image(B0_ppm, image.affine), wassr)
+        # Coefficients of the spline, shape is (4, intervals, n). On each
+        # interval, S(x) = c[0]*t³ + c[1]*t² + c[2]*t + c[3], t = x - ppm[i].
+        c = scipy.interpolate.CubicSpline(ppm, spectra, axis=1).c
+        h = numpy.diff(ppm)[:, None]
+        
+        # Roots of the derivative 3c[0]*t² + 2c[1]*t + c[2], using the
+        # numerically stable form of the solution.
+        a, b = 3*c[0], 2*c[1]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            q = -0.5*(b + numpy.copysign(numpy.sqrt(b**2 - 4*a*c[2]), b))
+            roots = [q/a, c[2]/q]
+        
+        # Candidates: both ends of the interval and the roots inside it.
+        # Invalid roots are replaced by the start of the interval.
+        t = numpy.stack([
+            numpy.zeros_like(a), numpy.broadcast_to(h, a.shape),
+            *[numpy.where((x >= 0) & (x <= h), x, 0) for x in roots]])
+        values = ((c[0]*t + c[1])*t + c[2])*t + c[3]
+        
+        # Minimum over all candidates of all intervals
+        values = values.reshape(-1, values.shape[-1])
+        best = numpy.argmin(values, axis=0)
+        voxels = numpy.arange(values.shape[-1])
+        candidate, interval = numpy.unravel_index(best, t.shape[:2])
+        minimum = ppm[interval] + t[candidate, interval, voxels]
+        
+        if delta_ppm is not None:
+            ppm_fine = numpy.arange(ppm.min(), ppm.max()+delta_ppm, delta_ppm)
+            index = numpy.rint((minimum-ppm_fine[0])/delta_ppm).astype(int)
+            minimum = ppm_fine[numpy.clip(index, 0, len(ppm_fine)-1)]
+        
+        return minimum
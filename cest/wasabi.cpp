@@ -2,13 +2,28 @@
 // active. https://discourse.mc-stan.org/t/includes-in-user-header/26093
 #include <stan/math.hpp>
 
+#include <algorithm>
+#include <chrono>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <stan/io/empty_var_context.hpp>
+#include <stan/services/sample/hmc_nuts_diag_e_adapt.hpp>
+
 #include <pybind11/eigen.h>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 
 #include <xtensor-python/pyarray.hpp>
 
+#include <tbb/enumerable_thread_specific.h>
+#include <tbb/global_control.h>
+#include <tbb/parallel_for.h>
+
 #include "slimp/actions.h"
+#include "slimp/ArrayWriter.h"
 
 #include "wasabi_sampler.h"
 
@@ -18,9 +33,151 @@
 using ArrayI = xt::xarray<int>;
 using ArrayD = xt::xarray<double>;
 
-std::tuple<ArrayD, std::vector<std::string>, std::vector<std::string>, ArrayI, ArrayI>
+// Arrays shared with Python: the inputs are not copied when they are already
+// in double precision, and the outputs are returned without a copy.
+using PyArrayD = xt::pyarray<double>;
+
+namespace
+{
+
+/**
+ * @brief Writer to an array of samples, which also stores the step size and
+ * the inverse metric reported by Stan at the end of the adaptation.
+ */
+class AdaptationWriter: public slimp::ArrayWriter
+{
+public:
+    double stepsize = 1;
+    std::vector<double> inv_metric;
+    
+    using slimp::ArrayWriter::ArrayWriter;
+    using slimp::ArrayWriter::operator();
+    
+    void operator()(std::string const & message) override
+    {
+        if(this->_metric_next)
+        {
+            this->inv_metric.clear();
+            std::istringstream stream(message);
+            std::string item;
+            while(std::getline(stream, item, ','))
+            {
+                this->inv_metric.push_back(std::stod(item));
+            }
+            this->_metric_next = false;
+        }
+        else if(message.rfind("Step size = ", 0) == 0)
+        {
+            this->stepsize = std::stod(message.substr(12));
+        }
+        else if(message == "Diagonal elements of inverse mass matrix:")
+        {
+            this->_metric_next = true;
+        }
+        
+        slimp::ArrayWriter::operator()(message);
+    }
+
+private:
+    bool _metric_next = false;
+};
+
+/// @brief Adapted state of a chain, used to warm-start the next voxel
+struct Adaptation
+{
+    double stepsize;
+    std::vector<double> inv_metric;
+    /// @brief Posterior mean of the model parameters
+    std::vector<double> mean;
+};
+
+/**
+ * @brief Sample the posterior of a voxel, with its chains in parallel. If the
+ * adaptation of a neighbouring voxel is available, the chains start from its
+ * posterior mean, step size and inverse metric with a shorter warmup. The
+ * adaptation is then updated.
+ */
+void sample_voxel(
+    slimp::VarContext & context,
+    slimp::action_parameters::Sample const & parameters, int neighbour_warmup,
+    std::vector<std::string> const & raw_names, std::size_t first_parameter,
+    std::vector<Adaptation> & adaptation, slimp::Tensor3d & samples)
+{
+    wasabi_sampler::model model(context, parameters.seed, &std::cout);
+    
+    auto const chains = parameters.num_chains;
+    adaptation.resize(chains);
+    tbb::parallel_for(std::size_t(0), chains, [&](std::size_t chain) {
+        stan::callbacks::interrupt interrupt;
+        stan::callbacks::logger logger;
+        stan::callbacks::writer init_writer, diagnostic_writer;
+        
+        auto & state = adaptation[chain];
+        AdaptationWriter sample_writer(samples, chain);
+        
+        int return_code;
+        if(!state.inv_metric.empty())
+        {
+            slimp::VarContext init, init_inv_metric;
+            for(std::size_t i=0; i!=raw_names.size(); ++i)
+            {
+                init.set(raw_names[i], state.mean[i]);
+            }
+            ArrayD inv_metric{ArrayD::shape_type{state.inv_metric.size()}};
+            std::copy(
+                state.inv_metric.begin(), state.inv_metric.end(),
+                inv_metric.begin());
+            init_inv_metric.set("inv_metric", inv_metric);
+            
+            return_code = stan::services::sample::hmc_nuts_diag_e_adapt(
+                model, init, init_inv_metric, parameters.seed, chain,
+                parameters.init_radius, neighbour_warmup,
+                parameters.num_samples, parameters.thin, parameters.save_warmup,
+                parameters.refresh, state.stepsize,
+                parameters.hmc.stepsize_jitter, parameters.hmc.max_depth,
+                parameters.adapt.delta, parameters.adapt.gamma,
+                parameters.adapt.kappa, parameters.adapt.t0,
+                parameters.adapt.init_buffer, parameters.adapt.term_buffer,
+                parameters.adapt.window, interrupt, logger, init_writer,
+                sample_writer, diagnostic_writer);
+        }
+        else
+        {
+            stan::io::empty_var_context init;
+            return_code = stan::services::sample::hmc_nuts_diag_e_adapt(
+                model, init, parameters.seed, chain, parameters.init_radius,
+                parameters.num_warmup, parameters.num_samples, parameters.thin,
+                parameters.save_warmup, parameters.refresh,
+                parameters.hmc.stepsize, parameters.hmc.stepsize_jitter,
+                parameters.hmc.max_depth, parameters.adapt.delta,
+                parameters.adapt.gamma, parameters.adapt.kappa,
+                parameters.adapt.t0, parameters.adapt.init_buffer,
+                parameters.adapt.term_buffer, parameters.adapt.window,
+                interrupt, logger, init_writer, sample_writer,
+                diagnostic_writer);
+        }
+        if(return_code != 0)
+        {
+            throw std::runtime_error(
+                "Error while sampling: "+std::to_string(return_code));
+        }
+        
+        state.stepsize = sample_writer.stepsize;
+        state.inv_metric = sample_writer.inv_metric;
+        state.mean.resize(raw_names.size());
+        for(std::size_t i=0; i!=raw_names.size(); ++i)
+        {
+            state.mean[i] = xt::mean(
+                xt::view(samples, first_parameter+i, chain))();
+        }
+    });
+}
+
+}
+
+std::tuple<PyArrayD, std::vector<std::string>, std::vector<std::string>, ArrayI, ArrayI>
 wasabi(
-    ArrayD const & Delta_w, ArrayD const & Z,
+    PyArrayD const & Delta_w, PyArrayD const & Z,
     double B0, double B1_nominal, double t_p,
     slimp::action_parameters::Sample /* const & */ parameters)
 {
@@ -31,12 +188,12 @@ wasabi(
     // non-constant fields.
     slimp::VarContext context;
     context.set("N", int(Z.shape()[1]));
-    context.set("Delta_w", Delta_w);
+    context.set("Delta_w", ArrayD(Delta_w));
     context.set("B0", B0);
     context.set("B1_nominal", B1_nominal);
     context.set("t_p", t_p);
     auto update_context = [&](slimp::VarContext & context, std::size_t r) {
-        context.set("Z", xt::eval(xt::view(Z, r)));
+        context.set("Z", ArrayD(xt::view(Z, r)));
     };
     update_context(context, 0);
     
@@ -44,7 +201,7 @@ wasabi(
     std::size_t const R = Z.shape()[0];
     
     // Outputs: parameters and names, summarized HMC information
-    ArrayD posterior;
+    PyArrayD posterior;
     std::vector<std::string> names, raw_names;
     std::size_t depth_index, divergent_index;
     ArrayI exceeded_depth{ArrayI::shape_type{R}};
@@ -65,8 +222,8 @@ wasabi(
         
         // We only store the model parameters, not the HMC parameters
         names = dummy.model_names();
-        posterior = ArrayD(
-            ArrayD::shape_type{R, names.size(), samples.shape(1), samples.shape(2)});
+        posterior = PyArrayD::from_shape(std::vector<std::size_t>{
+            R, names.size(), samples.shape(1), samples.shape(2)});
         
         raw_names = dummy.model_names(false, false);
     }
@@ -89,12 +246,317 @@ wasabi(
     return {posterior, names, raw_names, exceeded_depth, divergent};
 }
 
+std::tuple<
+    PyArrayD, std::vector<std::string>, std::vector<std::string>, ArrayI,
+    ArrayI, ArrayD, ArrayI>
+wasabi(
+    PyArrayD const & Delta_w, PyArrayD const & Z,
+    double B0, double B1_nominal, double t_p,
+    slimp::action_parameters::Sample parameters, int neighbour_warmup,
+    std::size_t block_size)
+{
+    // Model type
+    using Model = slimp::Model<wasabi_sampler::model>;
+    
+    if(parameters.save_warmup)
+    {
+        throw std::invalid_argument(
+            "Warmup draws cannot be saved with warm-started voxels");
+    }
+    if(block_size == 0)
+    {
+        throw std::invalid_argument("Block size must be positive");
+    }
+    
+    // Model context, initialized with constant fields and dummy values for
+    // non-constant fields.
+    slimp::VarContext context;
+    context.set("N", int(Z.shape()[1]));
+    context.set("Delta_w", ArrayD(Delta_w));
+    context.set("B0", B0);
+    context.set("B1_nominal", B1_nominal);
+    context.set("t_p", t_p);
+    auto update_context = [&](slimp::VarContext & context, std::size_t r) {
+        context.set("Z", ArrayD(xt::view(Z, r)));
+    };
+    update_context(context, 0);
+    
+    // Number of models to run
+    std::size_t const R = Z.shape()[0];
+    
+    // Outputs: parameters and names, summarized HMC information, sampling
+    // duration and warm start
+    PyArrayD posterior;
+    std::vector<std::string> names, raw_names;
+    std::size_t depth_index, divergent_index, first_parameter;
+    slimp::Tensor3d::shape_type samples_shape;
+    ArrayI exceeded_depth{ArrayI::shape_type{R}};
+    ArrayI divergent{ArrayI::shape_type{R}};
+    ArrayD duration{ArrayD::shape_type{R}};
+    ArrayI warm_started{ArrayI::shape_type{R}};
+    
+    // Create a dummy model to initialize the result array and helpers
+    {
+        Model dummy(context, parameters);
+        auto samples = dummy.create_samples();
+        samples_shape = samples.shape();
+        
+        auto const hmc = dummy.hmc_names();
+        depth_index =
+            std::find(hmc.begin(), hmc.end(), "treedepth__") - hmc.begin();
+        divergent_index = 
+            std::find(hmc.begin(), hmc.end(), "divergent__") - hmc.begin();
+        first_parameter = hmc.size();
+        
+        names = dummy.model_names();
+        posterior = PyArrayD::from_shape(std::vector<std::size_t>{
+            R, names.size(), samples.shape(1), samples.shape(2)});
+        
+        raw_names = dummy.model_names(false, false);
+    }
+    
+    stan::math::init_threadpool_tbb(parameters.threads_per_chain);
+    
+    // Voxels are processed by blocks of consecutive voxels, in parallel. In
+    // each block, the first voxel has a full warmup, and the next ones are
+    // warm-started from the previous one. Use smaller blocks if there are not
+    // enough of them to keep all threads busy, the chains of each voxel
+    // running in parallel.
+    auto const threads = std::size_t(tbb::global_control::active_value(
+        tbb::global_control::max_allowed_parallelism));
+    auto const chains = std::max(std::size_t(1), parameters.num_chains);
+    auto const min_blocks = (threads+chains-1)/chains;
+    block_size = std::max(
+        std::size_t(1), std::min(block_size, (R+min_blocks-1)/min_blocks));
+    
+    tbb::enumerable_thread_specific<slimp::VarContext> contexts(context);
+    std::size_t const blocks = (R+block_size-1)/block_size;
+    tbb::parallel_for(std::size_t(0), blocks, [&](std::size_t block) {
+        auto & local_context = contexts.local();
+        std::vector<Adaptation> adaptation;
+        auto const end = std::min(R, (block+1)*block_size);
+        for(auto r=block*block_size; r!=end; ++r)
+        {
+            auto const start = std::chrono::steady_clock::now();
+            
+            update_context(local_context, r);
+            warm_started[r] = !adaptation.empty();
+            slimp::Tensor3d samples(samples_shape);
+            sample_voxel(
+                local_context, parameters, neighbour_warmup, raw_names,
+                first_parameter, adaptation, samples);
+            
+            xt::view(posterior, r) = xt::view(
+                samples, xt::range(-names.size(), xt::placeholders::_));
+            exceeded_depth[r] = xt::sum(
+                    xt::view(samples, depth_index) > parameters.hmc.max_depth
+                )[0];
+            divergent[r] = xt::sum(xt::view(samples, divergent_index))[0];
+            
+            duration[r] = std::chrono::duration<double>(
+                std::chrono::steady_clock::now()-start).count();
+        }
+    });
+    
+    return {
+        posterior, names, raw_names, exceeded_depth, divergent, duration,
+        warm_started};
+}
+
+pybind11::dict
+wasabi(
+    PyArrayD const & Delta_w, PyArrayD const & Z,
+    double B0, double B1_nominal, double t_p,
+    slimp::action_parameters::Sample /* const & */ parameters,
+    std::vector<double> const & quantiles,
+    std::vector<std::size_t> const & keep)
+{
+    // Model type
+    using Model = slimp::Model<wasabi_sampler::model>;
+    
+    // Model context, initialized with constant fields and dummy values for
+    // non-constant fields.
+    slimp::VarContext context;
+    context.set("N", int(Z.shape()[1]));
+    context.set("Delta_w", ArrayD(Delta_w));
+    context.set("B0", B0);
+    context.set("B1_nominal", B1_nominal);
+    context.set("t_p", t_p);
+    auto update_context = [&](slimp::VarContext & context, std::size_t r) {
+        context.set("Z", ArrayD(xt::view(Z, r)));
+    };
+    update_context(context, 0);
+    
+    // Number of models to run
+    std::size_t const R = Z.shape()[0];
+    
+    for(auto const q: quantiles)
+    {
+        if(!(q >= 0 && q <= 1))
+        {
+            throw std::invalid_argument(
+                "Invalid quantile: "+std::to_string(q));
+        }
+    }
+    
+    // Position of the voxels in the array of kept draws, -1 if not kept
+    std::vector<long> kept(R, -1);
+    for(std::size_t i=0; i!=keep.size(); ++i)
+    {
+        if(keep[i] >= R)
+        {
+            throw std::invalid_argument(
+                "Invalid voxel index: "+std::to_string(keep[i]));
+        }
+        if(kept[keep[i]] >= 0)
+        {
+            throw std::invalid_argument(
+                "Duplicate voxel index: "+std::to_string(keep[i]));
+        }
+        kept[keep[i]] = i;
+    }
+    
+    // Outputs: summaries of the parameters and names, summarized HMC
+    // information, draws of the kept voxels
+    PyArrayD mean, sd, quantiles_, R_hat, ess, draws;
+    std::vector<std::string> names, raw_names;
+    std::size_t depth_index, divergent_index;
+    ArrayI exceeded_depth{ArrayI::shape_type{R}};
+    ArrayI divergent{ArrayI::shape_type{R}};
+    
+    // Create a dummy model to initialize the result arrays and helpers
+    {
+        Model dummy(context, parameters);
+        auto samples = dummy.create_samples();
+        
+        auto const hmc = dummy.hmc_names();
+        depth_index =
+            std::find(hmc.begin(), hmc.end(), "treedepth__") - hmc.begin();
+        divergent_index = 
+            std::find(hmc.begin(), hmc.end(), "divergent__") - hmc.begin();
+        
+        names = dummy.model_names();
+        for(auto array: {&mean, &sd, &R_hat, &ess})
+        {
+            *array = PyArrayD::from_shape(
+                std::vector<std::size_t>{R, names.size()});
+        }
+        quantiles_ = PyArrayD::from_shape(
+            std::vector<std::size_t>{R, names.size(), quantiles.size()});
+        draws = PyArrayD::from_shape(std::vector<std::size_t>{
+            keep.size(), names.size(), samples.shape(1), samples.shape(2)});
+        
+        raw_names = dummy.model_names(false, false);
+    }
+    
+    // Summarize the draws of each voxel as soon as they are available
+    auto update_results = [&](xt::xtensor<double, 3> const & samples, std::size_t r) {
+        slimp::Tensor3d const parameters_draws = xt::view(
+            samples, xt::range(-names.size(), xt::placeholders::_));
+        
+        xt::view(mean, r) = xt::mean(parameters_draws, {1, 2});
+        xt::view(sd, r) = xt::stddev(parameters_draws, {1, 2});
+        xt::view(R_hat, r) = slimp::get_potential_scale_reduction(
+            parameters_draws);
+        xt::view(ess, r) = slimp::get_effective_sample_size(parameters_draws);
+        
+        // Quantiles with linear interpolation, as in numpy
+        std::vector<double> values(
+            parameters_draws.shape(1)*parameters_draws.shape(2));
+        for(std::size_t parameter=0; parameter!=names.size(); ++parameter)
+        {
+            auto const parameter_draws = xt::view(parameters_draws, parameter);
+            std::copy(
+                parameter_draws.begin(), parameter_draws.end(), values.begin());
+            std::sort(values.begin(), values.end());
+            for(std::size_t q=0; q!=quantiles.size(); ++q)
+            {
+                auto const position = quantiles[q]*(values.size()-1);
+                auto const index = std::min(
+                    std::size_t(position), values.size()-1);
+                auto const next = std::min(index+1, values.size()-1);
+                quantiles_(r, parameter, q) =
+                    values[index]
+                    + (position-index)*(values[next]-values[index]);
+            }
+        }
+        
+        if(kept[r] >= 0)
+        {
+            xt::view(draws, kept[r]) = parameters_draws;
+        }
+        
+        exceeded_depth[r] = xt::sum(
+                xt::view(samples, depth_index) > parameters.hmc.max_depth
+            )[0];
+        divergent[r] = xt::sum(xt::view(samples, divergent_index))[0];
+    };
+    
+    stan::math::init_threadpool_tbb(parameters.threads_per_chain);
+    
+    slimp::parallel_sample<Model>(
+        context, parameters, R, update_context, update_results);
+    
+    pybind11::dict result;
+    result["mean"] = mean;
+    result["sd"] = sd;
+    result["quantiles"] = quantiles_;
+    result["R_hat"] = R_hat;
+    result["ess"] = ess;
+    result["names"] = names;
+    result["raw_names"] = raw_names;
+    result["exceeded_depth"] = exceeded_depth;
+    result["divergent"] = divergent;
+    result["draws"] = draws;
+    return result;
+}
+
 void wasabi(pybind11::module & m)
 {
     m.def("wasabi", &slimp::sample<wasabi_sampler::model>);
     m.def(
         "wasabi",
         pybind11::overload_cast<
-            ArrayD const &, ArrayD const &, double, double, double,
+            PyArrayD const &, PyArrayD const &, double, double, double,
             slimp::action_parameters::Sample>(wasabi));
+    m.def(
+        "wasabi",
+        pybind11::overload_cast<
+            PyArrayD const &, PyArrayD const &, double, double, double,
+            slimp::action_parameters::Sample, int, std::size_t>(wasabi),
+        "Sample the WASABI model with warm-started voxels. The voxels are "
+        "processed by blocks of at most block_size consecutive voxels, in "
+        "parallel: the first voxel of each block has a full warmup, and each "
+        "following voxel starts from the posterior mean, step size and "
+        "inverse metric of the previous one, with neighbour_warmup warmup "
+        "iterations. The voxels should thus be given in spatial order. The "
+        "blocks are smaller when there are too few voxels to keep all threads "
+        "busy, and the chains of each voxel also run in parallel. In addition "
+        "to the posterior, names, raw names, exceeded depth and divergent "
+        "counts, return the sampling duration of each voxel, in seconds, and "
+        "whether it was warm-started.",
+        pybind11::arg("Delta_w"), pybind11::arg("Z"), pybind11::arg("B0"),
+        pybind11::arg("B1_nominal"), pybind11::arg("t_p"),
+        pybind11::arg("parameters"), pybind11::arg("neighbour_warmup"),
+        pybind11::arg("block_size")=64);
+    m.def(
+        "wasabi",
+        pybind11::overload_cast<
+            PyArrayD const &, PyArrayD const &, double, double, double,
+            slimp::action_parameters::Sample, std::vector<double> const &,
+            std::vector<std::size_t> const &>(wasabi),
+        "Sample the WASABI model, and only return summaries of the posterior "
+        "of each voxel, computed as soon as the voxel is sampled: mean, "
+        "standard deviation, quantiles, potential scale reduction (R_hat) and "
+        "effective sample size, all with a shape of (R, parameters, ...). The "
+        "quantiles must be in [0, 1]. The full draws are only kept for the "
+        "voxels whose distinct indices are in keep, with a shape of "
+        "(len(keep), parameters, chains, draws). The result "
+        "is a dictionary, also containing the names, raw names, exceeded "
+        "depth and divergent counts.",
+        pybind11::arg("Delta_w"), pybind11::arg("Z"), pybind11::arg("B0"),
+        pybind11::arg("B1_nominal"), pybind11::arg("t_p"),
+        pybind11::arg("parameters"),
+        pybind11::arg("quantiles"),
+        pybind11::arg("keep")=std::vector<std::size_t>{});
 }
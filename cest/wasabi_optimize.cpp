@@ -0,0 +1,261 @@
+#include "wasabi_optimize.h"
+
+#include <cmath>
+#include <limits>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <Eigen/Core>
+#include <Eigen/Dense>
+
+#include <pybind11/numpy.h>
+#include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+
+#include <tbb/blocked_range.h>
+#include <tbb/parallel_for.h>
+
+#include "least_squares.h"
+#include "misc.h"
+
+namespace
+{
+
+// Larmor constant of the proton [rad/s/T], as in wasabi_sampler.stan
+double const gyromagnetic_ratio = 2.6752218708e8;
+
+/**
+ * @brief WASABI model, with normalized parameters so that the system solved by
+ * the Levenberg-Marquardt algorithm is well-conditioned: c, d, B1/B1_nominal
+ * and delta_w in ppm.
+ */
+class Model
+{
+public:
+    using Parameters = Eigen::Vector4d;
+    using Jacobian = Eigen::Matrix<double, Eigen::Dynamic, 4>;
+    
+    Model(
+        Eigen::Ref<Eigen::VectorXd const> Delta_w, double B0, double B1_nominal,
+        double t_p)
+    : Delta_w(Delta_w), w1_nominal(gyromagnetic_ratio*B1_nominal),
+        ppm(gyromagnetic_ratio*B0*1e-6), t_p(t_p)
+    {
+        // Nothing else
+    }
+    
+    /// @brief Compute the model
+    void operator()(Parameters const & p, Eigen::VectorXd & mu) const
+    {
+        auto const w1 = w1_nominal*p[2];
+        auto const w = (this->Delta_w.array() - ppm*p[3]).eval();
+        auto const q = (w1*w1 + w.square()).eval();
+        mu = (
+            p[0] - p[1] * w1*w1/q * (q.sqrt()*this->t_p/2).sin().square()
+        ).abs().matrix();
+    }
+    
+    /**
+     * @brief Compute the model and its Jacobian with respect to the normalized
+     * parameters.
+     */
+    void operator()(
+        Parameters const & p, Eigen::VectorXd & mu, Jacobian & J) const
+    {
+        auto const c = p[0], d = p[1];
+        auto const w1 = w1_nominal*p[2];
+        auto const delta_w = ppm*p[3];
+        for(Eigen::Index i=0; i!=this->Delta_w.size(); ++i)
+        {
+            auto const w = this->Delta_w[i] - delta_w;
+            auto const q = w1*w1 + w*w;
+            auto const r = std::sqrt(q);
+            
+            // sin(atan(w1/w))^2 = w1^2/(w1^2+w^2), also defined for w=0
+            auto const A = w1*w1/q;
+            auto const sine = std::sin(r*this->t_p/2);
+            auto const S = sine*sine;
+            auto const g = c - d*A*S;
+            auto const sign = (g < 0) ? -1. : 1.;
+            
+            auto const dS_dr = std::sin(r*this->t_p) * this->t_p/2;
+            auto const dg_dw1 = -d * (2*w1*w*w/(q*q)*S + A*dS_dr*w1/r);
+            auto const dg_dw = -d * (-2*w1*w1*w/(q*q)*S + A*dS_dr*w/r);
+            
+            mu[i] = std::abs(g);
+            J(i, 0) = sign;
+            J(i, 1) = -sign*A*S;
+            J(i, 2) = sign*dg_dw1*this->w1_nominal;
+            J(i, 3) = -sign*dg_dw*this->ppm;
+        }
+    }
+
+private:
+    Eigen::Ref<Eigen::VectorXd const> Delta_w;
+    double w1_nominal, ppm, t_p;
+};
+
+}
+
+std::vector<std::string> const & wasabi_names()
+{
+    static std::vector<std::string> const names{
+        "c", "d", "B1", "delta_w", "sigma"};
+    return names;
+}
+
+void optimize_wasabi(
+    Eigen::Ref<Eigen::VectorXd const> Delta_w,
+    Eigen::Ref<Eigen::MatrixXNd const> Z,
+    double B0, double B1_nominal, double t_p,
+    Eigen::Ref<Eigen::MatrixXNd> result)
+{
+    auto const size = Delta_w.size();
+    if(size < 4)
+    {
+        throw std::invalid_argument("At least 4 frequency offsets are required");
+    }
+    if(Z.cols() != size)
+    {
+        throw std::invalid_argument(
+            "Signal must have "+std::to_string(size)+" columns");
+    }
+    if(result.rows() != Z.rows() || result.cols() != 5)
+    {
+        throw std::invalid_argument(
+            "Result must have "+std::to_string(Z.rows())+" rows and 5 columns");
+    }
+    
+    Model const model(Delta_w, B0, B1_nominal, t_p);
+    auto const ppm = gyromagnetic_ratio*B0*1e-6;
+    
+    // The model oscillates with B1 and delta_w: start from the best point of a
+    // coarse grid of relative B1 and of delta_w (ppm), c and d being fitted
+    // by linear least squares on each point.
+    std::vector<Model::Parameters> starts;
+    for(int i=0; i<=20; ++i)
+    {
+        for(int j=-10; j<=10; ++j)
+        {
+            starts.emplace_back(0, -1, 0.5+0.05*i, 0.1*j);
+        }
+    }
+    
+    tbb::parallel_for(
+        tbb::blocked_range<Eigen::Index>(0, Z.rows()),
+        [&](tbb::blocked_range<Eigen::Index> const & range) {
+            Eigen::VectorXd mu(size);
+            for(auto row=range.begin(); row!=range.end(); ++row)
+            {
+                Eigen::VectorXd const Z_ = Z.row(row).transpose();
+                
+                auto best_cost = std::numeric_limits<double>::infinity();
+                Model::Parameters best;
+                for(auto p: starts)
+                {
+                    // With c=0 and d=-1, the model is u=A*S. For a given sign
+                    // of c - d*u, the model is linear in c and d: alternate
+                    // between the signs and the linear least squares, starting
+                    // from a perfect inversion (d = 2*c).
+                    model(p, mu);
+                    auto const n = double(size), s_u = mu.sum(),
+                        s_uu = mu.squaredNorm();
+                    auto const determinant = n*s_uu - s_u*s_u;
+                    if(determinant <= 0)
+                    {
+                        continue;
+                    }
+                    p[0] = Z_.maxCoeff();
+                    p[1] = 2*p[0];
+                    for(int iteration=0; iteration!=4; ++iteration)
+                    {
+                        Eigen::ArrayXd const sign =
+                            1 - 2*(p[0] - p[1]*mu.array() < 0).cast<double>();
+                        auto const s_z = (sign*Z_.array()).sum(),
+                            s_uz = (sign*mu.array()*Z_.array()).sum();
+                        p[0] = (s_uu*s_z - s_u*s_uz)/determinant;
+                        p[1] = -(n*s_uz - s_u*s_z)/determinant;
+                    }
+                    
+                    // As in the sampler, c and d must be positive
+                    if(p[0] <= 0 || p[1] <= 0)
+                    {
+                        continue;
+                    }
+                    
+                    auto const cost = 0.5*(
+                        (p[0] - p[1]*mu.array()).abs() - Z_.array()
+                    ).square().sum();
+                    if(cost < best_cost)
+                    {
+                        best_cost = cost;
+                        best = p;
+                    }
+                }
+                
+                if(std::isfinite(best_cost))
+                {
+                    best_cost = levenberg_marquardt(model, Z_, best);
+                }
+                else
+                {
+                    best.setConstant(std::numeric_limits<double>::quiet_NaN());
+                }
+                
+                // The model is invariant to the signs of (c, d) and of B1
+                if(best[0] < 0)
+                {
+                    best.head<2>() *= -1;
+                }
+                result(row, 0) = best[0];
+                result(row, 1) = best[1];
+                result(row, 2) = std::abs(best[2])*B1_nominal;
+                result(row, 3) = best[3]*ppm;
+                result(row, 4) = std::sqrt(2*best_cost/size);
+            }
+        });
+}
+
+void wasabi_optimize(pybind11::module & m)
+{
+    using namespace pybind11::literals;
+    
+    m.def(
+        "wasabi",
+        [](
+            ArrayOrScalar const & Delta_w, ArrayOrScalar const & Z,
+            double B0, double B1_nominal, double t_p,
+            std::string const & method, pybind11::object const & out) {
+            if(method != "optimize")
+            {
+                throw std::invalid_argument("Unknown method: "+method);
+            }
+            if(Z.ndim() != 2)
+            {
+                throw std::invalid_argument("Signal must be 2D");
+            }
+            
+            auto result = output_array<double>(out, {Z.shape(0), 5});
+            Eigen::Map<Eigen::MatrixXNd const> const Z_map(
+                Z.data(), Z.shape(0), Z.shape(1));
+            Eigen::Map<Eigen::MatrixXNd> result_map(
+                result.mutable_data(), result.shape(0), result.shape(1));
+            auto const Delta_w_ = as_vector(Delta_w);
+            {
+                pybind11::gil_scoped_release release_gil;
+                optimize_wasabi(Delta_w_, Z_map, B0, B1_nominal, t_p, result_map);
+            }
+            
+            return std::make_tuple(result, wasabi_names());
+        },
+        "Least-squares fit of the WASABI model, as an alternative to sampling "
+        "its posterior. Delta_w are the RF offsets w.r.t. the Larmor frequency "
+        "(rad/s), Z has one normalized spectrum per row, B0 and B1_nominal are "
+        "in T and t_p in s. The voxels are fitted in parallel with the "
+        "Levenberg-Marquardt algorithm. Return the estimates, with one row "
+        "per voxel, and the names of the parameters, as in the sampler. If "
+        "specified, the estimates are written to out.",
+        "Delta_w"_a, "Z"_a, "B0"_a, "B1_nominal"_a, "t_p"_a, "method"_a,
+        "out"_a=pybind11::none());
+}
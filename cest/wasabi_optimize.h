@@ -0,0 +1,36 @@
+#ifndef _fd92b6d1_bb58_428a_a85e_e0f219674355
+#define _fd92b6d1_bb58_428a_a85e_e0f219674355
+
+#include <string>
+#include <vector>
+
+#include <Eigen/Core>
+
+#include <pybind11/pybind11.h>
+
+#include "misc.h"
+
+/// @brief Names of the WASABI parameters, in the order of the sampler
+std::vector<std::string> const & wasabi_names();
+
+/**
+ * @brief Least-squares fit of the WASABI model of each voxel, using the
+ * Levenberg-Marquardt algorithm with an analytic Jacobian. The voxels are
+ * fitted in parallel.
+ * @param Delta_w RF offsets w.r.t. Larmor frequency [rad/s]
+ * @param Z Normalized signal magnitudes, one voxel per row
+ * @param B0 Main magnetic field [T]
+ * @param B1_nominal Nominal RF amplitude [T]
+ * @param t_p RF pulse duration [s]
+ * @param result Estimates of c, d, B1 [T], delta_w [rad/s] and sigma, one
+ *        voxel per row
+ */
+void optimize_wasabi(
+    Eigen::Ref<Eigen::VectorXd const> Delta_w,
+    Eigen::Ref<Eigen::MatrixXNd const> Z,
+    double B0, double B1_nominal, double t_p,
+    Eigen::Ref<Eigen::MatrixXNd> result);
+
+void wasabi_optimize(pybind11::module & m);
+
+#endif // _fd92b6d1_bb58_428a_a85e_e0f219674355
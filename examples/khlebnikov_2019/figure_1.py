@@ -1,5 +1,3 @@
-import itertools
-
 import colorcet
 import matplotlib.pyplot
 import numpy
@@ -26,20 +24,17 @@ mtrs = numpy.zeros((len(metabolites), len(w1s), len(durations)))
 
 species_a = species.grey_matter[B0]
 
-iterator = zip(
-    numpy.ndindex(mtrs.shape), itertools.product(metabolites, w1s, durations))
-for index, ((metabolite, proton), w1, duration) in iterator:
+for index, (metabolite, proton) in enumerate(metabolites):
     species_b = metabolite.species(species_a.T1, proton)
     
-    bm = lambda delta_w, w1, duration: cest.bm(
-        species_a, species_b, metabolite.labile_protons[proton].Cb, w0,
-        delta_w, w1, duration, [0, 0, species_a.M0, 0, 0, species_b.M0])[2]
+    # Simulate all (w1, duration) pairs at the reference, label and control
+    # offsets, starting from the equilibrium magnetization
+    Mz = cest.bm_sweep(
+        [species_a], [species_b], metabolite.labile_protons[proton].Cb, w0,
+        [-species_b.delta_w, +species_b.delta_w, 100], w1s, durations
+    )[0, 0, 0, ..., 2]
     
-    mtrs[index] += (
-        (
-            bm(-species_b.delta_w, w1, duration)
-            - bm(+species_b.delta_w, w1, duration))
-        / bm(100, w1, duration))
+    mtrs[index] = (Mz[..., 0] - Mz[..., 1]) / Mz[..., 2]
 
 figure, plots = matplotlib.pyplot.subplots(
     3, 2, layout="constrained", figsize=(9, 8))
@@ -37,16 +37,8 @@ if "Water" in series:
 derived = root/"derived"/"dummy"
 derived.mkdir(parents=True, exist_ok=True)
 
-B0 = cest.tasks.WASSR(
-    images["Glutamate"], meta_data["Glutamate"], derived/"B0.nii.gz",
-    ppm_range=(-5.1, +5.1))
-shifted = cest.tasks.ShiftSpectrum(
-    images["Glutamate"], meta_data["Glutamate"], B0.targets[0],
-    derived/"Glutamate_shifted.nii.gz")
-
 ppms = numpy.linspace(-5, 5, 501)
-refined = cest.tasks.Refine(
-    shifted.targets[0], shifted.file_dep[1], ppms,
-    derived/"Glutamate_refined.nii.gz")
-
-mtr = cest.tasks.MTR(refined.targets[0], ppms, derived/"Glutatmate_MTR.nii.gz")
+mtr = cest.tasks.Pipeline(
+    images["Glutamate"], meta_data["Glutamate"], ppms,
+    derived/"Glutatmate_MTR.nii.gz", wassr=derived/"B0.nii.gz",
+    ppm_range=(-5.1, +5.1))
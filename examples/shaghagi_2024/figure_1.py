@@ -23,12 +23,10 @@ duration = 10 # s
 
 spectra = numpy.empty((len(w1s), len(delta_w_rfs)))
 for index, w1 in enumerate(w1s):
-    spectra[index] = [
-        cest.bm(
-                species_a, species_b, Cb, w0, delta_w_rf, w1, duration,
-                [0, 0, species_a.M0, 0, 0, species_b.M0]
-            )[2]
-        for delta_w_rf in delta_w_rfs]
+    spectra[index] = cest.bm_batch(
+            species_a, species_b, Cb, w0, delta_w_rfs, w1, duration,
+            [0, 0, species_a.M0, 0, 0, species_b.M0]
+        )[:, 2]
 
 figure, plot = matplotlib.pyplot.subplots(layout="constrained")
 for spectrum, B1, color in zip(spectra, B1s, ["green", "red", "blue"]):
@@ -14,20 +14,20 @@ T2s = [0.003, 0.01, 0.03, 0.1, 0.3, 1]
 
 species_b = cest.Species(0.1, 0.08, Delta_omega_ppm, fb)
 
-bm = lambda rf_offset: cest.bm(
-    species_a, species_b, Cb, w0, rf_offset, w1, duration, M)
+bm = lambda rf_offsets: cest.bm_batch(
+    species_a, species_b, Cb, w0, rf_offsets, w1, duration, M)
 
 data = numpy.empty((2, len(T1s), len(rf_offsets_ppm)))
 for index, T1a in enumerate(T1s):
     species_a = cest.Species(T1a, 0.1, 0, 1)
     
     M = M0(species_a, species_b)
-    data[0, index] = [bm(x)[2] for x in rf_offsets_ppm]
+    data[0, index] = bm(rf_offsets_ppm)[:, 2]
 for index, T2a in enumerate(T2s):
     species_a = cest.Species(2, T2a, 0, 1)
     
     M = M0(species_a, species_b)
-    data[1, index] = [bm(x)[2] for x in rf_offsets_ppm]
+    data[1, index] = bm(rf_offsets_ppm)[:, 2]
 
 figure, plots = matplotlib.pyplot.subplots(
     2, 1, sharex=True, sharey=True, layout="constrained")
@@ -0,0 +1,71 @@
+import numpy
+import pytest
+import scipy.interpolate
+
+import cest
+
+# Non-uniform grids, with a dense centre as in usual Z-spectra, and with
+# different spacings at both ends
+grids = [
+    numpy.array([0., 1., 3., 4.]),
+    numpy.array([-6., -4., -2., -1., -0.5, 0., 0.5, 1., 2., 4., 6.]),
+    numpy.concatenate([
+        [-15, -10], numpy.linspace(-5, -1, 5), numpy.linspace(-0.8, 0.8, 9),
+        numpy.linspace(1, 5, 5), [7]]),
+    numpy.sort(numpy.random.default_rng(0).uniform(-5, 5, 20))]
+
+references = {
+    "linear": lambda x, y: lambda x_new: numpy.interp(x_new, x, y),
+    "cubic": scipy.interpolate.CubicSpline,
+    "akima": scipy.interpolate.Akima1DInterpolator}
+
+@pytest.mark.parametrize("kind", references.keys())
+@pytest.mark.parametrize("x", grids)
+def test_interpolate(kind, x):
+    y = numpy.stack([numpy.sin(x), x**2, numpy.exp(-x**2)])
+    x_new = numpy.linspace(x.min(), x.max(), 101)
+    
+    # Unsorted sample points
+    order = numpy.random.default_rng(1).permutation(len(x))
+    result = cest.utils.interpolate(x[order], y[:, order], x_new, kind)
+    
+    expected = numpy.stack([references[kind](x, f)(x_new) for f in y])
+    numpy.testing.assert_allclose(result, expected, rtol=0, atol=1e-10)
+
+@pytest.mark.parametrize("kind", references.keys())
+def test_interpolate_per_function(kind):
+    x = grids[1]
+    y = numpy.stack([numpy.sin(x), numpy.cos(x)])
+    x_new = numpy.stack([
+        numpy.linspace(-5, 5, 21), numpy.linspace(-1, 1, 21)])
+    
+    result = cest.utils.interpolate(x[::-1], y[:, ::-1], x_new, kind)
+    
+    expected = numpy.stack([
+        references[kind](x, f)(p) for f, p in zip(y, x_new)])
+    numpy.testing.assert_allclose(result, expected, rtol=0, atol=1e-10)
+
+def test_cubic_quadratic():
+    # A spline with not-a-knot conditions is exact for a parabola
+    x = numpy.array([0., 1., 3., 4.])
+    result = cest.utils.interpolate(x, x[None, :]**2, [0.5, 2, 3.5], "cubic")
+    numpy.testing.assert_allclose(result, [[0.25, 4, 12.25]], atol=1e-12)
+
+@pytest.mark.parametrize("kind", references.keys())
+def test_outside(kind):
+    x = grids[1]
+    y = numpy.stack([numpy.sin(x), x**2])
+    x_new = [-7, -6, 0.25, 6, 7]
+    
+    # Positions outside of the sampled range yield NaN, as in scipy
+    result = cest.utils.interpolate(x, y, x_new, kind)
+    assert numpy.all(numpy.isnan(result[:, [0, -1]]))
+    numpy.testing.assert_allclose(
+        result[:, 1:-1],
+        numpy.stack([references[kind](x, f)(x_new[1:-1]) for f in y]),
+        rtol=0, atol=1e-10)
+    
+    # Clamped positions take the value at the closest end, as in numpy.interp
+    result = cest.utils.interpolate(x, y, x_new, kind, clamp=True)
+    numpy.testing.assert_allclose(
+        result[:, [0, 1, -2, -1]], y[:, [0, 0, -1, -1]], rtol=0, atol=1e-10)
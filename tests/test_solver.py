@@ -0,0 +1,102 @@
+import itertools
+
+import numpy
+import pytest
+
+import cest
+
+# Water, amide and NOE at 3 T
+species_a = cest.Species(1.3, 50e-3, 0, 1)
+species_b = cest.Species(1, 10e-3, 3.5, 0.01)
+species_c = cest.Species(1, 10e-3, -3, 0.02)
+Cb, Cc = 40., 100.
+w0 = 3*2.6752218708e8
+
+M0_2 = [0, 0, species_a.M0, 0, 0, species_b.M0]
+M0_3 = [*M0_2, 0, 0, species_c.M0]
+
+# Far from resonance, near and on the resonance of each pool
+offsets = [-50, -5, -3, -2.99, -0.01, 0, 0.01, 1, 3.5, 3.51]
+w1s = [0, 2*numpy.pi*10, 2*numpy.pi*100, 2*numpy.pi*500]
+durations = [1e-4, 10e-3, 0.1, 2]
+
+tolerance = 1e-10
+
+def pools(count):
+    """ Species, exchange rates and equilibrium magnetization of the 2- or
+        3-pools model.
+    """
+    
+    if count == 2:
+        return (species_a, species_b, Cb), M0_2
+    else:
+        return (species_a, species_b, species_c, Cb, Cc), M0_3
+
+def check(solver_call):
+    """ Compare the results of the Padé and eigendecomposition solvers.
+    """
+    
+    cest.propagator_cache.clear()
+    pade = solver_call(cest.Solver.pade)
+    cest.propagator_cache.clear()
+    eigen = solver_call(cest.Solver.eigendecomposition)
+    numpy.testing.assert_allclose(eigen, pade, rtol=0, atol=tolerance)
+
+@pytest.mark.parametrize("count", [2, 3])
+@pytest.mark.parametrize("delta_w_rf", offsets)
+def test_block_pulse(count, delta_w_rf):
+    model, M0 = pools(count)
+    for w1, duration in itertools.product(w1s, durations):
+        check(
+            lambda solver: cest.bm(
+                *model, w0, delta_w_rf, w1, duration, M0, solver))
+
+@pytest.mark.parametrize("count", [2, 3])
+@pytest.mark.parametrize("delta_w_rf", offsets)
+def test_transition_matrix(count, delta_w_rf):
+    model, _ = pools(count)
+    for w1, duration in itertools.product(w1s, durations):
+        check(
+            lambda solver: cest.bm(
+                *model, w0, delta_w_rf, w1, duration, solver))
+
+@pytest.mark.parametrize("count", [2, 3])
+def test_batch(count):
+    model, M0 = pools(count)
+    # All combinations, with consecutive items sharing the same system
+    delta_w_rf, w1, duration = [
+        numpy.ravel(x) for x in numpy.meshgrid(
+            offsets, w1s, durations, indexing="ij")]
+    check(
+        lambda solver: cest.bm_batch(
+            *model, w0, delta_w_rf, w1, duration, M0, solver))
+
+@pytest.mark.parametrize("count", [2, 3])
+@pytest.mark.parametrize("projective", [False, True])
+@pytest.mark.parametrize("shape", ["block", "gaussian", "sech"])
+def test_shaped_pulse(count, projective, shape):
+    model, M0 = pools(count)
+    M0 = [*M0, 1] if projective else M0
+    steps = 50
+    pulse = getattr(cest.pulses, shape)(steps) * 2*numpy.pi*100 * steps
+    # Pulse with gaps, i.e. with w1=0
+    train = numpy.concatenate([pulse, numpy.zeros(10), pulse])
+    for delta_w_rf in offsets:
+        check(
+            lambda solver: cest.bm(
+                *model, w0, delta_w_rf, train, 1e-3, M0, solver))
+
+def test_cache_nan():
+    model, M0 = pools(2)
+    cest.propagator_cache.clear()
+    capacity = cest.propagator_cache.capacity
+    cest.propagator_cache.capacity = 4
+    try:
+        for _ in range(3):
+            cest.bm(*model, w0, 3.5, numpy.full(10, numpy.nan), 1e-3, M0)
+        assert cest.propagator_cache.size == 0
+        cest.bm(*model, w0, 3.5, numpy.arange(10.), 1e-3, M0)
+        assert cest.propagator_cache.size == 4
+    finally:
+        cest.propagator_cache.capacity = capacity
+        cest.propagator_cache.clear()